@@ -0,0 +1 @@
+"""Benchmarks of oirunner, for use with airspeed velocity (asv)."""
@@ -0,0 +1,30 @@
+"""Benchmarks of oirunner.forwardmodel."""
+
+import os
+
+from oirunner.forwardmodel import ForwardModel
+
+from .bench_priorimage import make_image
+
+DATAFILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "tests", "2004contest1.oifits"
+)
+
+
+class ScoreSuite:
+    params = ([1, 16, 128], [64, 128])
+    param_names = ["nimage", "dim"]
+
+    def setup(self, nimage, dim):
+        self.model = ForwardModel(DATAFILE)
+        self.hdus = [make_image(dim) for _ in range(nimage)]
+
+    def time_read(self, nimage, dim):
+        ForwardModel(DATAFILE)
+
+    def time_score_many(self, nimage, dim):
+        self.model.score_many(self.hdus)
+
+    def time_score_each(self, nimage, dim):
+        for hdu in self.hdus:
+            self.model.score(hdu)
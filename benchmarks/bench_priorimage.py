@@ -0,0 +1,140 @@
+"""Benchmarks of oirunner.priorimage.
+
+Run with asv, or directly as a script to print the speedup of makesf()
+relative to the original per-pixel implementation.
+
+"""
+
+import os
+import shutil
+import tempfile
+import timeit
+
+from astropy import wcs
+from astropy.io import fits
+
+import numpy as np
+
+import scipy.signal
+
+from oirunner import priorimage
+from oirunner.priorimage import MAS_TO_DEG, makesf
+
+PIXELSIZE = 0.25
+
+
+def makesf_loops(data, pixelsize, fwhm, threshold, blank=1e-8):
+    """Original per-pixel implementation of makesf."""
+    sigma = fwhm / pixelsize / 2.3548
+    maxvalue = data.max()
+    lowest = threshold * maxvalue
+    bw = int(6 * sigma)
+    kernel = np.zeros((bw, bw), float)
+    for i in range(bw):
+        for j in range(bw):
+            kernel[i, j] = np.exp(
+                -((i - bw / 2) ** 2 + (j - bw / 2) ** 2) / (2 * sigma * sigma)
+            )
+    result = scipy.signal.convolve(data, kernel, "same")
+    result = result * maxvalue / result.max()
+    for i in range(data.shape[0]):
+        for j in range(data.shape[1]):
+            if result[i, j] < lowest:
+                result[i, j] = blank
+    return result
+
+
+def make_image(dim):
+    """Return image HDU containing a random field of point sources."""
+    rng = np.random.default_rng(1)
+    data = rng.random((dim, dim)) ** 16
+    w = wcs.WCS(naxis=2)
+    w.wcs.cdelt = [PIXELSIZE * MAS_TO_DEG, PIXELSIZE * MAS_TO_DEG]
+    return fits.PrimaryHDU(data, header=w.to_header())
+
+
+class MakesfSuite:
+    params = ([128, 256, 512, 1024], [1.25, 10.0])
+    param_names = ["dim", "fwhm"]
+
+    def setup(self, dim, fwhm):
+        self.hdu = make_image(dim)
+
+    def time_makesf(self, dim, fwhm):
+        makesf(self.hdu, fwhm, 0.05)
+
+    def time_makesf_uncached(self, dim, fwhm):
+        priorimage.gaussian_kernel.cache_clear()
+        priorimage._kernel_fft.cache_clear()
+        makesf(self.hdu, fwhm, 0.05)
+
+    def time_makesf_loops(self, dim, fwhm):
+        makesf_loops(self.hdu.data, PIXELSIZE, fwhm, 0.05)
+
+
+class MakesfCubeSuite:
+    params = ([8, 64], [128, 256])
+    param_names = ["nwav", "dim"]
+
+    def setup(self, nwav, dim):
+        hdu = make_image(dim)
+        self.planes = [
+            fits.PrimaryHDU(np.roll(hdu.data, i, axis=1), header=hdu.header)
+            for i in range(nwav)
+        ]
+        cube = np.stack([plane.data for plane in self.planes])
+        self.cube = fits.PrimaryHDU(cube, header=hdu.header)
+
+    def time_makesf_cube(self, nwav, dim):
+        makesf(self.cube, 1.25, 0.05)
+
+    def time_makesf_planes(self, nwav, dim):
+        for plane in self.planes:
+            makesf(plane, 1.25, 0.05)
+
+
+class MakesfMemorySuite:
+    params = [1024, 2048]
+    param_names = ["dim"]
+
+    def setup(self, dim):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, "image.fits")
+        make_image(dim).writeto(self.filename)
+
+    def teardown(self, dim):
+        shutil.rmtree(self.tempdir)
+
+    def peakmem_makesf(self, dim):
+        with fits.open(self.filename, memmap=False) as hdulist:
+            makesf(hdulist[0], 1.25, 0.05)
+
+    def peakmem_makesf_lowmem(self, dim):
+        with fits.open(self.filename, memmap=True) as hdulist:
+            out = np.empty(hdulist[0].shape, np.float32)
+            makesf(hdulist[0], 1.25, 0.05, out=out)
+
+
+def main():
+    """Print table of makesf timings."""
+    print(f"{'dim':>6} {'fwhm':>6} {'loops/s':>10} {'makesf/s':>10} {'speedup':>8}")
+    for dim in MakesfSuite.params[0]:
+        for fwhm in MakesfSuite.params[1]:
+            hdu = make_image(dim)
+            makesf(hdu, fwhm, 0.05)  # populate kernel cache
+            t_new = min(timeit.repeat(lambda: makesf(hdu, fwhm, 0.05), number=1))
+            t_old = min(
+                timeit.repeat(
+                    lambda: makesf_loops(hdu.data, PIXELSIZE, fwhm, 0.05),
+                    number=1,
+                    repeat=3,
+                )
+            )
+            print(
+                f"{dim:6d} {fwhm:6.2f} {t_old:10.4f} {t_new:10.4f} "
+                f"{t_old / t_new:7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""Benchmarks of oirunner overhead in running bsmem.
+
+The stand-in tests/fakebsmem.py is used in place of bsmem, so that these
+measure argument building, subprocess orchestration, output parsing, prior
+staging and the parallel drivers rather than the reconstruction itself.
+ParallelSuite gives each stand-in run a nominal 0.1 s of work, so that
+its timings show how well runs overlap, and CpuSlotSuite gives CPU-bound
+runs, so that its timings show throughput with different CPU slot layouts.
+
+"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+
+import numpy as np
+
+from oirunner import asyncbsmem, cpuslots, runbsmem, spectral, sweep
+from oirunner.oiselect import DataIndex, DataSelector, _CHANNEL_COLUMNS
+from oirunner.staging import PriorStager, hash_hdu
+
+from .bench_priorimage import make_image
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+FAKEBSMEM = os.path.join(ROOT, "tests", "fakebsmem.py")
+DATAFILE = os.path.join(ROOT, "tests", "2004contest1.oifits")
+IMAGEFILE = os.path.join(ROOT, "tests", "gauss10.fits")
+
+
+class FakeBsmem:
+    """Base class for suites using stand-in bsmem in a temporary directory."""
+
+    niter = 10
+    nlines = 0
+    delay = 0.0
+
+    def setup(self, *params):
+        self.tempdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tempdir, os.path.basename(DATAFILE))
+        shutil.copyfile(DATAFILE, self.datafile)
+        self.outputfile = os.path.join(self.tempdir, "out.fits")
+        self._bsmem = runbsmem.BSMEM
+        self._environ = dict(os.environ)
+        runbsmem.BSMEM = FAKEBSMEM
+        os.environ["FAKEBSMEM_NITER"] = str(self.niter)
+        os.environ["FAKEBSMEM_LINES"] = str(self.nlines)
+        os.environ["FAKEBSMEM_DELAY"] = str(self.delay)
+
+    def teardown(self, *params):
+        runbsmem.BSMEM = self._bsmem
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.tempdir)
+
+
+class ArgsSuite:
+    def time_get_model_args(self):
+        runbsmem.get_model_args(
+            DATAFILE,
+            "out.fits",
+            128,
+            3,
+            10.0,
+            pixelsize=0.25,
+            wav=(500.0, 600.0),
+            uvmax=1.1e8,
+            alpha=1000.0,
+        )
+
+    def time_get_image_args(self):
+        runbsmem.get_image_args(
+            DATAFILE, "out.fits", 128, 0.25, "prior.fits", use_t3="phi", v2a=1.02
+        )
+
+
+class RunSuite(FakeBsmem):
+    params = ([10, 100], [0, 20])
+    param_names = ["niter", "nlines"]
+
+    def setup(self, niter, nlines):
+        self.niter = niter
+        self.nlines = nlines
+        super().setup()
+        self.args = runbsmem.get_model_args(
+            self.datafile, self.outputfile, 64, 3, 10.0, pixelsize=0.25
+        )
+
+    def time_run_bsmem(self, niter, nlines):
+        runbsmem.run_bsmem(self.args, use_cache=False)
+
+    def time_run_bsmem_fullstdout(self, niter, nlines):
+        fullstdout = runbsmem._get_fullstdout(self.outputfile)
+        runbsmem.run_bsmem(self.args, fullstdout, use_cache=False)
+
+    def time_async_run_bsmem(self, niter, nlines):
+        asyncio.run(asyncbsmem.async_run_bsmem(self.args, use_cache=False))
+
+
+class StagingSuite:
+    params = [64, 256, 1024]
+    param_names = ["dim"]
+
+    def setup(self, dim):
+        self.scratchdir = tempfile.mkdtemp()
+        self.hdu = make_image(dim)
+        self.stager = PriorStager(self.scratchdir)
+        with self.stager.stage(self.hdu):
+            pass
+
+    def teardown(self, dim):
+        self.stager.cleanup()
+        shutil.rmtree(self.scratchdir)
+
+    def time_stage_write(self, dim):
+        with PriorStager(self.scratchdir, reuse=False).stage(self.hdu):
+            pass
+
+    def time_stage_reuse(self, dim):
+        with self.stager.stage(self.hdu):
+            pass
+
+    def time_hash_hdu(self, dim):
+        hash_hdu(self.hdu)
+
+
+def make_large_oifits(filename, nwave, repeat):
+    """Write test data with nwave channels and each data row repeated."""
+    with fits.open(DATAFILE) as hdulist:
+        hdus = [hdu.copy() for hdu in hdulist]
+    for i, hdu in enumerate(hdus):
+        if hdu.name == "OI_WAVELENGTH":
+            waves = np.linspace(500e-9, 800e-9, nwave)
+            cols = [
+                fits.Column("EFF_WAVE", "E", "m", array=waves),
+                fits.Column("EFF_BAND", "E", "m", array=np.full(nwave, 5e-9)),
+            ]
+        elif hdu.name in ["OI_VIS2", "OI_T3"]:
+            cols = []
+            for col in hdu.columns:
+                array, fmt = np.repeat(hdu.data[col.name], repeat, axis=0), col.format
+                if col.name in _CHANNEL_COLUMNS:
+                    array = np.repeat(array.reshape(-1, 1), nwave, axis=1)
+                    fmt = "%d%s" % (nwave, col.format.format)
+                cols.append(fits.Column(col.name, fmt, col.unit, array=array))
+        else:
+            continue
+        hdus[i] = fits.BinTableHDU.from_columns(cols, header=hdu.header)
+    fits.HDUList(hdus).writeto(filename)
+
+
+class SelectSuite:
+    params = [16, 128]
+    param_names = ["nwave"]
+
+    def setup(self, nwave):
+        self.tempdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tempdir, "large.oifits")
+        make_large_oifits(self.datafile, nwave, 20)
+        self.index = DataIndex(self.datafile)
+        self.subsetfile = os.path.join(self.tempdir, "subset.oifits")
+
+    def teardown(self, nwave):
+        shutil.rmtree(self.tempdir)
+
+    def time_index(self, nwave):
+        DataIndex(self.datafile)
+
+    def time_write_channel(self, nwave):
+        self.index.write(self.subsetfile, (600.0, 610.0), 1.1e8)
+
+    def time_subset_reuse(self, nwave):
+        selector = DataSelector(self.tempdir)
+        selector.subset(self.datafile, (600.0, 610.0), 1.1e8)
+        selector.subset(self.datafile, (600.0, 610.0), 1.1e8)
+
+
+class ReconstSuite(FakeBsmem):
+    def time_reconst_grey_2step_using_image(self):
+        runbsmem.reconst_grey_2step_using_image(
+            self.datafile, IMAGEFILE, use_cache=False
+        )
+
+
+class ParallelSuite(FakeBsmem):
+    params = [1, 4]
+    param_names = ["workers"]
+    delay = 0.01
+    wavs = [(500.0 + 10 * i, 510.0 + 10 * i) for i in range(8)]
+
+    def time_reconst_channels(self, workers):
+        spectral.reconst_channels(
+            self.datafile, self.wavs, workers=workers, dim=64, use_cache=False
+        )
+
+    def time_sweep(self, workers):
+        combinations = sweep.param_grid({"alpha": [10.0, 100.0, 1000.0, 1e4]})
+        sweep.sweep(
+            self.datafile,
+            combinations,
+            workers=workers,
+            sweepdir=self.tempdir,
+            dim=64,
+            use_cache=False,
+        )
+
+    def time_async_gather(self, workers):
+        async def run_all():
+            semaphore = asyncio.Semaphore(workers)
+            await asyncio.gather(
+                *[
+                    asyncbsmem.async_run_bsmem_using_model(
+                        self.datafile,
+                        os.path.join(self.tempdir, f"out{i}.fits"),
+                        64,
+                        3,
+                        10.0,
+                        pixelsize=0.25,
+                        use_cache=False,
+                        semaphore=semaphore,
+                    )
+                    for i in range(8)
+                ]
+            )
+
+        asyncio.run(run_all())
+
+
+class CpuSlotSuite(FakeBsmem):
+    """Throughput of CPU-bound stand-in runs against CPU slot layout.
+
+    Each run spends 0.05 s of CPU time per iteration. "unpinned" runs as
+    many concurrent jobs as there are CPUs without slots; the others use a
+    SlotAllocator with the given CPUs per slot and layout.
+
+    """
+
+    params = ["unpinned", "1-compact", "2-compact", "2-scatter"]
+    param_names = ["layout"]
+    niter = 4
+    njobs = 8
+
+    def setup(self, layout):
+        self.cpus = len(os.sched_getaffinity(0))
+        self.cpu_slots = None
+        if layout != "unpinned":
+            cpus_per_slot, name = layout.split("-")
+            if int(cpus_per_slot) > self.cpus:
+                raise NotImplementedError
+            self.cpu_slots = cpuslots.SlotAllocator(
+                cpus_per_slot=int(cpus_per_slot), layout=name
+            )
+        super().setup()
+        os.environ["FAKEBSMEM_SPIN"] = "0.05"
+        self.args = [
+            runbsmem.get_model_args(
+                self.datafile,
+                os.path.join(self.tempdir, f"out{i}.fits"),
+                64,
+                3,
+                10.0,
+                pixelsize=0.25,
+            )
+            for i in range(self.njobs)
+        ]
+
+    def time_throughput(self, layout):
+        workers = self.cpus if self.cpu_slots is None else len(self.cpu_slots)
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(
+                    runbsmem.run_bsmem,
+                    args,
+                    use_cache=False,
+                    cpu_slots=self.cpu_slots,
+                )
+                for args in self.args
+            ]
+            for future in futures:
+                future.result()
@@ -0,0 +1,27 @@
+"""Benchmarks of oirunner start-up time.
+
+Each benchmark runs in a new interpreter, so that the cost of importing
+oirunner and its dependencies is included.
+
+"""
+
+
+def timeraw_import_runbsmem():
+    """Time importing the bsmem runner."""
+    return "import oirunner.runbsmem"
+
+
+def timeraw_import_pipeline():
+    """Time importing the multi-step pipeline."""
+    return "import oirunner.pipeline"
+
+
+def timeraw_makesf_version():
+    """Time "makesf -V", excluding interpreter start-up."""
+    return """
+    from oirunner.makesf.__main__ import create_parser
+    try:
+        create_parser().parse_args(["-V"])
+    except SystemExit:
+        pass
+    """
@@ -0,0 +1,620 @@
+"""Python module to run BSMEM from asyncio coroutines.
+
+The coroutines mirror the functions in oirunner.runbsmem and build the same
+bsmem arguments, so that a single event loop can drive many concurrent
+reconstructions. Concurrent bsmem runs are limited by a semaphore, and
+cancelling a coroutine kills its bsmem subprocess.
+
+Attributes:
+  DEFAULT_CONCURRENCY (int): Default maximum number of concurrent bsmem runs
+                             per event loop.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import copy
+import logging
+import os
+import shutil
+import signal
+import time
+import weakref
+from subprocess import CalledProcessError, PIPE
+from typing import (
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    TYPE_CHECKING,
+    Tuple,
+)
+
+from . import timing
+from .bsmemoutput import IterationParser, IterationRecord
+from .checkpoint import JobManifest
+from .cpuslots import CpuSlot, SlotAllocator
+from .lazy import lazy_import
+from .oiselect import DataSelector
+from .priorimage import get_pixelsize, makesf
+from .runbsmem import (
+    BsmemResult,
+    DEFAULT_DIM,
+    DEFAULT_MT,
+    DEFAULT_MW,
+    STDERR_LINES,
+    TERMINATE_GRACE,
+    _fetch_cached,
+    _finish_run,
+    _get_arg,
+    _get_fullstdout,
+    _get_mtime,
+    _get_outputfile,
+    _get_tag,
+    _install,
+    _lock_output,
+    _make_workdir,
+    _read_image,
+    _replay,
+    _unlock_output,
+    get_image_args,
+    get_model_args,
+)
+from .staging import PriorStager, get_default_stager
+from .stopping import StopPolicy
+
+if TYPE_CHECKING:
+    from astropy.io import fits
+else:
+    fits = lazy_import("astropy.io.fits")
+
+DEFAULT_CONCURRENCY = os.cpu_count() or 1
+
+
+# Keyword arguments consumed by async_run_bsmem() rather than bsmem itself
+_RUN_KWARGS = [
+    "use_cache",
+    "callback",
+    "timeout",
+    "stop_policy",
+    "checkpoint",
+    "semaphore",
+    "isolate",
+    "cpu_slots",
+]
+
+_semaphores: MutableMapping[asyncio.AbstractEventLoop, asyncio.Semaphore] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+# Locks on output filenames held by isolated runs in each event loop
+_output_locks: MutableMapping[
+    asyncio.AbstractEventLoop, "weakref.WeakValueDictionary[str, asyncio.Lock]"
+] = weakref.WeakKeyDictionary()
+
+# Interval between attempts to take an output lock held elsewhere (seconds)
+_LOCK_POLL = 0.05
+
+
+def get_semaphore() -> asyncio.Semaphore:
+    """Return semaphore shared by bsmem runs in the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(DEFAULT_CONCURRENCY)
+    return _semaphores[loop]
+
+
+def _split_kwargs(kwargs: Dict) -> Tuple[Dict, Dict]:
+    runkw = {k: v for k, v in kwargs.items() if k in _RUN_KWARGS}
+    argkw = {k: v for k, v in kwargs.items() if k not in _RUN_KWARGS}
+    return runkw, argkw
+
+
+def _killpg(pid: int, sig: int) -> None:
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def _collect(stream: asyncio.StreamReader, lines: Deque[str]) -> None:
+    async for raw in stream:
+        lines.append(raw.decode("utf-8", errors="replace"))
+
+
+async def _stream_bsmem(
+    args: Sequence[str],
+    fullstdout: Optional[str],
+    callback: Optional[Callable[[IterationRecord], None]],
+    timeout: Optional[float],
+    stop_policy: Optional[StopPolicy],
+    slot: Optional[CpuSlot] = None,
+) -> Optional[str]:
+    """Run bsmem, parsing its output as it arrives, and return stop reason."""
+    loop = asyncio.get_running_loop()
+    logging.info("Running '%s'" % " ".join(args))
+    policy = copy.deepcopy(stop_policy)
+    if policy is not None:
+        policy.reset()
+    parser = IterationParser()
+    errlines: Deque[str] = collections.deque(maxlen=STDERR_LINES)
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=PIPE,
+        stderr=PIPE,
+        start_new_session=True,
+        env=None if slot is None else slot.environ(),
+        preexec_fn=None if slot is None else slot.preexec,
+    )
+    assert process.stdout is not None and process.stderr is not None
+    errtask = asyncio.ensure_future(_collect(process.stderr, errlines))
+    stop_reason = None
+    handles = []
+
+    def stop(reason: str) -> None:
+        nonlocal stop_reason
+        if stop_reason is not None or process.returncode is not None:
+            return
+        stop_reason = reason
+        logging.warning(f"Stopping bsmem: {reason}")
+        _killpg(process.pid, signal.SIGTERM)
+        handles.append(
+            loop.call_later(TERMINATE_GRACE, _killpg, process.pid, signal.SIGKILL)
+        )
+
+    def handle(record: IterationRecord) -> None:
+        if policy is not None:
+            reason = policy(record)
+            if reason is not None:
+                stop(reason)
+        if callback is not None:
+            callback(record)
+
+    if timeout is not None:
+        handles.append(
+            loop.call_later(
+                timeout, stop, "wall-clock limit of %g s exceeded" % timeout
+            )
+        )
+    with contextlib.ExitStack() as stack:
+        out = None
+        if fullstdout is not None:
+            out = stack.enter_context(open(fullstdout, "w"))
+        try:
+            async for raw in process.stdout:
+                line = raw.decode("utf-8", errors="replace")
+                if out is not None:
+                    out.write(line)
+                record = parser.feed(line)
+                if record is not None:
+                    handle(record)
+            record = parser.finish()
+            if record is not None:
+                handle(record)
+            returncode = await process.wait()
+            await errtask
+        except BaseException:
+            _killpg(process.pid, signal.SIGKILL)
+            errtask.cancel()
+            raise
+        finally:
+            for h in handles:
+                h.cancel()
+        if out is not None and stop_reason is not None:
+            out.write(f"oirunner: bsmem stopped early ({stop_reason})\n")
+    last = "" if parser.last is None else parser.last.text
+    if returncode != 0 and stop_reason is None:
+        raise CalledProcessError(returncode, list(args), last, "".join(errlines))
+    logging.info(f"Last iteration:\n{last}")
+    return stop_reason
+
+
+async def async_run_bsmem(
+    args: Sequence[str],
+    fullstdout: Optional[str] = None,
+    use_cache: bool = True,
+    callback: Optional[Callable[[IterationRecord], None]] = None,
+    timeout: Optional[float] = None,
+    stop_policy: Optional[StopPolicy] = None,
+    checkpoint: Optional[JobManifest] = None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+    isolate: bool = False,
+    cpu_slots: Optional[SlotAllocator] = None,
+) -> BsmemResult:
+    """Run bsmem as subprocess and log result.
+
+    Asynchronous counterpart of oirunner.runbsmem.run_bsmem(). The resource
+    usage of the subprocess is not measured.
+
+    Args:
+      args: Arguments for subprocess.
+      fullstdout: Destination filename for full stdout.
+      use_cache: Reuse cached result if available.
+      callback: Function called with each iteration record as it arrives.
+      timeout: Wall-clock limit for bsmem run (seconds).
+      stop_policy: Policy for stopping bsmem once converged.
+      checkpoint: Manifest of completed runs to skip and to record run in.
+      semaphore: Limits concurrent bsmem runs, default from get_semaphore().
+      isolate: Lock output and run bsmem in a private working directory
+               (see run_bsmem()); runs waiting for the lock do not count
+               against the semaphore.
+      cpu_slots: Allocator of CPUs to pin bsmem to (see oirunner.cpuslots).
+
+    Returns:
+      Result of run, including the iteration records and the reason bsmem
+      was stopped early (if it was).
+
+    Raises:
+      BsmemStopped, CalledProcessError, OSError
+
+    """
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    records: List[IterationRecord] = []
+
+    def collect(record: IterationRecord) -> None:
+        records.append(record)
+        if callback is not None:
+            callback(record)
+
+    if semaphore is None:
+        semaphore = get_semaphore()
+    outputfile = _get_arg(args, "--output=")
+    isolate = isolate and outputfile is not None
+    async with contextlib.AsyncExitStack() as stack:
+        workargs, workstdout = args, fullstdout
+        if isolate:
+            assert outputfile is not None
+            # Wait for lock before taking a semaphore slot
+            with timing.span("bsmem.lock", outputfile=outputfile):
+                await stack.enter_async_context(_async_lock_output(outputfile))
+            workdir, workargs, workstdout = _make_workdir(args, fullstdout)
+            stack.callback(shutil.rmtree, workdir, ignore_errors=True)
+        async with semaphore:
+            with timing.span("bsmem", outputfile=outputfile) as attributes:
+                if checkpoint is not None:
+                    completed = await loop.run_in_executor(
+                        None, checkpoint.completed, args
+                    )
+                    if completed is not None:
+                        logging.info("Skipping completed run '%s'" % " ".join(args))
+                        attributes["skipped"] = True
+                        _replay(fullstdout, collect)
+                        return BsmemResult(
+                            args,
+                            records,
+                            time.perf_counter() - start,
+                            stop_reason=completed.stop_reason,
+                            reused=True,
+                        )
+                cache, key = await loop.run_in_executor(
+                    None, _fetch_cached, workargs, workstdout, use_cache, None
+                )
+                if cache is not None and key is None:
+                    attributes["cached"] = True
+                    _replay(workstdout, collect)
+                    if isolate:
+                        _install(workargs, workstdout, args, fullstdout)
+                    if checkpoint is not None:
+                        await loop.run_in_executor(None, checkpoint.record, args)
+                    return BsmemResult(
+                        args, records, time.perf_counter() - start, reused=True
+                    )
+                before = _get_mtime(outputfile)
+                slot = None
+                if cpu_slots is not None:
+                    with timing.span("bsmem.slot_wait"):
+                        slot = await cpu_slots.async_acquire()
+                    stack.callback(cpu_slots.release, slot)
+                    attributes["cpus"] = list(slot.cpus)
+                try:
+                    stop_reason = await _stream_bsmem(
+                        workargs, workstdout, collect, timeout, stop_policy, slot
+                    )
+                except CalledProcessError as e:
+                    # log output from bsmem process
+                    logging.exception(f"bsmem failed:\n{e.stderr}\n{e.stdout}")
+                    attributes["returncode"] = e.returncode
+                    raise
+                attributes["stop_reason"] = stop_reason
+                await loop.run_in_executor(
+                    None,
+                    _finish_run,
+                    workargs,
+                    workstdout,
+                    stop_reason,
+                    before,
+                    cache,
+                    key,
+                )
+                if isolate:
+                    _install(workargs, workstdout, args, fullstdout)
+                if checkpoint is not None:
+                    await loop.run_in_executor(
+                        None, checkpoint.record, args, stop_reason
+                    )
+                return BsmemResult(
+                    args, records, time.perf_counter() - start, stop_reason=stop_reason
+                )
+
+
+@contextlib.asynccontextmanager
+async def _async_lock_output(outputfile: str) -> AsyncIterator[None]:
+    """Hold exclusive lock on output filename, waiting on the event loop.
+
+    Runs in the same event loop queue on an asyncio.Lock for the output,
+    and the file lock excluding other threads and processes is polled
+    for, so that waiting runs do not occupy executor threads.
+
+    """
+    locks = _output_locks.setdefault(
+        asyncio.get_running_loop(), weakref.WeakValueDictionary()
+    )
+    path = os.path.abspath(outputfile)
+    lock = locks.get(path)
+    if lock is None:
+        lock = locks[path] = asyncio.Lock()
+    async with lock:
+        while True:
+            try:
+                f = _lock_output(outputfile, blocking=False)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(_LOCK_POLL)
+        try:
+            yield
+        finally:
+            _unlock_output(f)
+
+
+@contextlib.asynccontextmanager
+async def _stage(
+    stager: Optional[PriorStager], imagehdu: fits.PrimaryHDU
+) -> AsyncIterator[str]:
+    if stager is None:
+        stager = get_default_stager()
+    cm = stager.stage(imagehdu)
+    with timing.span("stage_prior"):
+        priorfile = await asyncio.get_running_loop().run_in_executor(None, cm.__enter__)
+    try:
+        yield priorfile
+    finally:
+        cm.__exit__(None, None, None)
+
+
+async def _select_data(
+    selector: Optional[DataSelector], datafile: str, argkw: Dict
+) -> str:
+    if selector is None:
+        return datafile
+    loop = asyncio.get_running_loop()
+    with timing.span("select_data"):
+        return await loop.run_in_executor(
+            None, selector.subset, datafile, argkw.get("wav"), argkw.get("uvmax")
+        )
+
+
+async def async_run_bsmem_using_model(
+    datafile: str,
+    outputfile: str,
+    dim: int,
+    modeltype: int,
+    modelwidth: float,
+    pixelsize: Optional[float] = None,
+    selector: Optional[DataSelector] = None,
+    **kwargs,
+) -> BsmemResult:
+    """Run bsmem using initial/prior model.
+
+    Asynchronous counterpart of oirunner.runbsmem.run_bsmem_using_model(),
+    accepting the same arguments and those of async_run_bsmem().
+
+    """
+    runkw, argkw = _split_kwargs(kwargs)
+    datafile = await _select_data(selector, datafile, argkw)
+    args = get_model_args(
+        datafile, outputfile, dim, modeltype, modelwidth, pixelsize, **argkw
+    )
+    return await async_run_bsmem(args, _get_fullstdout(outputfile), **runkw)
+
+
+async def async_run_bsmem_using_image(
+    datafile: str,
+    outputfile: str,
+    dim: int,
+    pixelsize: float,
+    imagehdu: fits.PrimaryHDU,
+    stager: Optional[PriorStager] = None,
+    selector: Optional[DataSelector] = None,
+    **kwargs,
+) -> BsmemResult:
+    """Run bsmem using initial/prior image.
+
+    Asynchronous counterpart of oirunner.runbsmem.run_bsmem_using_image(),
+    accepting the same arguments and those of async_run_bsmem().
+
+    """
+    runkw, argkw = _split_kwargs(kwargs)
+    datafile = await _select_data(selector, datafile, argkw)
+    async with _stage(stager, imagehdu) as priorfile:
+        args = get_image_args(datafile, outputfile, dim, pixelsize, priorfile, **argkw)
+        return await async_run_bsmem(args, _get_fullstdout(outputfile), **runkw)
+
+
+async def _read_prior(
+    imagefile: str, fwhm: Optional[float] = None, threshold: float = 0.0
+) -> fits.PrimaryHDU:
+    """Read image (then blur and threshold if fwhm given) in worker thread."""
+
+    def read() -> fits.PrimaryHDU:
+        imagehdu = _read_image(imagefile)
+        if fwhm is not None:
+            return makesf(imagehdu, fwhm, threshold)
+        return imagehdu
+
+    return await asyncio.get_running_loop().run_in_executor(None, read)
+
+
+async def async_reconst_grey_basic(
+    datafile: str,
+    pixelsize: Optional[float] = None,
+    dim: int = DEFAULT_DIM,
+    modeltype: int = DEFAULT_MT,
+    modelwidth: float = DEFAULT_MW,
+    wav: Optional[Tuple[float, float]] = None,
+    hash_names: bool = False,
+    **kwargs,
+) -> BsmemResult:
+    """Reconstruct a grey image by running bsmem once.
+
+    Asynchronous counterpart of oirunner.runbsmem.reconst_grey_basic().
+
+    Returns:
+       Result of bsmem run, path-like giving output FITS filename.
+
+    """
+    params = dict(
+        pixelsize=pixelsize,
+        dim=dim,
+        modeltype=modeltype,
+        modelwidth=modelwidth,
+        wav=wav,
+    )
+    tag = _get_tag(hash_names, params, kwargs)
+    outputfile = _get_outputfile(datafile, 1, wav, tag)
+    return await async_run_bsmem_using_model(
+        datafile,
+        outputfile,
+        dim,
+        modeltype,
+        modelwidth,
+        pixelsize=pixelsize,
+        wav=wav,
+        **kwargs,
+    )
+
+
+async def async_reconst_grey_basic_using_image(
+    datafile: str,
+    imagefile: str,
+    wav: Optional[Tuple[float, float]] = None,
+    hash_names: bool = False,
+    **kwargs,
+) -> BsmemResult:
+    """Reconstruct a grey image by running bsmem once using a prior image.
+
+    Asynchronous counterpart of
+    oirunner.runbsmem.reconst_grey_basic_using_image().
+
+    Returns:
+       Result of bsmem run, path-like giving output FITS filename.
+
+    """
+    tag = _get_tag(hash_names, dict(imagefile=imagefile, wav=wav), kwargs)
+    outputfile = _get_outputfile(datafile, 1, wav, tag)
+    imagehdu = await _read_prior(imagefile)
+    return await async_run_bsmem_using_image(
+        datafile,
+        outputfile,
+        imagehdu.data.shape[0],
+        get_pixelsize(imagehdu),
+        imagehdu,
+        wav=wav,
+        **kwargs,
+    )
+
+
+async def async_reconst_grey_2step(
+    datafile: str,
+    pixelsize: float,
+    dim: int = DEFAULT_DIM,
+    modeltype: int = DEFAULT_MT,
+    modelwidth: float = DEFAULT_MW,
+    wav: Optional[Tuple[float, float]] = None,
+    uvmax1: float = 1.1e8,
+    fwhm: float = 1.25,
+    threshold: float = 0.05,
+    hash_names: bool = False,
+    **kwargs,
+) -> BsmemResult:
+    """Reconstruct a grey image by running bsmem twice.
+
+    Asynchronous counterpart of oirunner.runbsmem.reconst_grey_2step().
+
+    Returns:
+       Result of bsmem run, path-like giving output FITS filename.
+
+    """
+    params = dict(
+        pixelsize=pixelsize,
+        dim=dim,
+        modeltype=modeltype,
+        modelwidth=modelwidth,
+        wav=wav,
+        uvmax1=uvmax1,
+        fwhm=fwhm,
+        threshold=threshold,
+    )
+    tag = _get_tag(hash_names, params, kwargs)
+    out1file = _get_outputfile(datafile, 1, wav, tag)
+    await async_run_bsmem_using_model(
+        datafile,
+        out1file,
+        dim,
+        modeltype,
+        modelwidth,
+        pixelsize=pixelsize,
+        wav=wav,
+        uvmax=uvmax1,
+        **kwargs,
+    )
+    imagehdu = await _read_prior(out1file, fwhm, threshold)
+    out2file = _get_outputfile(datafile, 2, wav, tag)
+    return await async_run_bsmem_using_image(
+        datafile, out2file, dim, pixelsize, imagehdu, wav=wav, **kwargs
+    )
+
+
+async def async_reconst_grey_2step_using_image(
+    datafile: str,
+    imagefile: str,
+    wav: Optional[Tuple[float, float]] = None,
+    uvmax1: float = 1.1e8,
+    fwhm: float = 1.25,
+    threshold: float = 0.05,
+    hash_names: bool = False,
+    **kwargs,
+) -> BsmemResult:
+    """Reconstruct a grey image by running bsmem twice using a prior image.
+
+    Asynchronous counterpart of
+    oirunner.runbsmem.reconst_grey_2step_using_image().
+
+    Returns:
+       Result of bsmem run, path-like giving output FITS filename.
+
+    """
+    params = dict(
+        imagefile=imagefile, wav=wav, uvmax1=uvmax1, fwhm=fwhm, threshold=threshold
+    )
+    tag = _get_tag(hash_names, params, kwargs)
+    out1file = _get_outputfile(datafile, 1, wav, tag)
+    image1hdu = await _read_prior(imagefile)
+    dim = image1hdu.data.shape[0]
+    pixelsize = get_pixelsize(image1hdu)
+    await async_run_bsmem_using_image(
+        datafile, out1file, dim, pixelsize, image1hdu, wav=wav, uvmax=uvmax1, **kwargs
+    )
+    image2hdu = await _read_prior(out1file, fwhm, threshold)
+    out2file = _get_outputfile(datafile, 2, wav, tag)
+    return await async_run_bsmem_using_image(
+        datafile, out2file, dim, pixelsize, image2hdu, wav=wav, **kwargs
+    )
@@ -0,0 +1,452 @@
+"""Python module to run a batch of bsmem reconstructions from a manifest.
+
+A manifest lists reconstruction jobs, each a data file to reconstruct by
+running bsmem once ("basic") or twice ("2step"), from a model or (if an
+image file is given) an image prior. Each job is normalised into the bsmem
+argument vectors it would run, and jobs whose arguments and input file
+contents are identical are collapsed so that the work runs only once. The
+unique jobs are then run concurrently.
+
+Manifests may be TOML (Python 3.11 or the tomli package required), JSON
+or CSV. TOML and JSON manifests hold a list of "jobs" tables, and an
+optional "defaults" table applied to every job::
+
+  [defaults]
+  pixelsize = 0.25
+  dim = 64
+
+  [[jobs]]
+  datafile = "star.oifits"
+  method = "2step"
+  wav = [1500.0, 1700.0]
+
+  [[jobs]]
+  name = "star-prior"
+  datafile = "star.oifits"
+  imagefile = "prior.fits"
+
+CSV manifests have one row per job, with a column for each job key; cells
+are parsed as JSON values where possible (e.g. wav as "[1500, 1700]"), and
+empty cells are ignored. Relative file names are relative to the manifest.
+
+Each job has keys "datafile", "method" (default "basic"), "imagefile"
+(optional) and "name" (optional). The remaining keys are keyword
+arguments of the reconst_grey_* function in oirunner.runbsmem that runs
+the job, data selection and error scaling arguments of
+run_bsmem_using_model(), or the run_bsmem() arguments in RUN_OPTIONS.
+
+Attributes:
+  DEFAULT_WORKERS (int):   Default maximum number of concurrent jobs.
+  METHODS (List[str]):     Reconstruction methods.
+  RUN_OPTIONS (List[str]): run_bsmem() arguments that may be given in a
+                           manifest.
+
+"""
+
+from __future__ import annotations
+
+import csv
+import hashlib
+import inspect
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Union
+
+from .bsmemcache import _hash_file
+from .priorimage import get_pixelsize
+from .runbsmem import (
+    BsmemResult,
+    _SELECTION_ARGS,
+    _get_outputfile,
+    _get_tag,
+    _read_image,
+    get_image_args,
+    get_model_args,
+    reconst_grey_2step,
+    reconst_grey_2step_using_image,
+    reconst_grey_basic,
+    reconst_grey_basic_using_image,
+)
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+METHODS = ["basic", "2step"]
+RUN_OPTIONS = ["use_cache", "timeout", "isolate"]
+
+# run_bsmem() arguments that may change the result
+_KEY_OPTIONS = ["timeout"]
+
+# Job keys naming files, which are relative to the manifest
+_FILE_KEYS = ["datafile", "imagefile"]
+
+
+class BatchJob(NamedTuple):
+    """Reconstruction job read from manifest.
+
+    Attributes:
+      name:      Job name, for reporting.
+      datafile:  Input OIFITS data filename.
+      options:   Keyword arguments for reconst_grey_* function.
+      twostep:   Run bsmem twice, using the smoothed output of the first
+                 run as the prior for the second.
+      imagefile: Input initial/prior FITS image, default is to use a model.
+
+    """
+
+    name: str
+    datafile: str
+    options: Dict[str, Any]
+    twostep: bool = False
+    imagefile: Optional[str] = None
+
+
+class BatchResult(NamedTuple):
+    """Outcome of one job in a batch.
+
+    Attributes:
+      job:        Job run.
+      key:        Hash identifying the job's work, or None if the job
+                  could not be normalised.
+      duplicate:  Job collapsed onto an earlier identical job, whose
+                  outcome it shares.
+      outputfile: Output FITS filename, or None if job failed.
+      seconds:    Wall-clock time for the job, zero for duplicates.
+      reused:     bsmem output reused from the cache or a checkpoint.
+      error:      Exception raised by failed job, else None.
+
+    """
+
+    job: BatchJob
+    key: Optional[str]
+    duplicate: bool
+    outputfile: Optional[str]
+    seconds: float
+    reused: bool
+    error: Optional[BaseException]
+
+
+def _load_toml(filename: str) -> Any:
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ValueError(
+                "Reading TOML manifest '%s' requires Python 3.11 or tomli" % filename
+            ) from None
+    with open(filename, "rb") as f:
+        return tomllib.load(f)
+
+
+def _parse_cell(value: str) -> Any:
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _load_csv(filename: str) -> Dict[str, Any]:
+    with open(filename, newline="") as f:
+        rows = list(csv.DictReader(f))
+    jobs = [
+        {key: _parse_cell(value) for key, value in row.items() if value} for row in rows
+    ]
+    return {"jobs": jobs}
+
+
+def _make_job(entry: Dict[str, Any], dirname: str, index: int) -> BatchJob:
+    options = dict(entry)
+    for key in _FILE_KEYS:
+        if key in options:
+            options[key] = os.path.join(dirname, options[key])
+    try:
+        datafile = options.pop("datafile")
+    except KeyError:
+        raise ValueError("Job %d has no datafile" % index) from None
+    name = str(options.pop("name", "job%d" % index))
+    method = options.pop("method", METHODS[0])
+    if method not in METHODS:
+        raise ValueError(
+            "Job '%s' has unknown method '%s' (expected one of %s)"
+            % (name, method, ", ".join(METHODS))
+        )
+    if options.get("wav") is not None:
+        options["wav"] = tuple(options["wav"])
+    imagefile = options.pop("imagefile", None)
+    return BatchJob(name, datafile, options, method == "2step", imagefile)
+
+
+def read_manifest(filename: str) -> List[BatchJob]:
+    """Return jobs listed in TOML, JSON or CSV manifest file.
+
+    The format is chosen by file extension.
+
+    Raises:
+      OSError, ValueError
+
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".toml":
+        manifest = _load_toml(filename)
+    elif extension == ".json":
+        with open(filename) as f:
+            manifest = json.load(f)
+    elif extension == ".csv":
+        manifest = _load_csv(filename)
+    else:
+        raise ValueError(
+            "Unknown manifest format '%s' (expected .toml, .json or .csv)" % extension
+        )
+    if isinstance(manifest, list):
+        manifest = {"jobs": manifest}
+    defaults = manifest.get("defaults", {})
+    dirname = os.path.dirname(filename)
+    return [
+        _make_job({**defaults, **entry}, dirname, i)
+        for i, entry in enumerate(manifest.get("jobs", []))
+    ]
+
+
+def get_reconst(job: BatchJob) -> Callable[..., BsmemResult]:
+    """Return reconst_grey_* function that runs job."""
+    if job.imagefile is None:
+        return reconst_grey_2step if job.twostep else reconst_grey_basic
+    return (
+        reconst_grey_2step_using_image
+        if job.twostep
+        else reconst_grey_basic_using_image
+    )
+
+
+def _get_positional(job: BatchJob) -> List[str]:
+    if job.imagefile is None:
+        return [job.datafile]
+    return [job.datafile, job.imagefile]
+
+
+def get_job_args(job: BatchJob) -> List[List[str]]:
+    """Return bsmem argument vectors of each run in job.
+
+    The prior image for the second run of a 2-step job is derived from
+    the output of the first, so the --sf argument of that run describes
+    the derivation rather than naming a file.
+
+    Raises:
+      OSError, ValueError
+
+    """
+    reconst = get_reconst(job)
+    try:
+        bound = inspect.signature(reconst).bind(*_get_positional(job), **job.options)
+    except TypeError as e:
+        raise ValueError(f"Job '{job.name}': {e}") from None
+    bound.apply_defaults()
+    params = dict(bound.arguments)
+    extra = params.pop("kwargs", {})
+    unknown = [
+        key for key in extra if key not in _SELECTION_ARGS and key not in RUN_OPTIONS
+    ]
+    if job.twostep and "uvmax" in extra:
+        unknown.append("uvmax (use uvmax1 for first run)")
+    if unknown:
+        raise ValueError(
+            "Job '%s' has unknown options: %s" % (job.name, ", ".join(unknown))
+        )
+    selection = {key: extra[key] for key in extra if key in _SELECTION_ARGS}
+    wav = params["wav"]
+    if job.twostep:
+        first_selection = dict(selection, uvmax=params["uvmax1"])
+    else:
+        first_selection = selection
+    named = {k: v for k, v in params.items() if k not in ["datafile", "hash_names"]}
+    tag = _get_tag(params["hash_names"], named, extra)
+    out1file = _get_outputfile(job.datafile, 1, wav, tag)
+    if job.imagefile is None:
+        dim = params["dim"]
+        pixelsize = params["pixelsize"]
+        args1 = get_model_args(
+            job.datafile,
+            out1file,
+            dim,
+            params["modeltype"],
+            params["modelwidth"],
+            pixelsize,
+            wav=wav,
+            **first_selection,
+        )
+    else:
+        imagehdu = _read_image(job.imagefile)
+        dim = imagehdu.data.shape[0]
+        pixelsize = get_pixelsize(imagehdu)
+        args1 = get_image_args(
+            job.datafile,
+            out1file,
+            dim,
+            pixelsize,
+            job.imagefile,
+            wav=wav,
+            **first_selection,
+        )
+    if not job.twostep:
+        return [args1]
+    prior2 = "makesf(%s,fwhm=%s,threshold=%s)" % (
+        out1file,
+        params["fwhm"],
+        params["threshold"],
+    )
+    out2file = _get_outputfile(job.datafile, 2, wav, tag)
+    args2 = get_image_args(
+        job.datafile, out2file, dim, pixelsize, prior2, wav=wav, **selection
+    )
+    return [args1, args2]
+
+
+def get_job_key(
+    job: BatchJob,
+    args: Sequence[Sequence[str]],
+    hashes: Optional[Dict[str, str]] = None,
+) -> str:
+    """Return hash identifying the work done by job.
+
+    The hash covers the bsmem argument vectors of the job's runs, the
+    run_bsmem() options and the contents of the input data and prior
+    image files.
+
+    Args:
+      job:    Job to identify.
+      args:   bsmem argument vectors from get_job_args(job).
+      hashes: Cache of file content hashes by filename, updated.
+
+    Raises:
+      OSError
+
+    """
+    if hashes is None:
+        hashes = {}
+    h = hashlib.sha256()
+    for runargs in args:
+        h.update("\0".join(runargs[1:]).encode("utf-8"))
+        h.update(b"\n")
+    run_options = {key: job.options[key] for key in _KEY_OPTIONS if key in job.options}
+    h.update(repr(sorted(run_options.items())).encode("utf-8"))
+    for filename in [job.datafile, job.imagefile]:
+        if filename is None:
+            continue
+        if filename not in hashes:
+            filehash = hashlib.sha256()
+            _hash_file(filename, filehash)
+            hashes[filename] = filehash.hexdigest()
+        h.update(hashes[filename].encode("ascii"))
+    return h.hexdigest()
+
+
+def _get_outputs(args: Sequence[Sequence[str]]) -> List[str]:
+    prefix = "--output="
+    return [arg[len(prefix) :] for a in args for arg in a if arg.startswith(prefix)]
+
+
+def plan_batch(jobs: Sequence[BatchJob]) -> List[Union[str, Exception]]:
+    """Return key identifying the work of each job, or the reason it is invalid.
+
+    Jobs whose inputs are missing, whose options are not understood, or
+    which would overwrite the output of a different job are invalid.
+
+    Returns:
+      For each job, its key from get_job_key(), or the exception
+      explaining why it cannot be run.
+
+    """
+    hashes: Dict[str, str] = {}
+    owners: Dict[str, BatchJob] = {}
+    owner_keys: Dict[str, str] = {}
+    plan: List[Union[str, Exception]] = []
+    for job in jobs:
+        try:
+            args = get_job_args(job)
+            key = get_job_key(job, args, hashes)
+            outputs = _get_outputs(args)
+            for outputfile in outputs:
+                if owner_keys.get(outputfile, key) != key:
+                    raise ValueError(
+                        "Job '%s' would overwrite '%s', written by job '%s'"
+                        % (job.name, outputfile, owners[outputfile].name)
+                    )
+        except (OSError, ValueError) as e:
+            plan.append(e)
+            continue
+        for outputfile in outputs:
+            owners.setdefault(outputfile, job)
+            owner_keys.setdefault(outputfile, key)
+        plan.append(key)
+    return plan
+
+
+def _run_job(job: BatchJob, kwargs: Dict[str, Any]) -> BatchResult:
+    start = time.perf_counter()
+    try:
+        result = get_reconst(job)(*_get_positional(job), **job.options, **kwargs)
+    except Exception as e:
+        logging.error(f"Batch job '{job.name}' failed: {e}")
+        return BatchResult(
+            job, None, False, None, time.perf_counter() - start, False, e
+        )
+    return BatchResult(
+        job,
+        None,
+        False,
+        os.fspath(result),
+        time.perf_counter() - start,
+        result.reused,
+        None,
+    )
+
+
+def run_batch(
+    jobs: Sequence[BatchJob], workers: int = DEFAULT_WORKERS, **kwargs
+) -> List[BatchResult]:
+    """Run jobs concurrently, running identical jobs only once.
+
+    Args:
+      jobs:    Jobs to run, e.g. from read_manifest().
+      workers: Maximum number of concurrent jobs.
+
+    Keyword arguments accepted by run_bsmem() that are not given in the
+    manifest (e.g. cpu_slots) may also be used, and apply to every job.
+
+    Returns:
+      Result for each job, in the same order as jobs.
+
+    """
+    plan = plan_batch(jobs)
+    first: Dict[str, int] = {}
+    for i, key in enumerate(plan):
+        if isinstance(key, str):
+            first.setdefault(key, i)
+    logging.info(
+        "Batch: running %d unique jobs of %d (%d invalid)"
+        % (len(first), len(jobs), sum(not isinstance(k, str) for k in plan))
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            key: executor.submit(_run_job, jobs[i], kwargs) for key, i in first.items()
+        }
+        outcomes = {key: future.result() for key, future in futures.items()}
+    results = []
+    for i, (job, key) in enumerate(zip(jobs, plan)):
+        if not isinstance(key, str):
+            results.append(BatchResult(job, None, False, None, 0.0, False, key))
+            continue
+        outcome = outcomes[key]
+        duplicate = first[key] != i
+        results.append(
+            outcome._replace(
+                job=job,
+                key=key,
+                duplicate=duplicate,
+                seconds=0.0 if duplicate else outcome.seconds,
+            )
+        )
+    return results
@@ -0,0 +1,285 @@
+"""Python module to estimate image uncertainties by bootstrap resampling.
+
+Each bootstrap sample is a copy of the OIFITS data in which the rows of
+every OI_VIS2, OI_T3 and OI_VIS table (i.e. the baseline and triangle
+measurements) are drawn with replacement. An image is reconstructed from
+each sample, and the images are accumulated into running per-pixel mean
+and variance as they complete, so that only one image need be held in
+memory at a time.
+
+Attributes:
+  DEFAULT_WORKERS (int): Default maximum number of concurrent bsmem runs.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, NamedTuple, Optional, TYPE_CHECKING, Union
+
+from .lazy import lazy_import
+from .runbsmem import _read_image, reconst_grey_basic
+
+if TYPE_CHECKING:
+    from astropy.io import fits
+    import numpy as np
+else:
+    fits = lazy_import("astropy.io.fits")
+    np = lazy_import("numpy")
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# Data tables resampled
+_DATA_TABLES = ["OI_VIS2", "OI_T3", "OI_VIS"]
+
+
+class RunningStats:
+    """Running mean and variance of equally-shaped arrays (Welford's method).
+
+    Attributes:
+      count: Number of arrays added.
+
+    """
+
+    def __init__(self) -> None:
+        """Create empty accumulator."""
+        self.count = 0
+        self._mean: Optional[np.ndarray] = None
+        self._m2: Optional[np.ndarray] = None
+
+    def add(self, data: np.ndarray) -> None:
+        """Add array to accumulator.
+
+        Raises:
+          ValueError
+
+        """
+        data = np.asarray(data, dtype=float)
+        if self._mean is None or self._m2 is None:
+            self._mean = np.zeros_like(data)
+            self._m2 = np.zeros_like(data)
+        elif data.shape != self._mean.shape:
+            raise ValueError(
+                "Cannot add array of shape %s to statistics of shape %s"
+                % (data.shape, self._mean.shape)
+            )
+        self.count += 1
+        delta = data - self._mean
+        self._mean += delta / self.count
+        delta *= data - self._mean
+        self._m2 += delta
+
+    @property
+    def mean(self) -> np.ndarray:
+        """Mean of arrays added.
+
+        Raises:
+          ValueError
+
+        """
+        if self._mean is None:
+            raise ValueError("No arrays added")
+        return self._mean.copy()
+
+    def variance(self, ddof: int = 1) -> np.ndarray:
+        """Return variance of arrays added.
+
+        Raises:
+          ValueError
+
+        """
+        if self._m2 is None or self.count <= ddof:
+            raise ValueError(
+                "Variance with ddof=%d needs more than %d arrays" % (ddof, ddof)
+            )
+        return self._m2 / (self.count - ddof)
+
+    def std(self, ddof: int = 1) -> np.ndarray:
+        """Return standard deviation of arrays added.
+
+        Raises:
+          ValueError
+
+        """
+        return np.sqrt(self.variance(ddof))
+
+
+class BootstrapResult(NamedTuple):
+    """Outcome of bootstrap reconstruction.
+
+    Attributes:
+      mean:         Per-pixel mean of bootstrap images.
+      std:          Per-pixel standard deviation of bootstrap images.
+      significance: mean / std, zero where std is zero.
+      nsamples:     Number of images accumulated.
+      failed:       Number of samples whose reconstruction failed.
+      header:       FITS header of first image, giving WCS.
+
+    """
+
+    mean: np.ndarray
+    std: np.ndarray
+    significance: np.ndarray
+    nsamples: int
+    failed: int
+    header: fits.Header
+
+
+def resample(hdulist: fits.HDUList, rng: np.random.Generator) -> fits.HDUList:
+    """Return copy of OIFITS data with data table rows drawn with replacement.
+
+    Each OI_VIS2, OI_T3 and OI_VIS table is resampled independently; other
+    HDUs are copied unchanged.
+
+    """
+    result = fits.HDUList()
+    for hdu in hdulist:
+        if hdu.name in _DATA_TABLES and hdu.data is not None and len(hdu.data) > 0:
+            rows = rng.integers(0, len(hdu.data), len(hdu.data))
+            result.append(fits.BinTableHDU(data=hdu.data[rows], header=hdu.header))
+        else:
+            result.append(hdu.copy())
+    return result
+
+
+def _get_bootdir(datafile: str) -> str:
+    dirname, basename = os.path.split(datafile)
+    stem, _ = os.path.splitext(basename)
+    return os.path.join(dirname, f"bsmem_boot_{stem}")
+
+
+def _run_sample(
+    hdulist: fits.HDUList,
+    samplefile: str,
+    seed: np.random.SeedSequence,
+    reconst: Callable[..., Union[str, "os.PathLike[str]"]],
+    pixelsize: float,
+    kwargs: dict,
+) -> Union[str, "os.PathLike[str]"]:
+    resample(hdulist, np.random.default_rng(seed)).writeto(samplefile, overwrite=True)
+    return reconst(samplefile, pixelsize, **kwargs)
+
+
+def _remove_sample(bootdir: str, samplefile: str) -> None:
+    """Remove resampled data and all files derived from it."""
+    samplestem = os.path.splitext(os.path.basename(samplefile))[0]
+    pattern = re.compile(r"(^|_)%s[._-]" % re.escape(samplestem))
+    for name in os.listdir(bootdir):
+        if pattern.search(name):
+            try:
+                os.remove(os.path.join(bootdir, name))
+            except FileNotFoundError:
+                pass
+
+
+def bootstrap(
+    datafile: str,
+    nsamples: int,
+    pixelsize: float,
+    workers: int = DEFAULT_WORKERS,
+    seed: Optional[int] = None,
+    bootdir: Optional[str] = None,
+    keep: bool = False,
+    reconst: Callable[..., Union[str, "os.PathLike[str]"]] = reconst_grey_basic,
+    **kwargs,
+) -> BootstrapResult:
+    """Reconstruct images from resampled data concurrently.
+
+    The pixel size is required so that all images share the same grid.
+
+    Args:
+      datafile:  Input OIFITS data filename.
+      nsamples:  Number of bootstrap samples.
+      pixelsize: Reconstructed image pixel size (mas).
+      workers:   Maximum number of concurrent bsmem runs.
+      seed:      Seed for random resampling, for reproducible samples.
+      bootdir:   Directory for resampled data and output images, default
+                 derived from datafile.
+      keep:      Keep resampled data and output images, rather than
+                 removing each once accumulated.
+      reconst:   Function to reconstruct one sample, taking data filename
+                 and pixel size and returning the output filename (or a
+                 path-like result), e.g. reconst_grey_2step.
+
+    Keyword arguments accepted by reconst may also be used.
+
+    Returns:
+      Per-pixel statistics of bootstrap images.
+
+    Raises:
+      OSError, ValueError
+
+    """
+    if bootdir is None:
+        bootdir = _get_bootdir(datafile)
+    os.makedirs(bootdir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(datafile))[0]
+    seeds = np.random.SeedSequence(seed).spawn(nsamples)
+    samplefiles = [
+        os.path.join(bootdir, f"{stem}_boot{i:04d}.oifits") for i in range(nsamples)
+    ]
+    stats = RunningStats()
+    header: Optional[fits.Header] = None
+    failed = 0
+    with fits.open(datafile, memmap=False) as hdulist:
+        hdulist.readall()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    _run_sample, hdulist, samplefile, seed, reconst, pixelsize, kwargs
+                ): samplefile
+                for samplefile, seed in zip(samplefiles, seeds)
+            }
+            for future in as_completed(futures):
+                # Drop each result once accumulated, so that only one
+                # image is held in memory at a time
+                samplefile = futures.pop(future)
+                try:
+                    # Read image without caching it on a BsmemResult
+                    imagehdu = _read_image(os.fspath(future.result()))
+                    stats.add(imagehdu.data)
+                except Exception as e:
+                    logging.error(f"Bootstrap sample '{samplefile}' failed: {e}")
+                    failed += 1
+                    continue
+                if header is None:
+                    header = imagehdu.header
+                if not keep:
+                    _remove_sample(bootdir, samplefile)
+    if not keep and not os.listdir(bootdir):
+        shutil.rmtree(bootdir)
+    if header is None or stats.count < 2:
+        raise ValueError(
+            "Only %d of %d bootstrap samples succeeded" % (stats.count, nsamples)
+        )
+    mean = stats.mean
+    std = stats.std()
+    significance = np.divide(mean, std, out=np.zeros_like(mean), where=std > 0)
+    return BootstrapResult(mean, std, significance, stats.count, failed, header)
+
+
+def write_maps(result: BootstrapResult, filename: str, overwrite: bool = True) -> None:
+    """Write mean, standard deviation and significance maps to FITS file.
+
+    The mean map is in the primary HDU, and the others in image extensions
+    named STD and SIGNIF, all with the WCS of the bootstrap images.
+
+    """
+    header = fits.Header()
+    for prefix in ["CTYPE", "CUNIT", "CRPIX", "CRVAL", "CDELT"]:
+        for key in [prefix + "1", prefix + "2"]:
+            if key in result.header:
+                header[key] = result.header[key]
+    primary = fits.PrimaryHDU(result.mean, header=header)
+    primary.header["NBOOT"] = (result.nsamples, "Number of bootstrap images")
+    primary.header["NFAILED"] = (result.failed, "Number of failed samples")
+    hdus = [
+        primary,
+        fits.ImageHDU(result.std, header=header, name="STD"),
+        fits.ImageHDU(result.significance, header=header, name="SIGNIF"),
+    ]
+    fits.HDUList(hdus).writeto(filename, overwrite=overwrite)
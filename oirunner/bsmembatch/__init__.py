@@ -0,0 +1 @@
+"""Command-line tool to run a manifest of BSMEM reconstructions."""
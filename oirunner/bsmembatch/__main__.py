@@ -0,0 +1,127 @@
+"""Run a batch of BSMEM reconstructions listed in a manifest.
+
+Jobs with identical bsmem arguments and input files run only once. See
+oirunner.batch for the manifest formats.
+
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+from oirunner import __version__
+from oirunner.batch import (
+    DEFAULT_WORKERS,
+    get_job_args,
+    plan_batch,
+    read_manifest,
+    run_batch,
+)
+from oirunner.cpuslots import SlotAllocator
+
+
+def show(jobs):
+    """Print bsmem arguments of each unique job, returning number invalid."""
+    seen = set()
+    invalid = 0
+    for job, key in zip(jobs, plan_batch(jobs)):
+        if not isinstance(key, str):
+            print(f"Job '{job.name}' is invalid: {key}", file=sys.stderr)
+            invalid += 1
+        elif key in seen:
+            print(f"# {job.name}: duplicate")
+        else:
+            seen.add(key)
+            print(f"# {job.name}")
+            for args in get_job_args(job):
+                print(" ".join(args))
+    return invalid
+
+
+def runbatch(args):
+    """Run jobs in manifest and print summary, returning number failed."""
+    try:
+        jobs = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Cannot read manifest: {e}")
+    if args.dry_run:
+        return show(jobs)
+    kwargs = {}
+    if args.cpus_per_job is not None:
+        try:
+            kwargs["cpu_slots"] = SlotAllocator(
+                cpus_per_slot=args.cpus_per_job, nice=args.nice
+            )
+        except ValueError as e:
+            sys.exit(f"Cannot allocate CPUs: {e}")
+    start = time.perf_counter()
+    results = run_batch(jobs, workers=args.workers, **kwargs)
+    elapsed = time.perf_counter() - start
+    failed = [r for r in results if r.error is not None]
+    for r in failed:
+        print(f"Job '{r.job.name}' failed: {r.error}", file=sys.stderr)
+    runs = [r for r in results if r.key is not None and not r.duplicate]
+    print(
+        "Ran %d unique jobs of %d (%d duplicate, %d reused) in %.1f s, %.2f jobs/min"
+        % (
+            len(runs),
+            len(results),
+            sum(r.duplicate for r in results),
+            sum(r.reused for r in runs),
+            elapsed,
+            60.0 * len(runs) / elapsed if elapsed > 0 else 0.0,
+        )
+    )
+    print("%d succeeded, %d failed" % (len(results) - len(failed), len(failed)))
+    return len(failed)
+
+
+def create_parser():
+    """Return new ArgumentParser instance for this script."""
+    parser = argparse.ArgumentParser(
+        description="Run BSMEM reconstructions listed in a manifest"
+    )
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Maximum number of concurrent jobs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-c",
+        "--cpus-per-job",
+        type=int,
+        help="Pin each bsmem process to this many CPUs of its own, and set "
+        "OMP_NUM_THREADS etc. to match (default: no pinning)",
+    )
+    parser.add_argument(
+        "--nice",
+        type=int,
+        help="Niceness increment for bsmem processes (requires --cpus-per-job)",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Print bsmem arguments of each unique job without running them",
+    )
+    parser.add_argument("manifest", help="Job manifest (.toml, .json or .csv)")
+    return parser
+
+
+def main():
+    """Run application."""
+    parser = create_parser()
+    args = parser.parse_args()
+    if args.nice is not None and args.cpus_per_job is None:
+        parser.error("--nice requires --cpus-per-job")
+    logging.basicConfig(level=logging.INFO)
+    if runbatch(args) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
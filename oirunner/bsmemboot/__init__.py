@@ -0,0 +1 @@
+"""Command-line tool to make BSMEM image uncertainty maps by bootstrapping."""
@@ -0,0 +1,102 @@
+"""Make image mean, uncertainty and significance maps by bootstrapping."""
+
+import argparse
+import logging
+import os.path
+import sys
+
+from oirunner import __version__
+from oirunner.bootstrap import DEFAULT_WORKERS, bootstrap, write_maps
+from oirunner.runbsmem import reconst_grey_2step, reconst_grey_basic
+
+
+def makemaps(args):
+    """Reconstruct images from resampled data and write maps."""
+    if not args.overwrite and os.path.exists(args.outputfile):
+        sys.exit("Not creating '%s' as it already exists." % args.outputfile)
+    kwargs = {}
+    if args.dim is not None:
+        kwargs["dim"] = args.dim
+    if args.alpha is not None:
+        kwargs["alpha"] = args.alpha
+    if args.wav is not None:
+        kwargs["wav"] = tuple(args.wav)
+    result = bootstrap(
+        args.datafile,
+        args.samples,
+        args.pixelsize,
+        workers=args.workers,
+        seed=args.seed,
+        keep=args.keep,
+        reconst=reconst_grey_2step if args.twostep else reconst_grey_basic,
+        **kwargs,
+    )
+    write_maps(result, args.outputfile)
+    print(
+        "Wrote '%s' (%d/%d samples)"
+        % (args.outputfile, result.nsamples, result.nsamples + result.failed)
+    )
+
+
+def create_parser():
+    """Return new ArgumentParser instance for this script."""
+    parser = argparse.ArgumentParser(
+        description="Make image uncertainty maps using BSMEM on resampled data"
+    )
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+    parser.add_argument(
+        "-o", "--overwrite", action="store_true", help="Overwrite existing file"
+    )
+    parser.add_argument(
+        "-n",
+        "--samples",
+        type=int,
+        default=50,
+        help="Number of bootstrap samples (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Maximum number of concurrent bsmem runs",
+    )
+    parser.add_argument("--seed", type=int, help="Seed for random resampling")
+    parser.add_argument(
+        "-w",
+        "--wav",
+        type=float,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        help="Wavelength range to select in nm",
+    )
+    parser.add_argument(
+        "-2", "--twostep", action="store_true", help="Run bsmem twice per sample"
+    )
+    parser.add_argument("--dim", type=int, help="Image width in pixels")
+    parser.add_argument("--alpha", type=float, help="Regularization hyperparameter")
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep resampled data and images for each sample",
+    )
+    parser.add_argument(
+        "--pixelsize", type=float, required=True, help="Image pixel size in mas"
+    )
+    parser.add_argument("datafile", help="Input OIFITS data file")
+    parser.add_argument(
+        "outputfile", help="Output FITS file of mean, STD and SIGNIF maps"
+    )
+    return parser
+
+
+def main():
+    """Run application."""
+    parser = create_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    makemaps(args)
+
+
+if __name__ == "__main__":
+    main()
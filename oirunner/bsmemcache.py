@@ -0,0 +1,231 @@
+"""Python module to cache bsmem results on disk.
+
+Results are keyed by a hash of the bsmem version, the full argument vector
+and the contents of the input data and prior image files, so that
+identical runs need not be repeated.
+
+Attributes:
+  CACHE_DIR (str):     Default cache directory, from $OIRUNNER_CACHE_DIR if set.
+  CACHE_MAXSIZE (int): Default maximum total size of cached files (bytes).
+  NO_CACHE (bool):     Default cache disabled, by setting $OIRUNNER_NO_CACHE.
+
+"""
+
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from subprocess import PIPE, STDOUT, run
+from typing import List, NamedTuple, Optional, Sequence
+
+CACHE_DIR = os.environ.get(
+    "OIRUNNER_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "oirunner", "bsmem"),
+)
+CACHE_MAXSIZE = 1024**3
+NO_CACHE = bool(os.environ.get("OIRUNNER_NO_CACHE"))
+
+_IMAGE = "image.fits"
+_STDOUT = "out.txt"
+
+# Arguments whose values are filenames, hashed by content
+_CONTENT_ARGS = ["--data=", "--sf="]
+# Arguments that do not affect the result
+_IGNORE_ARGS = ["--output="]
+
+
+class CacheStats(NamedTuple):
+    """Cache statistics.
+
+    Attributes:
+      hits:    Number of lookups satisfied from the cache.
+      misses:  Number of lookups not satisfied from the cache.
+      entries: Number of cached results.
+      size:    Total size of cached files (bytes).
+
+    """
+
+    hits: int
+    misses: int
+    entries: int
+    size: int
+
+
+@functools.lru_cache(maxsize=None)
+def get_bsmem_version(executable: str) -> str:
+    """Return version string reported by 'bsmem -V'."""
+    process = run([executable, "-V"], stdout=PIPE, stderr=STDOUT)
+    return process.stdout.decode("utf-8").strip()
+
+
+def _hash_file(filename: str, h) -> None:
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+
+def get_run_key(args: Sequence[str]) -> str:
+    """Return hash identifying result of bsmem argument vector.
+
+    The hash covers the bsmem version, the arguments other than the output
+    filename and the contents of the input data and prior image files.
+
+    Raises:
+      OSError
+
+    """
+    h = hashlib.sha256()
+    h.update(get_bsmem_version(args[0]).encode("utf-8"))
+    for arg in args[1:]:
+        if any(arg.startswith(prefix) for prefix in _IGNORE_ARGS):
+            continue
+        h.update(b"\0")
+        for prefix in _CONTENT_ARGS:
+            if arg.startswith(prefix):
+                h.update(prefix.encode("utf-8"))
+                _hash_file(arg[len(prefix) :], h)
+                break
+        else:
+            h.update(arg.encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Size-bounded on-disk cache of bsmem output files.
+
+    Each entry holds the output FITS image and (if captured) the full
+    stdout of a bsmem run. The least recently used entries are evicted
+    when the total size exceeds maxsize.
+
+    Attributes:
+      cachedir: Cache directory.
+      maxsize:  Maximum total size of cached files (bytes).
+      hits:     Number of lookups satisfied from the cache.
+      misses:   Number of lookups not satisfied from the cache.
+
+    """
+
+    def __init__(self, cachedir: str = CACHE_DIR, maxsize: int = CACHE_MAXSIZE):
+        """Create cache, making cache directory if necessary."""
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cachedir, exist_ok=True)
+
+    def get_key(self, args: Sequence[str]) -> str:
+        """Return cache key for bsmem argument vector.
+
+        Raises:
+          OSError
+
+        """
+        return get_run_key(args)
+
+    def _entrydir(self, key: str) -> str:
+        return os.path.join(self.cachedir, key[:2], key)
+
+    def fetch(self, key: str, outputfile: str, fullstdout: Optional[str]) -> bool:
+        """Copy cached result to outputfile and fullstdout if present.
+
+        Returns:
+          True if result was found in the cache.
+
+        """
+        entrydir = self._entrydir(key)
+        image = os.path.join(entrydir, _IMAGE)
+        out = os.path.join(entrydir, _STDOUT)
+        try:
+            shutil.copyfile(image, outputfile)
+            if fullstdout is not None:
+                shutil.copyfile(out, fullstdout)
+            os.utime(entrydir)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key: str, outputfile: str, fullstdout: Optional[str]) -> None:
+        """Add result files to the cache, then evict old entries if necessary."""
+        parent = os.path.dirname(self._entrydir(key))
+        os.makedirs(parent, exist_ok=True)
+        tempdir = tempfile.mkdtemp(dir=parent)
+        try:
+            shutil.copyfile(outputfile, os.path.join(tempdir, _IMAGE))
+            if fullstdout is not None:
+                shutil.copyfile(fullstdout, os.path.join(tempdir, _STDOUT))
+            os.rename(tempdir, self._entrydir(key))
+        except OSError:
+            # Entry already exists (e.g. stored by another process)
+            shutil.rmtree(tempdir, ignore_errors=True)
+        else:
+            self.evict()
+
+    def _entries(self) -> List[os.DirEntry]:
+        entries = []
+        for prefix in os.scandir(self.cachedir):
+            if prefix.is_dir():
+                entries += [e for e in os.scandir(prefix.path) if e.is_dir()]
+        return entries
+
+    @staticmethod
+    def _size(entrydir: str) -> int:
+        return sum(e.stat().st_size for e in os.scandir(entrydir))
+
+    def evict(self) -> None:
+        """Remove least recently used entries until within maxsize."""
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime)
+        sizes = [self._size(e.path) for e in entries]
+        total = sum(sizes)
+        for entry, size in zip(entries, sizes):
+            if total <= self.maxsize:
+                break
+            logging.info(f"Evicting cached bsmem result {entry.name}")
+            shutil.rmtree(entry.path, ignore_errors=True)
+            total -= size
+
+    def clear(self) -> None:
+        """Remove all entries and reset statistics."""
+        for entry in self._entries():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> CacheStats:
+        """Return cache statistics."""
+        entries = self._entries()
+        return CacheStats(
+            self.hits,
+            self.misses,
+            len(entries),
+            sum(self._size(e.path) for e in entries),
+        )
+
+
+_default_cache: Optional[ResultCache] = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache() -> Optional[ResultCache]:
+    """Return cache used by run_bsmem(), or None if caching is disabled."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None and not NO_CACHE:
+            _default_cache = ResultCache()
+        return _default_cache
+
+
+def set_default_cache(cache: Optional[ResultCache]) -> None:
+    """Set cache used by run_bsmem(), or disable caching if None."""
+    global _default_cache, NO_CACHE
+    with _default_lock:
+        _default_cache = cache
+        NO_CACHE = cache is None
@@ -0,0 +1 @@
+"""Command-line tool to reconstruct a FITS image cube using BSMEM."""
@@ -0,0 +1,201 @@
+"""Reconstruct an image cube from spectrally dispersed data using BSMEM."""
+
+import argparse
+import contextlib
+import logging
+import os.path
+import sys
+
+from oirunner import __version__, timing
+from oirunner.checkpoint import JobManifest
+from oirunner.oiselect import get_default_selector
+from oirunner.runbsmem import reconst_grey_2step, reconst_grey_basic
+from oirunner.spectral import (
+    DEFAULT_WORKERS,
+    _get_cubefile,
+    chain_savings,
+    reconst_chained_cube,
+    reconst_grey_cube,
+)
+
+
+def makechained(args, kwargs):
+    """Reconstruct chained channels, returning cube filename and results."""
+    if args.twostep or args.processes:
+        sys.exit("--chain cannot be combined with --twostep or --processes")
+    cubefile, results = reconst_chained_cube(
+        args.datafile,
+        wavs=args.wav,
+        cubefile=args.output,
+        fwhm=args.chain_fwhm,
+        nchains=args.chain,
+        workers=args.workers,
+        **kwargs,
+    )
+    try:
+        savings = chain_savings(results)
+    except ValueError:
+        pass
+    else:
+        print(
+            "Warm starts took %.1f iterations per channel (cold %.1f), "
+            "saving an estimated %.0f iterations and %.1f s"
+            % (
+                savings.warm_iterations,
+                savings.cold_iterations,
+                savings.iterations_saved,
+                savings.seconds_saved,
+            )
+        )
+    return cubefile, results
+
+
+def makecube(args):
+    """Reconstruct image cube, returning number of failed channels."""
+    cubefile = args.output
+    if cubefile is None:
+        cubefile = _get_cubefile(args.datafile)
+    if not args.overwrite and os.path.exists(cubefile):
+        sys.exit("Not creating '%s' as it already exists." % cubefile)
+    kwargs = {}
+    if args.pixelsize is not None:
+        kwargs["pixelsize"] = args.pixelsize
+    if args.dim is not None:
+        kwargs["dim"] = args.dim
+    if args.alpha is not None:
+        kwargs["alpha"] = args.alpha
+    if args.checkpoint is not None:
+        kwargs["checkpoint"] = JobManifest(args.checkpoint)
+    if args.preselect:
+        kwargs["selector"] = get_default_selector()
+    if args.chain is not None:
+        cubefile, results = makechained(args, kwargs)
+    elif args.twostep:
+        if args.pixelsize is None:
+            sys.exit("--pixelsize is required for two-step reconstruction")
+        cubefile, results = reconst_grey_cube(
+            args.datafile,
+            wavs=args.wav,
+            cubefile=args.output,
+            reconst=reconst_grey_2step,
+            workers=args.workers,
+            processes=args.processes,
+            **kwargs,
+        )
+    else:
+        cubefile, results = reconst_grey_cube(
+            args.datafile,
+            wavs=args.wav,
+            cubefile=args.output,
+            reconst=reconst_grey_basic,
+            workers=args.workers,
+            processes=args.processes,
+            **kwargs,
+        )
+    failed = [r for r in results if r.error is not None]
+    for r in failed:
+        print(
+            "Channel %.1f-%.1f nm failed: %s" % (r.wav[0], r.wav[1], r.error),
+            file=sys.stderr,
+        )
+    print(
+        "Wrote '%s' (%d/%d channels)"
+        % (cubefile, len(results) - len(failed), len(results))
+    )
+    return len(failed)
+
+
+def create_parser():
+    """Return new ArgumentParser instance for this script."""
+    parser = argparse.ArgumentParser(
+        description="Reconstruct image cube using BSMEM, one channel per run"
+    )
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+    parser.add_argument(
+        "-o", "--overwrite", action="store_true", help="Overwrite existing file"
+    )
+    parser.add_argument("--output", help="Output FITS cube")
+    parser.add_argument(
+        "-w",
+        "--wav",
+        type=float,
+        nargs=2,
+        action="append",
+        metavar=("MIN", "MAX"),
+        help="Wavelength channel limits in nm (repeat for each channel, "
+        "default is one channel per OI_WAVELENGTH entry)",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Maximum number of concurrent bsmem runs",
+    )
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="Use worker processes rather than threads",
+    )
+    parser.add_argument(
+        "-2", "--twostep", action="store_true", help="Run bsmem twice per channel"
+    )
+    parser.add_argument(
+        "--chain",
+        type=int,
+        nargs="?",
+        const=1,
+        metavar="NCHAINS",
+        help="Start each channel from the image for its neighbour, using "
+        "NCHAINS (default 1) chains from evenly spaced anchor channels",
+    )
+    parser.add_argument(
+        "--chain-fwhm",
+        type=float,
+        metavar="FWHM",
+        help="Blur neighbouring images used as priors by Gaussian of this "
+        "FWHM in mas",
+    )
+    parser.add_argument("--pixelsize", type=float, help="Image pixel size in mas")
+    parser.add_argument("--dim", type=int, help="Image width in pixels")
+    parser.add_argument("--alpha", type=float, help="Regularization hyperparameter")
+    parser.add_argument(
+        "--checkpoint",
+        metavar="MANIFEST",
+        help="Record completed runs in job manifest, skipping those already "
+        "complete",
+    )
+    parser.add_argument(
+        "--preselect",
+        action="store_true",
+        help="Pass bsmem a pre-selected subset of the data for each channel",
+    )
+    parser.add_argument(
+        "--timings", metavar="FILE", help="Append timing spans to JSON lines file"
+    )
+    parser.add_argument(
+        "--profile", metavar="FILE", help="Write Python profile in pstats format"
+    )
+    parser.add_argument("datafile", help="Input OIFITS data file")
+    return parser
+
+
+def main():
+    """Run application."""
+    parser = create_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with contextlib.ExitStack() as stack:
+        if args.timings is not None:
+            stack.enter_context(
+                timing.using_hook(timing.JsonLinesExporter(args.timings))
+            )
+        if args.profile is not None:
+            stack.enter_context(timing.profile(args.profile))
+        failed = makecube(args)
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
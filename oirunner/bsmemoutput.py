@@ -0,0 +1,129 @@
+"""Python module to parse bsmem iteration output.
+
+Attributes:
+  ALIASES (Dict[str, List[str]]): Normalised metric names recognised as
+                                  chi2, entropy, alpha and flux.
+
+"""
+
+import re
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+ALIASES = {
+    "chi2": ["chi2", "chisq", "chi_2", "chi_squared"],
+    "entropy": ["entropy", "entropy_s", "s"],
+    "alpha": ["alpha"],
+    "flux": ["flux", "total_flux"],
+}
+
+_ITERATION_RE = re.compile(r"^\s*Iteration\s+(\d+)\s*:?")
+_METRIC_RE = re.compile(
+    r"(?P<key>[A-Za-z][\w ^/]*?)\s*(?:=+|:)\s*"
+    r"(?P<value>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eEdD][-+]?\d+)?)"
+)
+_NONWORD_RE = re.compile(r"\W+")
+
+
+def _normalise(key: str) -> str:
+    return _NONWORD_RE.sub("_", key.strip().lower()).strip("_")
+
+
+class IterationRecord(NamedTuple):
+    """Metrics reported by bsmem for a single iteration.
+
+    Attributes:
+      iteration: Iteration number.
+      chi2:      Chi-squared, if reported.
+      entropy:   Entropy, if reported.
+      alpha:     Regularization hyperparameter, if reported.
+      flux:      Total flux, if reported.
+      metrics:   All "name = value" and "name: value" pairs found in the
+                 iteration block, keyed by lower-case name.
+      text:      Text of the iteration block.
+
+    """
+
+    iteration: int
+    chi2: Optional[float]
+    entropy: Optional[float]
+    alpha: Optional[float]
+    flux: Optional[float]
+    metrics: Dict[str, float]
+    text: str
+
+
+def parse_block(iteration: int, lines: List[str]) -> IterationRecord:
+    """Return record parsed from text of a single iteration block."""
+    metrics: Dict[str, float] = {}
+    for i, line in enumerate(lines):
+        if i == 0:
+            line = _ITERATION_RE.sub("", line)
+        for match in _METRIC_RE.finditer(line):
+            value = match.group("value").replace("d", "e").replace("D", "e")
+            metrics.setdefault(_normalise(match.group("key")), float(value))
+    named = {}
+    for name, aliases in ALIASES.items():
+        # Prefer exact match, then e.g. "current_alpha" for "alpha"
+        keys = [k for a in aliases for k in metrics if k == a]
+        keys += [k for a in aliases for k in metrics if k.endswith("_" + a)]
+        named[name] = metrics[keys[0]] if keys else None
+    return IterationRecord(
+        iteration,
+        named["chi2"],
+        named["entropy"],
+        named["alpha"],
+        named["flux"],
+        metrics,
+        "".join(lines),
+    )
+
+
+class IterationParser:
+    """Incremental parser for bsmem output.
+
+    Feed lines of output one at a time. Each iteration block begins with a
+    line starting "Iteration N" and is complete when the next one starts,
+    or on finish().
+
+    Attributes:
+      last: Most recent complete iteration record, or None.
+
+    """
+
+    def __init__(self) -> None:
+        """Create parser."""
+        self.last: Optional[IterationRecord] = None
+        self._iteration: Optional[int] = None
+        self._lines: List[str] = []
+
+    def feed(self, line: str) -> Optional[IterationRecord]:
+        """Parse line of output, returning record if it completes a block."""
+        match = _ITERATION_RE.match(line)
+        record = None
+        if match:
+            record = self.finish()
+            self._iteration = int(match.group(1))
+        if self._iteration is not None:
+            self._lines.append(line)
+        return record
+
+    def finish(self) -> Optional[IterationRecord]:
+        """Return record for incomplete final block, if any."""
+        if self._iteration is None:
+            return None
+        self.last = parse_block(self._iteration, self._lines)
+        self._iteration = None
+        self._lines = []
+        return self.last
+
+
+def parse_iterations(lines: Iterable[str]) -> Iterator[IterationRecord]:
+    """Yield iteration records parsed from lines of bsmem output."""
+    parser = IterationParser()
+    for line in lines:
+        record = parser.feed(line)
+        if record is not None:
+            yield record
+    record = parser.finish()
+    if record is not None:
+        yield record
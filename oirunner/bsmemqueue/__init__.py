@@ -0,0 +1 @@
+"""Command-line tool to queue BSMEM reconstructions and run them on many nodes."""
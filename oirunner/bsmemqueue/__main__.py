@@ -0,0 +1,164 @@
+"""Queue BSMEM reconstructions and run them with workers on many nodes.
+
+'submit' adds one job per wavelength channel of a data file to a queue
+database, 'work' runs a worker that claims and runs jobs from the queue,
+and 'status' summarises the queue. Any number of workers, on any nodes
+that share the database and data files, may run at once.
+
+"""
+
+import argparse
+import logging
+import signal
+import sys
+
+from oirunner import __version__
+from oirunner.jobqueue import (
+    FAILED,
+    JobQueue,
+    LEASE_SECONDS,
+    MAX_ATTEMPTS,
+    POLL_SECONDS,
+    Worker,
+)
+from oirunner.runbsmem import reconst_grey_2step, reconst_grey_basic
+from oirunner.spectral import get_wavelength_bins
+
+
+def submit(args):
+    """Add a job for each wavelength channel to queue."""
+    queue = JobQueue(args.database)
+    kwargs = {}
+    if args.pixelsize is not None:
+        kwargs["pixelsize"] = args.pixelsize
+    if args.dim is not None:
+        kwargs["dim"] = args.dim
+    if args.alpha is not None:
+        kwargs["alpha"] = args.alpha
+    if args.twostep:
+        if args.pixelsize is None:
+            sys.exit("--pixelsize is required for two-step reconstruction")
+        reconst = reconst_grey_2step
+    else:
+        reconst = reconst_grey_basic
+    wavs = args.wav if args.wav is not None else get_wavelength_bins(args.datafile)
+    for wav in wavs:
+        job_id = queue.submit(
+            reconst,
+            args.datafile,
+            wav=list(wav),
+            priority=args.priority,
+            max_attempts=args.max_attempts,
+            name="%s %.1f-%.1f nm" % (args.datafile, wav[0], wav[1]),
+            **kwargs,
+        )
+        print(f"Submitted job {job_id}")
+
+
+def work(args):
+    """Run jobs from queue until none remain, or until interrupted."""
+    worker = Worker(JobQueue(args.database, lease=args.lease), poll=args.poll)
+    handler = signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    try:
+        count = worker.run(max_jobs=args.max_jobs, wait=args.wait)
+    finally:
+        signal.signal(signal.SIGTERM, handler)
+    print(f"Ran {count} jobs")
+
+
+def status(args):
+    """Print number of jobs with each status, and any failures."""
+    queue = JobQueue(args.database)
+    for name, count in queue.counts().items():
+        print(f"{name:>10} {count}")
+    for job in queue.jobs(FAILED):
+        print(f"Job {job.job_id} ({job.name}) failed: {job.error}", file=sys.stderr)
+
+
+def create_parser():
+    """Return new ArgumentParser instance for this script."""
+    parser = argparse.ArgumentParser(
+        description="Queue BSMEM reconstructions and run them on many nodes"
+    )
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser(
+        "submit", help="Queue reconstruction of each wavelength channel"
+    )
+    submit_parser.set_defaults(func=submit)
+    submit_parser.add_argument(
+        "-w",
+        "--wav",
+        type=float,
+        nargs=2,
+        action="append",
+        metavar=("MIN", "MAX"),
+        help="Wavelength channel limits in nm (repeat for each channel, "
+        "default is one channel per OI_WAVELENGTH entry)",
+    )
+    submit_parser.add_argument(
+        "-2", "--twostep", action="store_true", help="Run bsmem twice per channel"
+    )
+    submit_parser.add_argument(
+        "--pixelsize", type=float, help="Image pixel size in mas"
+    )
+    submit_parser.add_argument("--dim", type=int, help="Image width in pixels")
+    submit_parser.add_argument(
+        "--alpha", type=float, help="Regularization hyperparameter"
+    )
+    submit_parser.add_argument(
+        "--priority",
+        type=int,
+        default=0,
+        help="Jobs of higher priority run first (default: %(default)s)",
+    )
+    submit_parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=MAX_ATTEMPTS,
+        help="Maximum number of times to run each job (default: %(default)s)",
+    )
+    submit_parser.add_argument("database", help="Queue database file")
+    submit_parser.add_argument("datafile", help="Input OIFITS data file")
+
+    work_parser = subparsers.add_parser("work", help="Run jobs from queue")
+    work_parser.set_defaults(func=work)
+    work_parser.add_argument(
+        "-n", "--max-jobs", type=int, help="Maximum number of jobs to run"
+    )
+    work_parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Wait for more jobs rather than exiting when queue is empty",
+    )
+    work_parser.add_argument(
+        "--poll",
+        type=float,
+        default=POLL_SECONDS,
+        help="Interval between checks for new jobs in seconds (default: %(default)s)",
+    )
+    work_parser.add_argument(
+        "--lease",
+        type=float,
+        default=LEASE_SECONDS,
+        help="Lease duration in seconds (default: %(default)s)",
+    )
+    work_parser.add_argument("database", help="Queue database file")
+
+    status_parser = subparsers.add_parser("status", help="Summarise queue")
+    status_parser.set_defaults(func=status)
+    status_parser.add_argument("database", help="Queue database file")
+    return parser
+
+
+def main():
+    """Run application."""
+    parser = create_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
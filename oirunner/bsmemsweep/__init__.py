@@ -0,0 +1 @@
+"""Command-line tool to sweep BSMEM hyperparameters."""
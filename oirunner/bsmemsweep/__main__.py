@@ -0,0 +1,184 @@
+"""Sweep BSMEM hyperparameters over a grid or random sample."""
+
+import argparse
+import logging
+import os.path
+import sys
+
+from oirunner import __version__
+from oirunner.sweep import (
+    DEFAULT_WORKERS,
+    Pruning,
+    param_grid,
+    param_sample,
+    sweep,
+    write_results,
+)
+
+
+def grid_spec(spec):
+    """Return name and values from 'name=v1,v2,...' argument."""
+    name, sep, values = spec.partition("=")
+    try:
+        if not name or not sep:
+            raise ValueError
+        return name, [float(v) for v in values.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid grid '{spec}' (expected NAME=V1,V2,...)"
+        )
+
+
+def range_spec(spec):
+    """Return name, range and whether log-scaled from 'name=lo:hi[:log]'."""
+    name, sep, values = spec.partition("=")
+    fields = values.split(":")
+    try:
+        if not name or not sep or len(fields) < 2 or fields[2:] not in [[], ["log"]]:
+            raise ValueError
+        return name, (float(fields[0]), float(fields[1])), fields[2:] == ["log"]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"invalid range '{spec}' (expected NAME=LO:HI[:log])"
+        )
+
+
+def parse_grid(specs):
+    """Return grid from list of parsed grid_spec() arguments."""
+    return dict(specs)
+
+
+def parse_ranges(specs):
+    """Return ranges and log-scaled names from parsed range_spec() arguments."""
+    ranges = {name: bounds for name, bounds, _ in specs}
+    log = {name for name, _, islog in specs if islog}
+    return ranges, log
+
+
+def runsweep(args):
+    """Run sweep and write table, returning number of failed runs."""
+    if not args.overwrite and os.path.exists(args.table):
+        sys.exit("Not creating '%s' as it already exists." % args.table)
+    if args.grid and args.range:
+        sys.exit("Specify either --grid or --range, not both")
+    if args.grid:
+        combinations = param_grid(parse_grid(args.grid))
+    elif args.range:
+        ranges, log = parse_ranges(args.range)
+        combinations = param_sample(ranges, args.samples, log, args.seed)
+    else:
+        sys.exit("Specify parameters to sweep with --grid or --range")
+    kwargs = {}
+    for name in ["pixelsize", "dim", "uvmax"]:
+        if getattr(args, name) is not None:
+            kwargs[name] = getattr(args, name)
+    if args.wav is not None:
+        kwargs["wav"] = tuple(args.wav)
+    if args.no_cache:
+        kwargs["use_cache"] = False
+    pruning = None
+    if args.prune:
+        pruning = Pruning(args.min_iterations, args.eta, args.keep)
+    results = sweep(
+        args.datafile,
+        combinations,
+        workers=args.workers,
+        pruning=pruning,
+        **kwargs,
+    )
+    write_results(results, args.table, overwrite=args.overwrite)
+    failed = [r for r in results if r.error is not None]
+    for r in failed:
+        print("Run %d %s failed: %s" % (r.run, r.params, r.error), file=sys.stderr)
+    print(
+        "Wrote '%s' (%d runs, %d pruned, %d failed)"
+        % (
+            args.table,
+            len(results),
+            sum(r.pruned for r in results),
+            len(failed),
+        )
+    )
+    return len(failed)
+
+
+def create_parser():
+    """Return new ArgumentParser instance for this script."""
+    parser = argparse.ArgumentParser(description="Sweep BSMEM hyperparameters")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+    parser.add_argument(
+        "-o", "--overwrite", action="store_true", help="Overwrite existing file"
+    )
+    parser.add_argument(
+        "-g",
+        "--grid",
+        action="append",
+        type=grid_spec,
+        metavar="NAME=V1,V2,...",
+        help="Values of parameter to sweep, e.g. alpha=100,1000 (repeatable)",
+    )
+    parser.add_argument(
+        "-r",
+        "--range",
+        action="append",
+        type=range_spec,
+        metavar="NAME=LO:HI[:log]",
+        help="Range of parameter to sample randomly (repeatable)",
+    )
+    parser.add_argument(
+        "-n", "--samples", type=int, default=20, help="Number of random samples"
+    )
+    parser.add_argument("--seed", type=int, help="Random number generator seed")
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Maximum number of concurrent bsmem runs",
+    )
+    parser.add_argument(
+        "-p",
+        "--prune",
+        action="store_true",
+        help="Abandon unpromising combinations early (successive halving)",
+    )
+    parser.add_argument(
+        "--min-iterations",
+        type=int,
+        default=Pruning().min_iterations,
+        help="Iterations in first pruning round",
+    )
+    parser.add_argument(
+        "--eta", type=int, default=Pruning().eta, help="Pruning reduction factor"
+    )
+    parser.add_argument(
+        "--keep",
+        type=float,
+        default=Pruning().final_fraction,
+        help="Fraction of combinations to run to convergence when pruning",
+    )
+    parser.add_argument("--pixelsize", type=float, help="Image pixel size in mas")
+    parser.add_argument("--dim", type=int, help="Image width in pixels")
+    parser.add_argument(
+        "-w", "--wav", type=float, nargs=2, metavar=("MIN", "MAX"), help="nm"
+    )
+    parser.add_argument("--uvmax", type=float, help="Maximum uv radius in waves")
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Do not reuse or store bsmem results"
+    )
+    parser.add_argument("datafile", help="Input OIFITS data file")
+    parser.add_argument("table", help="Output results table (.csv or .fits)")
+    return parser
+
+
+def main():
+    """Run application."""
+    parser = create_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if runsweep(args) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
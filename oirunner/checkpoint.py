@@ -0,0 +1,198 @@
+"""Python module to checkpoint bsmem runs so that jobs can be resumed.
+
+A job manifest is a JSON file recording each completed bsmem run, keyed by
+output filename, with a hash of its inputs (see get_run_key()) and of the
+output image. Passing the same manifest when re-running a job skips runs
+whose output is still present and unchanged and whose inputs and
+arguments are the same, so an interrupted job resumes from the first
+missing or stale run.
+
+Runs stopped early (e.g. by a wall-clock limit or a stop policy, see
+oirunner.stopping) may have left a truncated image, so they are not
+treated as complete unless the manifest is created with
+record_stopped=True.
+
+The manifest is rewritten atomically after each run, under a file lock so
+that it may be shared between threads and worker processes.
+
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from .bsmemcache import get_run_key
+
+_FORMAT = 1
+
+
+class StageRecord(NamedTuple):
+    """Completed bsmem run recorded in a job manifest.
+
+    Attributes:
+      key:         Hash of bsmem version, arguments and input files.
+      args:        Arguments for bsmem subprocess.
+      outputfile:  Output FITS filename.
+      outputhash:  Hash of output FITS file.
+      stop_reason: Reason bsmem was stopped early, else None.
+      time:        Time run completed (seconds since the epoch).
+
+    """
+
+    key: str
+    args: List[str]
+    outputfile: str
+    outputhash: str
+    stop_reason: Optional[str]
+    time: float
+
+
+def _hash_output(filename: str) -> str:
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _get_output(args: Sequence[str]) -> Optional[str]:
+    for arg in args:
+        if arg.startswith("--output="):
+            return os.path.abspath(arg[len("--output=") :])
+    return None
+
+
+class JobManifest:
+    """Record of completed bsmem runs, stored as a JSON file.
+
+    Attributes:
+      filename:       Manifest filename.
+      record_stopped: Whether runs stopped early count as complete.
+
+    """
+
+    def __init__(self, filename: str, record_stopped: bool = False):
+        """Create manifest, reading existing file if present."""
+        self.filename = os.path.abspath(filename)
+        self.record_stopped = record_stopped
+        self._lock = threading.Lock()
+        self._stages: Dict[str, StageRecord] = {}
+        self._load()
+
+    def __reduce__(self):
+        """Pickle by filename, e.g. to pass to a worker process."""
+        return (JobManifest, (self.filename, self.record_stopped))
+
+    def _load(self) -> None:
+        try:
+            with open(self.filename) as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logging.warning(f"Ignoring invalid manifest '{self.filename}': {e}")
+            return
+        self._stages = {
+            name: StageRecord(**entry)
+            for name, entry in content.get("stages", {}).items()
+        }
+
+    def _save(self) -> None:
+        content = {
+            "format": _FORMAT,
+            "stages": {name: r._asdict() for name, r in self._stages.items()},
+        }
+        dirname = os.path.dirname(self.filename)
+        fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=dirname)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(content, f, indent=1)
+            os.replace(tmpname, self.filename)
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+    def _update(self, name: str, record: Optional[StageRecord]) -> None:
+        """Merge change with manifest on disk, then save."""
+        with self._lock, open(self.filename + ".lock", "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            self._load()
+            if record is None:
+                self._stages.pop(name, None)
+            else:
+                self._stages[name] = record
+            self._save()
+
+    def completed(self, args: Sequence[str]) -> Optional[StageRecord]:
+        """Return record of run if complete and still valid, else None.
+
+        A run is valid if it was recorded with the same output filename,
+        bsmem version, arguments and input file contents, the output file
+        is unchanged, and it was not stopped early (unless record_stopped
+        is set).
+
+        """
+        outputfile = _get_output(args)
+        if outputfile is None:
+            return None
+        with self._lock:
+            record = self._stages.get(outputfile)
+        if record is None:
+            return None
+        if record.stop_reason is not None and not self.record_stopped:
+            logging.info(f"'{outputfile}' was stopped early ({record.stop_reason})")
+            return None
+        try:
+            if record.key != get_run_key(args):
+                logging.info(f"Inputs changed since '{outputfile}' was made")
+                return None
+            if record.outputhash != _hash_output(outputfile):
+                logging.info(f"'{outputfile}' changed since it was made")
+                return None
+        except OSError:
+            return None
+        return record
+
+    def record(self, args: Sequence[str], stop_reason: Optional[str] = None) -> None:
+        """Record completed run.
+
+        A run stopped early is not recorded (and any previous record of
+        its output is forgotten) unless record_stopped is set, so that a
+        resumed job runs it again.
+
+        Raises:
+          OSError, ValueError
+
+        """
+        outputfile = _get_output(args)
+        if outputfile is None:
+            raise ValueError("bsmem arguments do not specify output file")
+        if stop_reason is not None and not self.record_stopped:
+            self._update(outputfile, None)
+            return
+        self._update(
+            outputfile,
+            StageRecord(
+                get_run_key(args),
+                list(args),
+                outputfile,
+                _hash_output(outputfile),
+                stop_reason,
+                time.time(),
+            ),
+        )
+
+    def invalidate(self, outputfile: str) -> None:
+        """Forget completed run with given output filename."""
+        self._update(os.path.abspath(outputfile), None)
+
+    def stages(self) -> List[StageRecord]:
+        """Return records of completed runs."""
+        with self._lock:
+            return list(self._stages.values())
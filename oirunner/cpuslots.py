@@ -0,0 +1,269 @@
+"""Python module to allocate CPUs to concurrent bsmem processes.
+
+Running many bsmem processes side by side oversubscribes the cores of a
+node if each starts as many threads as there are CPUs, and processes that
+migrate between cores lose the contents of their caches. A SlotAllocator
+divides the CPUs available to this process into disjoint slots. Each bsmem
+run holds a slot while its subprocess runs (waiting for one to become
+free), and the subprocess is pinned to the slot's CPUs, told to start that
+many threads through environment variables such as OMP_NUM_THREADS, and
+optionally given lower CPU (nice) and I/O (ionice) priority.
+
+Slots are allocated within one Python process; a separate allocator is
+needed in each process that runs bsmem.
+
+Attributes:
+  THREAD_VARS (List[str]): Environment variables setting thread counts.
+  LAYOUTS (List[str]):     Ways of grouping CPUs into slots: "compact" gives
+                           each slot consecutively numbered CPUs (which
+                           typically share caches), and "scatter" deals CPUs
+                           to slots in turn.
+
+"""
+
+import asyncio
+import contextlib
+import os
+import platform
+import threading
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+THREAD_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+LAYOUTS = ["compact", "scatter"]
+
+# ioprio_set system call numbers, by machine
+_IOPRIO_SET = {"x86_64": 251, "aarch64": 30}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+# C library, loaded before fork since importing in the child is unsafe
+_libc = None
+
+
+def _load_libc() -> None:
+    global _libc
+    if platform.machine() not in _IOPRIO_SET:
+        raise ValueError(f"ionice is not supported on {platform.machine()}")
+    if _libc is None:
+        import ctypes
+
+        _libc = ctypes.CDLL(None, use_errno=True)
+
+
+def _set_ioprio(ioclass: int, level: int) -> None:
+    assert _libc is not None
+    prio = (ioclass << _IOPRIO_CLASS_SHIFT) | level
+    number = _IOPRIO_SET[platform.machine()]
+    if _libc.syscall(number, _IOPRIO_WHO_PROCESS, 0, prio) != 0:
+        raise OSError("ioprio_set failed")
+
+
+class CpuSlot(NamedTuple):
+    """CPUs and settings for one bsmem subprocess.
+
+    Attributes:
+      number:  Position of slot in allocator.
+      cpus:    CPUs the subprocess is pinned to.
+      threads: Thread count set in environment of subprocess.
+      nice:    Increment to niceness of subprocess, or None.
+      ionice:  I/O scheduling class and level of subprocess, or None.
+
+    """
+
+    number: int
+    cpus: Tuple[int, ...]
+    threads: int
+    nice: Optional[int] = None
+    ionice: Optional[Tuple[int, int]] = None
+
+    def environ(self, base: Optional[Mapping[str, str]] = None) -> Dict[str, str]:
+        """Return environment for subprocess, default based on os.environ."""
+        env = dict(os.environ if base is None else base)
+        for name in THREAD_VARS:
+            env[name] = str(self.threads)
+        return env
+
+    def preexec(self) -> None:
+        """Apply CPU affinity and priorities; called in child before exec."""
+        os.sched_setaffinity(0, self.cpus)
+        if self.nice is not None:
+            os.nice(self.nice)
+        if self.ionice is not None:
+            _set_ioprio(*self.ionice)
+
+
+def get_layout(
+    cpus: Sequence[int], nslots: int, cpus_per_slot: int, layout: str = "compact"
+) -> List[Tuple[int, ...]]:
+    """Return CPUs of each slot.
+
+    Raises:
+      ValueError
+
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(
+            "Unknown layout '%s' (expected one of %s)" % (layout, ", ".join(LAYOUTS))
+        )
+    if nslots < 1 or cpus_per_slot < 1:
+        raise ValueError("Need at least one slot of at least one CPU")
+    if nslots * cpus_per_slot > len(cpus):
+        raise ValueError(
+            "Cannot make %d slots of %d CPUs from %d CPUs"
+            % (nslots, cpus_per_slot, len(cpus))
+        )
+    if layout == "compact":
+        return [
+            tuple(cpus[k * cpus_per_slot : (k + 1) * cpus_per_slot])
+            for k in range(nslots)
+        ]
+    return [tuple(cpus[k::nslots][:cpus_per_slot]) for k in range(nslots)]
+
+
+class SlotAllocator:
+    """Hand out disjoint sets of CPUs to concurrent bsmem subprocesses.
+
+    Pass an instance as the cpu_slots argument of run_bsmem() (or any
+    function forwarding keyword arguments to it). Runs wait while all
+    slots are in use, so the number of slots also limits the number of
+    concurrent bsmem processes. Threads wait with acquire(), and
+    coroutines with async_acquire(), which waits on the event loop
+    rather than occupying a thread.
+
+    Attributes:
+      slots: CPUs of each slot.
+      threads: Thread count set for each subprocess.
+      nice: Increment to niceness of each subprocess, or None.
+      ionice: I/O scheduling class and level of each subprocess, or None.
+
+    """
+
+    def __init__(
+        self,
+        nslots: Optional[int] = None,
+        cpus_per_slot: int = 1,
+        cpus: Optional[Iterable[int]] = None,
+        layout: str = "compact",
+        threads: Optional[int] = None,
+        nice: Optional[int] = None,
+        ionice: Optional[Tuple[int, int]] = None,
+    ):
+        """Divide CPUs into slots.
+
+        Args:
+          nslots:        Number of slots, default as many as fit.
+          cpus_per_slot: Number of CPUs in each slot.
+          cpus:          CPUs to use, default those available to this process.
+          layout:        How CPUs are grouped into slots, one of LAYOUTS.
+          threads:       Thread count for each subprocess, default
+                         cpus_per_slot.
+          nice:          Increment to niceness of each subprocess.
+          ionice:        I/O scheduling class (1-3) and level (0-7) of each
+                         subprocess, e.g. (3, 0) for idle (Linux only).
+
+        Raises:
+          ValueError
+
+        """
+        cpus = sorted(os.sched_getaffinity(0) if cpus is None else set(cpus))
+        if nslots is None:
+            nslots = len(cpus) // max(cpus_per_slot, 1)
+        self.slots = get_layout(cpus, nslots, cpus_per_slot, layout)
+        self.threads = cpus_per_slot if threads is None else threads
+        self.nice = nice
+        self.ionice = ionice
+        if ionice is not None:
+            _load_libc()
+        self._free = list(range(nslots))
+        self._cond = threading.Condition()
+        # Events of coroutines waiting for a slot, with their event loops
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def __len__(self) -> int:
+        """Return number of slots."""
+        return len(self.slots)
+
+    @property
+    def free(self) -> int:
+        """Number of slots not in use."""
+        with self._cond:
+            return len(self._free)
+
+    def acquire(self, timeout: Optional[float] = None) -> CpuSlot:
+        """Wait for a free slot and take it.
+
+        Raises:
+          TimeoutError
+
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._free, timeout):
+                raise TimeoutError(f"No CPU slot free after {timeout} s")
+            return self._take()
+
+    async def async_acquire(self) -> CpuSlot:
+        """Wait on the running event loop for a free slot and take it."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._free:
+                    return self._take()
+                waiter = (loop, asyncio.Event())
+                self._waiters.append(waiter)
+            try:
+                await waiter[1].wait()
+            finally:
+                with self._cond:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+
+    def _take(self) -> CpuSlot:
+        number = self._free.pop(0)
+        return CpuSlot(number, self.slots[number], self.threads, self.nice, self.ionice)
+
+    def release(self, slot: CpuSlot) -> None:
+        """Return slot taken by acquire().
+
+        Raises:
+          ValueError
+
+        """
+        with self._cond:
+            if slot.number in self._free:
+                raise ValueError(f"CPU slot {slot.number} is not in use")
+            self._free.append(slot.number)
+            self._free.sort()
+            self._cond.notify()
+            # Waiting coroutines retry, and wait again if the slot is taken
+            for loop, event in self._waiters:
+                try:
+                    loop.call_soon_threadsafe(event.set)
+                except RuntimeError:
+                    # Event loop closed
+                    pass
+            self._waiters.clear()
+
+    @contextlib.contextmanager
+    def slot(self, timeout: Optional[float] = None) -> Iterator[CpuSlot]:
+        """Context manager taking a slot for the duration of a with block."""
+        slot = self.acquire(timeout)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
@@ -0,0 +1,391 @@
+"""Python module to score images against OIFITS data.
+
+bsmem reports the chi-squared of its own reconstruction, but comparing
+many candidate images (from a sweep, bootstrap or multi-step run) against
+the same data needs a forward model that does not run bsmem. A
+ForwardModel reads the squared visibilities and closure phases from an
+OIFITS file once, and computes the model values for images by a discrete
+Fourier transform at the uv points of the data. The transform is
+separable over the image axes and vectorised over all baselines,
+wavelength channels and images, so that many images on the same pixel
+grid can be scored together.
+
+Model visibilities use the OIFITS convention V(u, v) = sum I(x, y)
+exp(-2 pi i (u x + v y)), with x increasing with the first image axis
+(RA) by CDELT1 and y with the second (Dec) by CDELT2. Images are
+normalised to unit total flux. Squared visibilities and closure phases
+do not depend on the position of the image on the grid.
+
+Attributes:
+  MAX_ELEMENTS (int): Maximum number of complex elements in intermediate
+                      arrays, bounding memory used per transform chunk.
+
+"""
+
+from __future__ import annotations
+
+import math
+from typing import (
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TYPE_CHECKING,
+    Tuple,
+    Union,
+)
+
+from .lazy import lazy_import
+from .priorimage import MAS_TO_DEG, get_pixelsize
+
+if TYPE_CHECKING:
+    from astropy.io import fits
+    import numpy as np
+else:
+    fits = lazy_import("astropy.io.fits")
+    np = lazy_import("numpy")
+
+MAX_ELEMENTS = 1 << 22
+
+_MAS_TO_RAD = math.radians(MAS_TO_DEG)
+
+
+class ResidualTable(NamedTuple):
+    """Data and model values of one observable, one element per data point.
+
+    Attributes:
+      hdu:      Position of data table HDU in OIFITS file.
+      row:      Row of data table.
+      channel:  Wavelength channel.
+      wave:     Effective wavelength (m).
+      spfreq:   Spatial frequency (waves), the longest of the triangle for
+                closure phases.
+      data:     Measured value.
+      error:    Uncertainty of measured value.
+      model:    Model value.
+      residual: Normalised residual (data - model) / error, wrapped into
+                [-180, 180) degrees before normalising for closure phases.
+
+    """
+
+    hdu: np.ndarray
+    row: np.ndarray
+    channel: np.ndarray
+    wave: np.ndarray
+    spfreq: np.ndarray
+    data: np.ndarray
+    error: np.ndarray
+    model: np.ndarray
+    residual: np.ndarray
+
+
+class ImageScore(NamedTuple):
+    """Agreement of image with OIFITS data.
+
+    Reduced chi-squared values are NaN if there are no data of that kind.
+
+    Attributes:
+      chi2:      Reduced chi-squared of all squared visibilities and closure
+                 phases.
+      chi2_vis2: Reduced chi-squared of squared visibilities.
+      chi2_t3:   Reduced chi-squared of closure phases.
+      vis2:      Squared visibility residuals.
+      t3:        Closure phase (degrees) residuals.
+
+    """
+
+    chi2: float
+    chi2_vis2: float
+    chi2_t3: float
+    vis2: ResidualTable
+    t3: ResidualTable
+
+
+class _Points(NamedTuple):
+    hdu: np.ndarray
+    row: np.ndarray
+    channel: np.ndarray
+    wave: np.ndarray
+    spfreq: np.ndarray
+    data: np.ndarray
+    error: np.ndarray
+    # Spatial frequencies (waves) of each baseline, shape (nbase, npoints)
+    u: np.ndarray
+    v: np.ndarray
+
+
+def _get_waves(hdulist: fits.HDUList) -> Dict[str, np.ndarray]:
+    return {
+        hdu.header["INSNAME"]: np.asarray(hdu.data["EFF_WAVE"], float)
+        for hdu in hdulist[1:]
+        if hdu.name == "OI_WAVELENGTH"
+    }
+
+
+def _read_points(
+    hdulist: fits.HDUList,
+    extname: str,
+    datacol: str,
+    errcol: str,
+    wav: Optional[Tuple[float, float]],
+) -> _Points:
+    waves = _get_waves(hdulist)
+    parts: List[_Points] = []
+    for position, hdu in enumerate(hdulist):
+        if hdu.name != extname or hdu.data is None or len(hdu.data) == 0:
+            continue
+        insname = hdu.header["INSNAME"]
+        if insname not in waves:
+            raise KeyError("No OI_WAVELENGTH table for INSNAME '%s'" % insname)
+        tablewaves = waves[insname]
+        nrows, nwave = len(hdu.data), len(tablewaves)
+        data = np.asarray(hdu.data[datacol], float).reshape(nrows, nwave)
+        error = np.asarray(hdu.data[errcol], float).reshape(nrows, nwave)
+        mask = np.isfinite(data) & np.isfinite(error) & (error > 0)
+        if "FLAG" in hdu.columns.names:
+            mask &= ~np.asarray(hdu.data["FLAG"], bool).reshape(nrows, nwave)
+        if wav is not None:
+            mask &= (tablewaves >= wav[0] * 1e-9) & (tablewaves <= wav[1] * 1e-9)
+        row, channel = np.nonzero(mask)
+        wave = tablewaves[channel]
+        if extname == "OI_T3":
+            u1, v1 = hdu.data["U1COORD"][row], hdu.data["V1COORD"][row]
+            u2, v2 = hdu.data["U2COORD"][row], hdu.data["V2COORD"][row]
+            u = np.array([u1, u2, u1 + u2], float) / wave
+            v = np.array([v1, v2, v1 + v2], float) / wave
+        else:
+            u = np.array([hdu.data["UCOORD"][row]], float) / wave
+            v = np.array([hdu.data["VCOORD"][row]], float) / wave
+        parts.append(
+            _Points(
+                np.full(len(row), position),
+                row,
+                channel,
+                wave,
+                np.hypot(u, v).max(axis=0),
+                data[row, channel],
+                error[row, channel],
+                u,
+                v,
+            )
+        )
+    if not parts:
+        nbase = 3 if extname == "OI_T3" else 1
+        empty = np.zeros(0)
+        return _Points(
+            *[empty.astype(int)] * 3, *[empty] * 4, *[np.zeros((nbase, 0))] * 2
+        )
+    return _Points(
+        *[np.concatenate(arrays, axis=-1) for arrays in zip(*parts)]  # type: ignore
+    )
+
+
+def _get_axes(imagehdu: Union[fits.PrimaryHDU, fits.ImageHDU]) -> Tuple[float, float]:
+    """Return signed increments (mas) of image axes, checking pixels square."""
+    pixelsize = get_pixelsize(imagehdu)
+    return pixelsize, abs(pixelsize) * np.sign(imagehdu.header["CDELT2"])
+
+
+def _dft_axis(freq: np.ndarray, n: int, delta: float) -> np.ndarray:
+    """Return DFT kernel, shape (len(freq), n), for n pixels of delta mas."""
+    offsets = (np.arange(n) - n // 2) * (delta * _MAS_TO_RAD)
+    return np.exp(-2j * np.pi * np.multiply.outer(freq, offsets))
+
+
+def model_vis(
+    images: np.ndarray,
+    u: np.ndarray,
+    v: np.ndarray,
+    deltax: float,
+    deltay: float,
+) -> np.ndarray:
+    """Return complex visibilities of images at uv points.
+
+    Args:
+      images: Array of images, shape (nimage, ny, nx), indexed [y, x].
+      u:      Spatial frequencies along x (waves).
+      v:      Spatial frequencies along y (waves).
+      deltax: Signed pixel increment along x (mas).
+      deltay: Signed pixel increment along y (mas).
+
+    Returns:
+      Visibilities of images normalised to unit total flux, shape
+      (nimage, npoints).
+
+    Raises:
+      ValueError
+
+    """
+    images = np.asarray(images, float)
+    nimage, ny, nx = images.shape
+    flux = images.sum(axis=(1, 2))
+    if np.any(flux == 0):
+        raise ValueError("Cannot normalise image with zero total flux")
+    result = np.empty((nimage, len(u)), complex)
+    chunk = max(1, MAX_ELEMENTS // (nimage * max(nx, ny)))
+    for start in range(0, len(u), chunk):
+        end = start + chunk
+        kernelx = _dft_axis(u[start:end], nx, deltax)
+        kernely = _dft_axis(v[start:end], ny, deltay)
+        # Transform along x, then sum along y for each point
+        partial = images @ kernelx.T
+        result[:, start:end] = np.einsum("nyp,py->np", partial, kernely)
+    return result / flux[:, np.newaxis]
+
+
+def _residual_table(points: _Points, model: np.ndarray, residual: np.ndarray):
+    return ResidualTable(
+        points.hdu,
+        points.row,
+        points.channel,
+        points.wave,
+        points.spfreq,
+        points.data,
+        points.error,
+        model,
+        residual,
+    )
+
+
+def _reduced(residual: np.ndarray) -> float:
+    if len(residual) == 0:
+        return float("nan")
+    return float(np.sum(residual**2) / len(residual))
+
+
+class ForwardModel:
+    """Squared visibilities and closure phases of images at OIFITS uv points.
+
+    Flagged data, and data with non-finite values or non-positive errors,
+    are ignored.
+
+    Attributes:
+      datafile: Input OIFITS data filename.
+      wav:      Min and max wavelengths selected (nm), or None for all.
+      nvis2:    Number of squared visibility points.
+      nt3:      Number of closure phase points.
+
+    """
+
+    def __init__(self, datafile: str, wav: Optional[Tuple[float, float]] = None):
+        """Read squared visibilities and closure phases.
+
+        Args:
+          datafile: Input OIFITS data filename.
+          wav:      Min and max wavelengths to select (nm).
+
+        Raises:
+          KeyError, OSError, ValueError
+
+        """
+        self.datafile = datafile
+        self.wav = wav
+        with fits.open(datafile, memmap=False) as hdulist:
+            self._vis2 = _read_points(hdulist, "OI_VIS2", "VIS2DATA", "VIS2ERR", wav)
+            self._t3 = _read_points(hdulist, "OI_T3", "T3PHI", "T3PHIERR", wav)
+        self.nvis2 = len(self._vis2.row)
+        self.nt3 = len(self._t3.row)
+        if self.nvis2 + self.nt3 == 0:
+            raise ValueError(
+                "No squared visibilities or closure phases in '%s' (wav=%s)"
+                % (datafile, wav)
+            )
+        # All spatial frequencies, transformed together
+        self._u = np.concatenate([self._vis2.u.ravel(), self._t3.u.ravel()])
+        self._v = np.concatenate([self._vis2.v.ravel(), self._t3.v.ravel()])
+
+    def model(
+        self, images: np.ndarray, deltax: float, deltay: Optional[float] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return model squared visibilities and closure phases of images.
+
+        Args:
+          images: Image or array of images indexed [y, x], all on the
+                  same pixel grid.
+          deltax: Signed pixel increment along x (mas).
+          deltay: Signed pixel increment along y (mas), default deltax.
+
+        Returns:
+          Squared visibilities and closure phases (degrees), with shapes
+          (nvis2,) and (nt3,) for a single image, or (nimage, nvis2) and
+          (nimage, nt3).
+
+        Raises:
+          ValueError
+
+        """
+        images = np.asarray(images, float)
+        single = images.ndim == 2
+        if single:
+            images = images[np.newaxis]
+        if deltay is None:
+            deltay = deltax
+        vis = model_vis(images, self._u, self._v, deltax, deltay)
+        vis2 = np.abs(vis[:, : self.nvis2]) ** 2
+        tvis = vis[:, self.nvis2 :].reshape(len(images), 3, self.nt3)
+        t3 = tvis[:, 0] * tvis[:, 1] * np.conj(tvis[:, 2])
+        t3phi = np.degrees(np.angle(t3))
+        if single:
+            return vis2[0], t3phi[0]
+        return vis2, t3phi
+
+    def _score(self, vis2: np.ndarray, t3phi: np.ndarray) -> ImageScore:
+        vis2res = (self._vis2.data - vis2) / self._vis2.error
+        t3diff = (self._t3.data - t3phi + 180.0) % 360.0 - 180.0
+        t3res = t3diff / self._t3.error
+        return ImageScore(
+            _reduced(np.concatenate([vis2res, t3res])),
+            _reduced(vis2res),
+            _reduced(t3res),
+            _residual_table(self._vis2, vis2, vis2res),
+            _residual_table(self._t3, t3phi, t3res),
+        )
+
+    def score(self, imagehdu: Union[fits.PrimaryHDU, fits.ImageHDU]) -> ImageScore:
+        """Return chi-squared and residuals of image.
+
+        Raises:
+          KeyError, ValueError
+
+        """
+        return self.score_many([imagehdu])[0]
+
+    def score_many(
+        self, imagehdus: Sequence[Union[fits.PrimaryHDU, fits.ImageHDU]]
+    ) -> List[ImageScore]:
+        """Return chi-squared and residuals of each image.
+
+        Images on the same pixel grid are transformed together.
+
+        Raises:
+          KeyError, ValueError
+
+        """
+        groups: Dict[Tuple[Tuple[int, ...], float, float], List[int]] = {}
+        for i, imagehdu in enumerate(imagehdus):
+            key = (imagehdu.data.shape, *_get_axes(imagehdu))
+            groups.setdefault(key, []).append(i)
+        scores: List[Optional[ImageScore]] = [None] * len(imagehdus)
+        for (_, deltax, deltay), indexes in groups.items():
+            images = np.stack([imagehdus[i].data for i in indexes])
+            vis2, t3phi = self.model(images, deltax, deltay)
+            for i, v, t in zip(indexes, vis2, t3phi):
+                scores[i] = self._score(v, t)
+        return scores  # type: ignore
+
+
+def score_image(
+    datafile: str,
+    imagehdu: Union[fits.PrimaryHDU, fits.ImageHDU],
+    wav: Optional[Tuple[float, float]] = None,
+) -> ImageScore:
+    """Return chi-squared and residuals of image against OIFITS data.
+
+    Use ForwardModel to score several images against the same data.
+
+    Raises:
+      KeyError, OSError, ValueError
+
+    """
+    return ForwardModel(datafile, wav).score(imagehdu)
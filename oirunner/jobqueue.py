@@ -0,0 +1,532 @@
+"""Python module to share reconstruction jobs between worker processes.
+
+Jobs are calls of importable functions, e.g. runbsmem.reconst_grey_2step,
+with JSON-serializable arguments. They are stored in an SQLite database,
+which may be on a filesystem shared between nodes. Worker processes on
+any node claim the pending job of highest priority, holding a lease on it
+that they renew while the job runs. A job whose lease expires, because
+its worker died or lost contact with the database, is returned to the
+queue. Failed jobs are retried until they have been attempted
+max_attempts times.
+
+SQLite relies on the filesystem's locking, so the database should not be
+placed on a network filesystem whose locking is unreliable. Leases are
+compared with each node's clock, so clocks should be synchronized to
+much better than LEASE_SECONDS.
+
+Example:
+  queue = JobQueue("jobs.db")
+  for wav in get_wavelength_bins(datafile):
+      queue.submit(reconst_grey_basic, datafile, wav=wav)
+  Worker(queue).run()
+
+Attributes:
+  LEASE_SECONDS (float): Default duration of a worker's claim on a job
+                         between renewals.
+  MAX_ATTEMPTS (int):    Default maximum number of times a job is run.
+  POLL_SECONDS (float):  Default interval between checks for new jobs.
+  PENDING, RUNNING, DONE, FAILED, CANCELLED (str): Job statuses.
+
+"""
+
+import contextlib
+import importlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Union
+
+from . import timing
+
+LEASE_SECONDS = 60.0
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 1.0
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    function TEXT NOT NULL,
+    args TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    seconds REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority DESC, job_id);
+"""
+
+
+class Job(NamedTuple):
+    """Job stored in queue.
+
+    Attributes:
+      job_id:        Unique identifier of job.
+      name:          Optional description of job.
+      function:      Function to call, as "module:qualname".
+      args:          Positional arguments.
+      kwargs:        Keyword arguments.
+      priority:      Jobs of higher priority are claimed first.
+      status:        "pending", "running", "done", "failed" or "cancelled".
+      attempts:      Number of times job has been claimed.
+      max_attempts:  Maximum number of times to claim job.
+      worker:        Identifier of worker that last claimed job.
+      lease_expires: Time claim on running job expires.
+      submitted:     Time job was submitted.
+      started:       Time job was last claimed.
+      finished:      Time job last finished or failed.
+      seconds:       Duration of last attempt.
+      result:        Return value of function, if done.
+      error:         Error message from last failed attempt.
+
+    Times are in seconds since the epoch.
+
+    """
+
+    job_id: int
+    name: Optional[str]
+    function: str
+    args: List[Any]
+    kwargs: Dict[str, Any]
+    priority: int
+    status: str
+    attempts: int
+    max_attempts: int
+    worker: Optional[str]
+    lease_expires: Optional[float]
+    submitted: float
+    started: Optional[float]
+    finished: Optional[float]
+    seconds: Optional[float]
+    result: Any
+    error: Optional[str]
+
+
+def _make_job(row: sqlite3.Row) -> Job:
+    values = dict(row)
+    for key in ["args", "kwargs", "result"]:
+        if values[key] is not None:
+            values[key] = json.loads(values[key])
+    return Job(**values)
+
+
+def get_function_name(function: Callable) -> str:
+    """Return "module:qualname" identifying importable function.
+
+    Raises:
+      ValueError
+
+    """
+    module = getattr(function, "__module__", None)
+    qualname = getattr(function, "__qualname__", "")
+    if module is None or module == "__main__" or "<" in qualname:
+        raise ValueError(f"Cannot submit {function!r} as it cannot be imported")
+    return f"{module}:{qualname}"
+
+
+def resolve_function(name: str) -> Callable:
+    """Return function identified by "module:qualname".
+
+    Raises:
+      AttributeError, ImportError, ValueError
+
+    """
+    module, sep, qualname = name.partition(":")
+    if not sep:
+        raise ValueError(f"Function name '{name}' is not of form 'module:qualname'")
+    result: Any = importlib.import_module(module)
+    for attr in qualname.split("."):
+        result = getattr(result, attr)
+    return result
+
+
+def get_worker_id() -> str:
+    """Return identifier of this process, unique across nodes."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+    """Queue of jobs stored in an SQLite database.
+
+    Each operation uses its own short transaction, so a JobQueue may be
+    used from several threads and many processes may share a database.
+
+    Attributes:
+      filename: Database filename.
+      lease:    Duration of claim on job between renewals (seconds).
+
+    """
+
+    def __init__(self, filename: str, lease: float = LEASE_SECONDS):
+        """Open queue, creating database if necessary."""
+        self.filename = os.path.abspath(filename)
+        self.lease = lease
+        db = sqlite3.connect(self.filename, timeout=60.0)
+        try:
+            db.executescript(_SCHEMA)
+        finally:
+            db.close()
+
+    def __reduce__(self):
+        """Pickle by filename, e.g. to pass to a worker process."""
+        return (JobQueue, (self.filename, self.lease))
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Context manager yielding connection with write lock held."""
+        db = sqlite3.connect(self.filename, timeout=60.0, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def submit(
+        self,
+        function: Union[str, Callable],
+        *args: Any,
+        priority: int = 0,
+        max_attempts: int = MAX_ATTEMPTS,
+        name: Optional[str] = None,
+        **kwargs: Any,
+    ) -> int:
+        """Add job to queue.
+
+        Args:
+          function:     Importable function, or its "module:qualname".
+          args:         Positional arguments for function.
+          priority:     Jobs of higher priority are claimed first.
+          max_attempts: Maximum number of times to run job.
+          name:         Optional description of job.
+          kwargs:       Keyword arguments for function.
+
+        Returns:
+          Identifier of new job.
+
+        Raises:
+          TypeError, ValueError
+
+        """
+        if not isinstance(function, str):
+            function = get_function_name(function)
+        with self._transaction() as db:
+            cursor = db.execute(
+                "INSERT INTO jobs (name, function, args, kwargs, priority, status,"
+                " max_attempts, submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    name,
+                    function,
+                    json.dumps(args),
+                    json.dumps(kwargs),
+                    priority,
+                    PENDING,
+                    max_attempts,
+                    time.time(),
+                ),
+            )
+            job_id = cursor.lastrowid
+        assert job_id is not None
+        return job_id
+
+    def _expire(self, db: sqlite3.Connection, now: float) -> None:
+        """Return jobs with expired leases to queue, or fail them."""
+        for row in db.execute(
+            "SELECT job_id, worker, attempts, max_attempts FROM jobs"
+            " WHERE status = ? AND lease_expires < ?",
+            (RUNNING, now),
+        ).fetchall():
+            logging.warning(
+                f"Lease on job {row['job_id']} held by {row['worker']} expired"
+            )
+            retry = row["attempts"] < row["max_attempts"]
+            db.execute(
+                "UPDATE jobs SET status = ?, lease_expires = NULL, error = ?"
+                " WHERE job_id = ?",
+                (
+                    PENDING if retry else FAILED,
+                    f"Lease held by {row['worker']} expired",
+                    row["job_id"],
+                ),
+            )
+
+    def claim(self, worker: Optional[str] = None) -> Optional[Job]:
+        """Claim pending job of highest priority, if any.
+
+        Args:
+          worker: Identifier of claiming worker, default get_worker_id().
+
+        Returns:
+          Claimed job, or None if there are no pending jobs.
+
+        """
+        if worker is None:
+            worker = get_worker_id()
+        now = time.time()
+        with self._transaction() as db:
+            self._expire(db, now)
+            row = db.execute(
+                "SELECT job_id FROM jobs WHERE status = ?"
+                " ORDER BY priority DESC, job_id LIMIT 1",
+                (PENDING,),
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, worker = ?,"
+                " lease_expires = ?, started = ?, finished = NULL, seconds = NULL"
+                " WHERE job_id = ?",
+                (RUNNING, worker, now + self.lease, now, row["job_id"]),
+            )
+            return _make_job(
+                db.execute(
+                    "SELECT * FROM jobs WHERE job_id = ?", (row["job_id"],)
+                ).fetchone()
+            )
+
+    def renew(self, job_id: int, worker: str) -> bool:
+        """Extend worker's lease on running job.
+
+        Returns:
+          False if the job is no longer held by the worker.
+
+        """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET lease_expires = ?"
+                " WHERE job_id = ? AND worker = ? AND status = ?",
+                (time.time() + self.lease, job_id, worker, RUNNING),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id: int, worker: str, result: Any = None) -> bool:
+        """Record successful completion of job.
+
+        Args:
+          job_id: Identifier of job.
+          worker: Identifier of worker holding job.
+          result: JSON-serializable return value of job function (other
+                  values are recorded as strings).
+
+        Returns:
+          False if the job is no longer held by the worker, so the result
+          was not recorded.
+
+        """
+        return self._finish(job_id, worker, DONE, json.dumps(result, default=str))
+
+    def fail(self, job_id: int, worker: str, error: str) -> bool:
+        """Record failed attempt at job, returning it to queue if retries remain.
+
+        Returns:
+          False if the job is no longer held by the worker.
+
+        """
+        return self._finish(job_id, worker, FAILED, None, error)
+
+    def _finish(
+        self,
+        job_id: int,
+        worker: str,
+        status: str,
+        result: Optional[str],
+        error: Optional[str] = None,
+    ) -> bool:
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT attempts, max_attempts, started FROM jobs"
+                " WHERE job_id = ? AND worker = ? AND status = ?",
+                (job_id, worker, RUNNING),
+            ).fetchone()
+            if row is None:
+                logging.warning(f"Job {job_id} is no longer held by {worker}")
+                return False
+            if status == FAILED and row["attempts"] < row["max_attempts"]:
+                status = PENDING
+            db.execute(
+                "UPDATE jobs SET status = ?, lease_expires = NULL, finished = ?,"
+                " seconds = ?, result = ?, error = ? WHERE job_id = ?",
+                (status, now, now - row["started"], result, error, job_id),
+            )
+        return True
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel pending job.
+
+        Returns:
+          False if the job is not pending.
+
+        """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = ? WHERE job_id = ? AND status = ?",
+                (CANCELLED, job_id, PENDING),
+            )
+            return cursor.rowcount == 1
+
+    def retry(self, job_id: int) -> bool:
+        """Return failed or cancelled job to queue, with no attempts counted.
+
+        Returns:
+          False if the job has not failed or been cancelled.
+
+        """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = ?, attempts = 0"
+                " WHERE job_id = ? AND status IN (?, ?)",
+                (PENDING, job_id, FAILED, CANCELLED),
+            )
+            return cursor.rowcount == 1
+
+    def get(self, job_id: int) -> Job:
+        """Return job with given identifier.
+
+        Raises:
+          KeyError
+
+        """
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT * FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"No job {job_id} in '{self.filename}'")
+        return _make_job(row)
+
+    def jobs(self, status: Optional[str] = None) -> List[Job]:
+        """Return all jobs, or those with given status, in order submitted."""
+        with self._transaction() as db:
+            if status is None:
+                rows = db.execute("SELECT * FROM jobs ORDER BY job_id").fetchall()
+            else:
+                rows = db.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY job_id", (status,)
+                ).fetchall()
+        return [_make_job(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        """Return number of jobs with each status."""
+        with self._transaction() as db:
+            self._expire(db, time.time())
+            rows = db.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        result = {s: 0 for s in [PENDING, RUNNING, DONE, FAILED, CANCELLED]}
+        result.update({row[0]: row[1] for row in rows})
+        return result
+
+
+class Worker:
+    """Process that claims and runs jobs from a queue.
+
+    While a job runs, a background thread renews the lease on it. If the
+    lease is lost, the job may be claimed by another worker, and its
+    result from this worker is discarded.
+
+    Attributes:
+      queue:     Queue to take jobs from.
+      worker_id: Identifier of worker.
+      poll:      Interval between checks for new jobs (seconds).
+
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        worker_id: Optional[str] = None,
+        poll: float = POLL_SECONDS,
+    ):
+        """Create worker."""
+        self.queue = queue
+        self.worker_id = get_worker_id() if worker_id is None else worker_id
+        self.poll = poll
+        self._stopping = threading.Event()
+
+    def stop(self) -> None:
+        """Stop claiming jobs once the current job (if any) finishes."""
+        self._stopping.set()
+
+    def run_job(self, job: Job) -> bool:
+        """Run claimed job and record its outcome.
+
+        Returns:
+          Whether the job succeeded.
+
+        """
+        logging.info(f"{self.worker_id} running job {job.job_id} ({job.function})")
+        finished = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(job, finished))
+        renewer.daemon = True
+        renewer.start()
+        try:
+            with timing.span("job", job_id=job.job_id, function=job.function):
+                function = resolve_function(job.function)
+                result = function(*job.args, **job.kwargs)
+        except Exception as e:
+            logging.exception(f"Job {job.job_id} failed")
+            self.queue.fail(job.job_id, self.worker_id, f"{type(e).__name__}: {e}")
+            return False
+        finally:
+            finished.set()
+            renewer.join()
+        self.queue.complete(job.job_id, self.worker_id, result)
+        return True
+
+    def _renew(self, job: Job, finished: threading.Event) -> None:
+        while not finished.wait(self.queue.lease / 3):
+            try:
+                if not self.queue.renew(job.job_id, self.worker_id):
+                    logging.warning(f"{self.worker_id} lost lease on job {job.job_id}")
+                    return
+            except sqlite3.Error as e:
+                logging.warning(f"Failed to renew lease on job {job.job_id}: {e}")
+
+    def run(self, max_jobs: Optional[int] = None, wait: bool = False) -> int:
+        """Claim and run jobs until queue is empty or stop() is called.
+
+        Args:
+          max_jobs: Maximum number of jobs to run.
+          wait:     Wait for new jobs rather than returning when no jobs
+                    are pending.
+
+        Returns:
+          Number of jobs run.
+
+        """
+        count = 0
+        while not self._stopping.is_set() and (max_jobs is None or count < max_jobs):
+            job = self.queue.claim(self.worker_id)
+            if job is None:
+                if not wait:
+                    break
+                self._stopping.wait(self.poll)
+                continue
+            self.run_job(job)
+            count += 1
+        return count
@@ -0,0 +1,63 @@
+"""Python module to defer importing heavy dependencies until first use.
+
+Importing astropy, numpy and scipy takes several hundred milliseconds,
+which would otherwise dominate the start-up time of the command-line
+tools, e.g. "makesf -V", and of code that only builds bsmem arguments.
+Modules in this package therefore bind these dependencies to proxies::
+
+  from __future__ import annotations
+
+  from typing import TYPE_CHECKING
+
+  from .lazy import lazy_import
+
+  if TYPE_CHECKING:
+      from astropy.io import fits
+  else:
+      fits = lazy_import("astropy.io.fits")
+
+The real module is imported when an attribute of the proxy is first
+accessed. Postponed evaluation of annotations ensures that type hints
+naming the dependency do not trigger the import.
+
+"""
+
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Proxy for a module, imported when an attribute is first accessed."""
+
+    def __getattr__(self, name: str):
+        """Import module and return attribute from it.
+
+        Raises:
+          AttributeError, ImportError
+
+        """
+        module = importlib.import_module(self.__name__)
+        # Later lookups find attributes without calling __getattr__
+        self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+    def __repr__(self) -> str:
+        """Return representation showing module name."""
+        return f"<lazy module '{self.__name__}'>"
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Return module, or proxy importing it on first attribute access.
+
+    Args:
+      name: Absolute module name, e.g. "astropy.io.fits".
+
+    Returns:
+      The module itself if already imported, else a proxy for it.
+
+    """
+    try:
+        return sys.modules[name]
+    except KeyError:
+        return LazyModule(name)
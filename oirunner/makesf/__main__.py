@@ -1,20 +1,69 @@
 """Make initial/prior model image for BSMEM.
 
+The input may be a 2-D image or an image cube, each plane of which is
+blurred and thresholded separately.
+
+With --batch, many input images are processed in a single interpreter
+using a pool of worker processes, skipping those whose output is up to
+date. Inputs that are themselves prior images made by this script are
+ignored, so that a glob pattern matching the outputs of a previous run
+can be used again.
+
 Attributes:
   COPY_KEYWORDS (List[str]): FITS header keywords copied from input file.
+  HASH_KEYWORD (str):        FITS header keyword recording hash of input
+                             file and parameters.
+  DEFAULT_TEMPLATE (str):    Default output filename template for batch
+                             mode.
+  DEFAULT_WORKERS (int):     Default number of worker processes for batch
+                             mode.
 
 """
 
+from __future__ import annotations
+
 import argparse
+import glob
+import hashlib
 import os.path
 import sys
-
-from astropy.io import fits
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterable, List, NamedTuple, Optional, Sequence, TYPE_CHECKING
 
 from oirunner import __version__
+from oirunner.lazy import lazy_import
 from oirunner.priorimage import makesf
 
+if TYPE_CHECKING:
+    from astropy.io import fits
+    import numpy as np
+else:
+    fits = lazy_import("astropy.io.fits")
+    np = lazy_import("numpy")
+
 COPY_KEYWORDS = ["HDUNAME", "ORIGIN", "OBJECT", "AUTHOR", "REFERENC"]
+HASH_KEYWORD = "MAKESFID"
+DEFAULT_TEMPLATE = "{dir}/{stem}_sf{ext}"
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+_buffer: Optional[np.ndarray] = None
+
+
+class BatchResult(NamedTuple):
+    """Outcome of processing one image in batch mode.
+
+    Attributes:
+      inputimage:  Input FITS image filename.
+      outputimage: Output FITS image filename.
+      skipped:     Output was up to date.
+      error:       Error message if processing failed, else None.
+
+    """
+
+    inputimage: str
+    outputimage: str
+    skipped: bool
+    error: Optional[str]
 
 
 def copyheader(fromhdu, tohdu):
@@ -26,22 +75,260 @@ def copyheader(fromhdu, tohdu):
             pass
 
 
+def get_hash(inputimage, fwhm, threshold, blank=None, dtype=None):
+    """Return hash of input image file and makesf parameters."""
+    h = hashlib.sha256()
+    with open(inputimage, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    params = (fwhm, threshold, blank)
+    if dtype is not None:
+        params += (np.dtype(dtype).name,)
+    h.update(repr(params).encode("ascii"))
+    return h.hexdigest()
+
+
+def makeprior(
+    inputimage,
+    outputimage,
+    fwhm,
+    threshold,
+    blank=None,
+    overwrite=False,
+    lowmem=False,
+    dtype=None,
+):
+    """Make initial/prior image file for BSMEM from existing image file.
+
+    If lowmem is True, the input image is memory-mapped and the output
+    image data are written to a buffer that is reused by subsequent calls
+    in the same process for images of the same shape and dtype.
+
+    """
+    with fits.open(inputimage, memmap=lowmem or None) as hdulist:
+        kwargs = {} if blank is None else {"blank": blank}
+        if lowmem:
+            shape = hdulist[0].shape
+            kwargs["out"] = _get_buffer(shape, np.dtype(dtype or np.float64))
+        outhdu = makesf(hdulist[0], fwhm, threshold, dtype=dtype, **kwargs)
+        copyheader(hdulist[0], outhdu)
+        outhdu.header[HASH_KEYWORD] = get_hash(
+            inputimage, fwhm, threshold, blank, dtype
+        )
+        outhdu.writeto(outputimage, overwrite=overwrite)
+
+
+def _get_buffer(shape, dtype):
+    global _buffer
+    if _buffer is None or _buffer.shape != shape or _buffer.dtype != dtype:
+        _buffer = None  # release old buffer before allocating new one
+        _buffer = np.empty(shape, dtype)
+    return _buffer
+
+
 def makeimage(args):
     """Make initial/prior image for BSMEM from existing image."""
     if not args.overwrite and os.path.exists(args.outputimage):
         sys.exit("Not creating '%s' as it already exists." % args.outputimage)
-    with fits.open(args.inputimage) as hdulist:
-        if args.blank is None:
-            outhdu = makesf(hdulist[0], args.fwhm, args.threshold)
-        else:
-            outhdu = makesf(hdulist[0], args.fwhm, args.threshold, blank=args.blank)
-        copyheader(hdulist[0], outhdu)
-        outhdu.writeto(args.outputimage, overwrite=args.overwrite)
+    makeprior(
+        args.inputimage,
+        args.outputimage,
+        args.fwhm,
+        args.threshold,
+        blank=args.blank,
+        overwrite=args.overwrite,
+        lowmem=args.low_memory,
+        dtype=args.dtype,
+    )
+
+
+def expand_inputs(patterns: Iterable[str], listfiles: Iterable[str] = ()) -> List[str]:
+    """Return input filenames from glob patterns and list files.
+
+    List files contain one filename or glob pattern per line; blank lines
+    and lines starting with '#' are ignored. Duplicates are removed.
+
+    Raises:
+      OSError
+
+    """
+    patterns = list(patterns)
+    for listfile in listfiles:
+        with open(listfile) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(line)
+    result: List[str] = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        result += [name for name in matches if name not in result]
+    return result
+
+
+def get_outputimage(template: str, inputimage: str) -> str:
+    """Return output filename for input filename.
+
+    The template may use {dir}, {name}, {stem} and {ext}, which are the
+    directory, filename, filename without extension and extension of the
+    input image. A template that names an existing directory or ends with
+    a path separator is treated as {template}/{name}.
+
+    """
+    if template.endswith(os.sep) or os.path.isdir(template):
+        template = os.path.join(template, "{name}")
+    dirname, name = os.path.split(inputimage)
+    stem, ext = os.path.splitext(name)
+    return template.format(dir=dirname or ".", name=name, stem=stem, ext=ext)
+
+
+def _is_prior(filename: str) -> bool:
+    try:
+        fits.getval(filename, HASH_KEYWORD)
+    except (KeyError, OSError):
+        return False
+    return True
+
+
+def exclude_outputs(inputs: Sequence[str], template: str) -> List[str]:
+    """Return input filenames that are not outputs of this script.
+
+    Inputs that are the output filename of another input, or whose
+    primary header has the HASH_KEYWORD keyword written by makeprior(),
+    are excluded.
+
+    """
+    outputs = {os.path.abspath(get_outputimage(template, name)) for name in inputs}
+    return [
+        name
+        for name in inputs
+        if os.path.abspath(name) not in outputs and not _is_prior(name)
+    ]
+
+
+def is_up_to_date(
+    inputimage, outputimage, fwhm, threshold, blank=None, check="mtime", dtype=None
+) -> bool:
+    """Return whether output image is up to date with respect to input.
+
+    Args:
+      inputimage:  Input FITS image filename.
+      outputimage: Output FITS image filename.
+      fwhm:        FWHM of Gaussian to convolve with in mas.
+      threshold:   Threshold relative to peak intensity.
+      blank:       Replacement value for pixels below threshold.
+      check:       "mtime" to compare modification times, or "hash" to
+                   compare hash of input and parameters with that recorded
+                   in the output header.
+      dtype:       Output precision, or None for the default.
+
+    """
+    try:
+        if check == "hash":
+            recorded = fits.getval(outputimage, HASH_KEYWORD)
+            return recorded == get_hash(inputimage, fwhm, threshold, blank, dtype)
+        return os.stat(outputimage).st_mtime >= os.stat(inputimage).st_mtime
+    except (KeyError, OSError):
+        return False
+
+
+def processimage(
+    inputimage,
+    outputimage,
+    fwhm,
+    threshold,
+    blank,
+    overwrite,
+    check,
+    lowmem=False,
+    dtype=None,
+) -> BatchResult:
+    """Make prior image for one input in batch mode, catching errors."""
+    try:
+        if not overwrite and is_up_to_date(
+            inputimage, outputimage, fwhm, threshold, blank, check, dtype
+        ):
+            return BatchResult(inputimage, outputimage, True, None)
+        makeprior(
+            inputimage,
+            outputimage,
+            fwhm,
+            threshold,
+            blank,
+            overwrite=True,
+            lowmem=lowmem,
+            dtype=dtype,
+        )
+    except Exception as e:
+        return BatchResult(inputimage, outputimage, False, f"{type(e).__name__}: {e}")
+    return BatchResult(inputimage, outputimage, False, None)
+
+
+def makebatch(args) -> List[BatchResult]:
+    """Make prior images for many inputs, reporting outcome of each."""
+    inputs = exclude_outputs(
+        expand_inputs(args.inputimage, args.list or []), args.output
+    )
+    if len(inputs) == 0:
+        sys.exit("No input images")
+    outputs = [get_outputimage(args.output, name) for name in inputs]
+    if len(set(outputs)) < len(outputs):
+        sys.exit("Output template '%s' gives duplicate filenames" % args.output)
+    options = (args.blank, args.overwrite, args.check, args.low_memory, args.dtype)
+    jobs = [
+        (i, o, args.fwhm, args.threshold, *options) for i, o in zip(inputs, outputs)
+    ]
+    results = []
+    if args.workers <= 1 or len(jobs) == 1:
+        for job in jobs:
+            results.append(processimage(*job))
+            _report(results[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(processimage, *job) for job in jobs]
+            for future in as_completed(futures):
+                _report(future.result())
+            results = [future.result() for future in futures]
+    failed = sum(r.error is not None for r in results)
+    skipped = sum(r.skipped for r in results)
+    print(
+        "%d made, %d up to date, %d failed"
+        % (len(results) - failed - skipped, skipped, failed),
+        file=sys.stderr,
+    )
+    return results
+
+
+def _report(result: BatchResult) -> None:
+    if result.error is not None:
+        print(f"FAILED {result.inputimage}: {result.error}", file=sys.stderr)
+    elif result.skipped:
+        print(f"up to date {result.outputimage}", file=sys.stderr)
+    else:
+        print(f"{result.inputimage} -> {result.outputimage}", file=sys.stderr)
+
+
+def _add_memory_arguments(parser):
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Memory-map input images and reuse output buffers",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_const",
+        const="float32",
+        dest="dtype",
+        help="Compute and write output images in single precision",
+    )
 
 
 def create_parser():
     """Return new ArgumentParser instance for this script."""
-    parser = argparse.ArgumentParser(description="Make initial/prior image for BSMEM")
+    parser = argparse.ArgumentParser(
+        description="Make initial/prior image for BSMEM",
+        epilog="Use '%(prog)s --batch --help' for batch mode.",
+    )
     parser.add_argument("-V", "--version", action="version", version=__version__)
     parser.add_argument(
         "-o", "--overwrite", action="store_true", help="Overwrite existing file"
@@ -49,7 +336,8 @@ def create_parser():
     parser.add_argument(
         "-b", "--blank", type=float, help="Replacement value for pixels below threshold"
     )
-    parser.add_argument("inputimage", help="Input FITS image")
+    _add_memory_arguments(parser)
+    parser.add_argument("inputimage", help="Input FITS image or image cube")
     parser.add_argument("outputimage", help="Output FITS image")
     parser.add_argument(
         "fwhm", type=float, help="FWHM of Gaussian to convolve with in mas"
@@ -60,8 +348,80 @@ def create_parser():
     return parser
 
 
+def create_batch_parser():
+    """Return new ArgumentParser instance for batch mode of this script."""
+    parser = argparse.ArgumentParser(
+        description="Make initial/prior images for BSMEM from many images"
+    )
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+    parser.add_argument(
+        "--batch", action="store_true", required=True, help="Select batch mode"
+    )
+    parser.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="Remake output images even if up to date",
+    )
+    parser.add_argument(
+        "-b", "--blank", type=float, help="Replacement value for pixels below threshold"
+    )
+    _add_memory_arguments(parser)
+    parser.add_argument(
+        "-f",
+        "--fwhm",
+        type=float,
+        required=True,
+        help="FWHM of Gaussian to convolve with in mas",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        required=True,
+        help="Threshold relative to peak intensity",
+    )
+    parser.add_argument(
+        "-l",
+        "--list",
+        action="append",
+        metavar="FILE",
+        help="File listing input images, one per line (repeatable)",
+    )
+    parser.add_argument(
+        "--output",
+        default=DEFAULT_TEMPLATE,
+        metavar="TEMPLATE",
+        help="Output filename template using {dir}, {name}, {stem} and {ext}, "
+        "or output directory (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--check",
+        choices=["mtime", "hash"],
+        default="mtime",
+        help="How to decide whether an output image is up to date",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of worker processes",
+    )
+    parser.add_argument(
+        "inputimage", nargs="*", help="Input FITS images or glob patterns"
+    )
+    return parser
+
+
 def main():
     """Run application."""
+    if "--batch" in sys.argv[1:]:
+        args = create_batch_parser().parse_args()
+        results = makebatch(args)
+        if any(r.error is not None for r in results):
+            sys.exit(1)
+        return
     parser = create_parser()
     args = parser.parse_args()
     try:
@@ -0,0 +1,435 @@
+"""Python module to pre-select OIFITS data for bsmem runs.
+
+bsmem reads the whole OIFITS file and then discards data outside the
+requested wavelength range and uv radius. When many runs select from the
+same large file, e.g. one per wavelength channel, it is quicker to read
+the file once, index the OI_VIS2, OI_T3 and OI_VIS rows, and pass each
+bsmem run a compact file containing only the channels and rows it could
+use. The selection options are still passed to bsmem, so the subset need
+only be a superset of the data bsmem selects.
+
+Attributes:
+  SUBSET_DIR (str):  Default directory for subset files, from
+                     $OIRUNNER_SUBSET_DIR if set.
+  MAX_INDEXES (int): Default maximum number of data file indexes to keep
+                     in memory.
+
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, TYPE_CHECKING, Tuple
+
+from . import timing
+from .lazy import lazy_import
+from .staging import SCRATCH_DIR
+
+if TYPE_CHECKING:
+    from astropy.io import fits
+    import numpy as np
+else:
+    fits = lazy_import("astropy.io.fits")
+    np = lazy_import("numpy")
+
+SUBSET_DIR = os.environ.get(
+    "OIRUNNER_SUBSET_DIR", os.path.join(SCRATCH_DIR, "oirunner_subsets")
+)
+MAX_INDEXES = 4
+
+# Data tables indexed by uv radius
+_DATA_TABLES = ["OI_VIS2", "OI_T3", "OI_VIS"]
+# Columns with one element per wavelength channel
+_CHANNEL_COLUMNS = {
+    "VIS2DATA",
+    "VIS2ERR",
+    "T3AMP",
+    "T3AMPERR",
+    "T3PHI",
+    "T3PHIERR",
+    "VISAMP",
+    "VISAMPERR",
+    "VISPHI",
+    "VISPHIERR",
+    "RVIS",
+    "RVISERR",
+    "IVIS",
+    "IVISERR",
+    "FLAG",
+}
+# Columns with one element per row
+_ROW_COLUMNS = {
+    "TARGET_ID",
+    "TIME",
+    "MJD",
+    "INT_TIME",
+    "UCOORD",
+    "VCOORD",
+    "U1COORD",
+    "V1COORD",
+    "U2COORD",
+    "V2COORD",
+    "STA_INDEX",
+}
+# Relative tolerance on uv radius cut, so that rounding cannot drop data
+_UV_TOLERANCE = 1e-9
+
+
+class SelectionStats(NamedTuple):
+    """Data pre-selection statistics.
+
+    Attributes:
+      indexed: Number of data files read and indexed.
+      written: Number of subset files written.
+      reused:  Number of times an existing subset file was reused.
+      seconds: Total time spent indexing and writing subsets.
+
+    """
+
+    indexed: int
+    written: int
+    reused: int
+    seconds: float
+
+
+class _IndexedTable(NamedTuple):
+    position: int
+    insname: str
+    # Row numbers sorted by increasing baseline length
+    order: np.ndarray
+    # Longest baseline of each row (m), in the same order
+    baseline: np.ndarray
+    # Whether wavelength channels may be removed from this table
+    subsettable: bool
+
+
+def _get_baseline(hdu: fits.BinTableHDU) -> np.ndarray:
+    data = hdu.data
+    if hdu.name == "OI_T3":
+        u1, v1 = data["U1COORD"], data["V1COORD"]
+        u2, v2 = data["U2COORD"], data["V2COORD"]
+        return np.maximum.reduce(
+            [np.hypot(u1, v1), np.hypot(u2, v2), np.hypot(u1 + u2, v1 + v2)]
+        )
+    return np.hypot(data["UCOORD"], data["VCOORD"])
+
+
+class DataIndex:
+    """In-memory OIFITS data indexed by wavelength and uv radius.
+
+    Attributes:
+      datafile: Input OIFITS data filename.
+
+    """
+
+    def __init__(self, datafile: str):
+        """Read and index OIFITS file.
+
+        Raises:
+          KeyError, OSError
+
+        """
+        self.datafile = datafile
+        self._lock = threading.Lock()
+        with fits.open(datafile, memmap=False) as hdulist:
+            self._hdulist = fits.HDUList([hdu.copy() for hdu in hdulist])
+        self._waves: Dict[str, np.ndarray] = {}
+        self._tables: List[_IndexedTable] = []
+        for hdu in self._hdulist[1:]:
+            if hdu.name == "OI_WAVELENGTH":
+                self._waves[hdu.header["INSNAME"]] = np.asarray(
+                    hdu.data["EFF_WAVE"], float
+                )
+        for position, hdu in enumerate(self._hdulist):
+            if hdu.name not in _DATA_TABLES:
+                continue
+            insname = hdu.header["INSNAME"]
+            if insname not in self._waves:
+                raise KeyError(
+                    "No OI_WAVELENGTH table for INSNAME '%s' in '%s'"
+                    % (insname, datafile)
+                )
+            baseline = _get_baseline(hdu)
+            order = np.argsort(baseline, kind="stable")
+            subsettable = set(hdu.columns.names) <= _CHANNEL_COLUMNS | _ROW_COLUMNS
+            self._tables.append(
+                _IndexedTable(position, insname, order, baseline[order], subsettable)
+            )
+        # Channels can only be removed if every table using them allows it
+        for table in self._tables:
+            if not table.subsettable:
+                self._tables = [
+                    t._replace(subsettable=False) if t.insname == table.insname else t
+                    for t in self._tables
+                ]
+
+    def select(
+        self,
+        wav: Optional[Tuple[float, float]] = None,
+        uvmax: Optional[float] = None,
+    ) -> fits.HDUList:
+        """Return subset of data that bsmem could select.
+
+        Wavelength channels outside wav are removed, as are data table rows
+        whose uv radius exceeds uvmax at every remaining wavelength.
+
+        Args:
+          wav:   Min and max wavelengths to select (nm).
+          uvmax: Maximum uv radius to select (waves).
+
+        Returns:
+          New HDUList, sharing unmodified HDUs with the index.
+
+        Raises:
+          ValueError
+
+        """
+        chans = {}
+        for insname, waves in self._waves.items():
+            if wav is None:
+                chans[insname] = np.arange(len(waves))
+            else:
+                mask = (waves >= wav[0] * 1e-9) & (waves <= wav[1] * 1e-9)
+                chans[insname] = np.flatnonzero(mask)
+        replace: Dict[int, Optional[fits.BinTableHDU]] = {}
+        npoints = 0
+        for table in self._tables:
+            hdu = self._hdulist[table.position]
+            waves = self._waves[table.insname]
+            selected = chans[table.insname]
+            if len(selected) == 0:
+                replace[table.position] = None
+                continue
+            if uvmax is None:
+                rows = np.arange(len(table.order))
+            else:
+                limit = uvmax * (1 + _UV_TOLERANCE) * waves[selected].max()
+                end = np.searchsorted(table.baseline, limit, side="right")
+                rows = np.sort(table.order[:end])
+            if len(rows) == 0:
+                replace[table.position] = None
+                continue
+            npoints += len(rows) * len(selected)
+            if not table.subsettable:
+                selected = np.arange(len(waves))
+            replace[table.position] = _subset_table(hdu, rows, selected, len(waves))
+        if npoints == 0:
+            raise ValueError(
+                "No data selected from '%s' (wav=%s, uvmax=%s)"
+                % (self.datafile, wav, uvmax)
+            )
+        result = fits.HDUList()
+        for position, hdu in enumerate(self._hdulist):
+            if hdu.name == "OI_WAVELENGTH":
+                insname = hdu.header["INSNAME"]
+                if len(chans[insname]) == 0:
+                    continue
+                if all(t.subsettable for t in self._tables if t.insname == insname):
+                    hdu = _subset_rows(hdu, chans[insname])
+                result.append(hdu)
+            elif position in replace:
+                newhdu = replace[position]
+                if newhdu is not None:
+                    result.append(newhdu)
+            else:
+                result.append(hdu)
+        return result
+
+    def write(
+        self,
+        filename: str,
+        wav: Optional[Tuple[float, float]] = None,
+        uvmax: Optional[float] = None,
+    ) -> None:
+        """Write subset of data that bsmem could select to file.
+
+        Raises:
+          OSError, ValueError
+
+        """
+        with self._lock:
+            self.select(wav, uvmax).writeto(filename, overwrite=True)
+
+
+def _subset_rows(hdu: fits.BinTableHDU, rows: np.ndarray) -> fits.BinTableHDU:
+    return fits.BinTableHDU(data=hdu.data[rows], header=hdu.header)
+
+
+def _subset_table(
+    hdu: fits.BinTableHDU, rows: np.ndarray, chans: np.ndarray, nwave: int
+) -> fits.BinTableHDU:
+    if len(rows) == len(hdu.data) and len(chans) == nwave:
+        return hdu
+    if len(chans) == nwave:
+        return _subset_rows(hdu, rows)
+    columns = []
+    for col in hdu.columns:
+        array = hdu.data[col.name][rows]
+        fmt = col.format
+        if col.name in _CHANNEL_COLUMNS:
+            array = array.reshape(len(rows), nwave)[:, chans]
+            fmt = "%d%s" % (len(chans), col.format.format)
+        columns.append(
+            fits.Column(name=col.name, format=fmt, unit=col.unit, array=array)
+        )
+    return fits.BinTableHDU.from_columns(columns, header=hdu.header)
+
+
+def _get_stat(datafile: str) -> Tuple[str, int, int]:
+    st = os.stat(datafile)
+    return os.path.abspath(datafile), st.st_mtime_ns, st.st_size
+
+
+class DataSelector:
+    """Write pre-selected subsets of OIFITS files, reusing existing subsets.
+
+    Data files are identified by absolute path, modification time and size
+    rather than by content, so that a large file need not be read again
+    to find an existing subset. Subset files are kept in subsetdir until
+    removed by clear().
+
+    Attributes:
+      subsetdir:  Directory for subset files.
+      maxindexes: Maximum number of data file indexes to keep in memory.
+
+    """
+
+    def __init__(self, subsetdir: Optional[str] = None, maxindexes: int = MAX_INDEXES):
+        """Create selector, making subset directory if necessary."""
+        self.subsetdir = SUBSET_DIR if subsetdir is None else subsetdir
+        self.maxindexes = maxindexes
+        self._indexes: "OrderedDict[Tuple[str, int, int], DataIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._indexed = 0
+        self._written = 0
+        self._reused = 0
+        self._seconds = 0.0
+        os.makedirs(self.subsetdir, exist_ok=True)
+
+    def __reduce__(self):
+        """Pickle by subset directory, e.g. for process pools."""
+        return (self.__class__, (self.subsetdir, self.maxindexes))
+
+    def index(self, datafile: str) -> DataIndex:
+        """Return index of data file, reading it if not already indexed.
+
+        Raises:
+          KeyError, OSError
+
+        """
+        key = _get_stat(datafile)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        with timing.span("select.index", datafile=datafile):
+            start = time.perf_counter()
+            index = DataIndex(datafile)
+            elapsed = time.perf_counter() - start
+        logging.info("Indexed '%s' in %.3f s" % (datafile, elapsed))
+        with self._lock:
+            self._indexes[key] = index
+            self._indexed += 1
+            self._seconds += elapsed
+            while len(self._indexes) > self.maxindexes:
+                self._indexes.popitem(last=False)
+        return index
+
+    def get_subsetfile(
+        self,
+        datafile: str,
+        wav: Optional[Tuple[float, float]] = None,
+        uvmax: Optional[float] = None,
+    ) -> str:
+        """Return name of subset file for data file and selection.
+
+        Raises:
+          OSError
+
+        """
+        h = hashlib.sha256()
+        h.update(repr((_get_stat(datafile), wav, uvmax)).encode("utf-8"))
+        stem, _ = os.path.splitext(os.path.basename(datafile))
+        return os.path.join(self.subsetdir, f"{stem}_{h.hexdigest()[:16]}.oifits")
+
+    def subset(
+        self,
+        datafile: str,
+        wav: Optional[Tuple[float, float]] = None,
+        uvmax: Optional[float] = None,
+    ) -> str:
+        """Return filename of subset of data file that bsmem could select.
+
+        Args:
+          datafile: Input OIFITS data filename.
+          wav:      Min and max wavelengths to select (nm).
+          uvmax:    Maximum uv radius to select (waves).
+
+        Raises:
+          KeyError, OSError, ValueError
+
+        """
+        if wav is not None:
+            wav = (float(wav[0]), float(wav[1]))
+        if uvmax is not None:
+            uvmax = float(uvmax)
+        filename = self.get_subsetfile(datafile, wav, uvmax)
+        if os.path.exists(filename):
+            with self._lock:
+                self._reused += 1
+            return filename
+        index = self.index(datafile)
+        with timing.span("select.write", datafile=datafile, wav=wav, uvmax=uvmax):
+            start = time.perf_counter()
+            fd, tempname = tempfile.mkstemp(suffix=".oifits", dir=self.subsetdir)
+            os.close(fd)
+            try:
+                index.write(tempname, wav, uvmax)
+                os.replace(tempname, filename)
+            except BaseException:
+                os.remove(tempname)
+                raise
+            elapsed = time.perf_counter() - start
+        logging.info("Wrote data subset '%s' in %.3f s" % (filename, elapsed))
+        with self._lock:
+            self._written += 1
+            self._seconds += elapsed
+        return filename
+
+    def clear(self) -> None:
+        """Forget indexes and remove all subset files in subsetdir."""
+        with self._lock:
+            self._indexes.clear()
+            for name in os.listdir(self.subsetdir):
+                if name.endswith(".oifits"):
+                    try:
+                        os.remove(os.path.join(self.subsetdir, name))
+                    except FileNotFoundError:
+                        pass
+
+    def stats(self) -> SelectionStats:
+        """Return pre-selection statistics."""
+        with self._lock:
+            return SelectionStats(
+                self._indexed, self._written, self._reused, self._seconds
+            )
+
+
+_default_selector: Optional[DataSelector] = None
+_default_lock = threading.Lock()
+
+
+def get_default_selector() -> DataSelector:
+    """Return selector using the default subset directory."""
+    global _default_selector
+    with _default_lock:
+        if _default_selector is None:
+            _default_selector = DataSelector()
+        return _default_selector
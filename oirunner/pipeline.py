@@ -0,0 +1,281 @@
+"""Python module to run BSMEM iteratively through a configurable pipeline.
+
+Each stage after the first uses the previous stage's output image, blurred
+and thresholded by makesf(), as its initial/prior image. The output image
+of each stage is read once and kept in memory, both to make the next prior
+image and to measure how much the image changed, so that the pipeline can
+stop once successive images agree.
+
+Attributes:
+  DEFAULT_STAGES (List[Stage]): Stages equivalent to reconst_grey_2step().
+
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TYPE_CHECKING,
+    Tuple,
+    Union,
+)
+
+from .lazy import lazy_import
+from .priorimage import get_pixelsize, makesf
+from .runbsmem import (
+    BsmemResult,
+    DEFAULT_DIM,
+    DEFAULT_MT,
+    DEFAULT_MW,
+    _get_outputfile,
+    _read_image,
+    run_bsmem_using_image,
+    run_bsmem_using_model,
+)
+
+if TYPE_CHECKING:
+    from astropy.io import fits
+    import numpy as np
+else:
+    fits = lazy_import("astropy.io.fits")
+    np = lazy_import("numpy")
+
+
+class Stage(NamedTuple):
+    """Settings for one bsmem run in a pipeline.
+
+    Attributes:
+      uvmax:     Maximum uv radius to select (waves), or None for all data.
+      fwhm:      FWHM of Gaussian to convolve previous output with (mas).
+      threshold: Threshold (relative to peak) to apply to previous output.
+      options:   Additional keyword arguments for run_bsmem_using_model()
+                 or run_bsmem_using_image() for this stage only.
+
+    fwhm and threshold are ignored for the first stage.
+
+    """
+
+    uvmax: Optional[float] = None
+    fwhm: float = 1.25
+    threshold: float = 0.05
+    options: Optional[Dict[str, Any]] = None
+
+
+class StageResult(NamedTuple):
+    """Outcome of one pipeline stage.
+
+    Attributes:
+      stage:      Stage number, starting from 1.
+      outputfile: Output FITS filename.
+      change:     Difference from previous stage output (see image_change()),
+                  or None for the first stage.
+      result:     Result of bsmem run, whose image is not kept so that
+                  earlier stage images can be freed.
+
+    """
+
+    stage: int
+    outputfile: str
+    change: Optional[float]
+    result: BsmemResult
+
+
+DEFAULT_STAGES = [Stage(uvmax=1.1e8), Stage()]
+
+
+def image_change(image1: np.ndarray, image2: np.ndarray) -> float:
+    """Return difference between images after normalising total flux.
+
+    The difference is half the sum of absolute differences between the
+    flux-normalised images, which ranges from 0 (identical) to 1 (no
+    overlap).
+
+    Raises:
+      ValueError
+
+    """
+    if image1.shape != image2.shape:
+        raise ValueError(f"Image shapes differ: {image1.shape} {image2.shape}")
+    flux1 = image1.sum(dtype=np.float64)
+    flux2 = image2.sum(dtype=np.float64)
+    if flux1 == 0.0 or flux2 == 0.0:
+        return np.inf
+    return 0.5 * float(np.abs(image1 / flux1 - image2 / flux2).sum())
+
+
+def run_pipeline(
+    datafile: str,
+    stages: Sequence[Stage] = DEFAULT_STAGES,
+    pixelsize: Optional[float] = None,
+    dim: int = DEFAULT_DIM,
+    modeltype: int = DEFAULT_MT,
+    modelwidth: float = DEFAULT_MW,
+    imagehdu: Optional[Union[fits.PrimaryHDU, fits.ImageHDU]] = None,
+    wav: Optional[Tuple[float, float]] = None,
+    tolerance: Optional[float] = None,
+    **kwargs,
+) -> List[StageResult]:
+    """Run bsmem once per stage, each using the previous output as prior.
+
+    Args:
+      datafile:   Input OIFITS data filename.
+      stages:     Settings for each bsmem run.
+      pixelsize:  Reconstructed image pixel size for 1st run (mas), later
+                  runs use the pixel size of the previous output.
+      dim:        Reconstructed image width for 1st run (pixels).
+      modeltype:  Initial/prior image model type for 1st run (0-4).
+      modelwidth: Initial/prior image model width for 1st run (mas).
+      imagehdu:   Initial/prior image for 1st run, overrides model, pixelsize
+                  and dim.
+      wav:        Min and max wavelengths to select (nm).
+      tolerance:  Stop after a stage whose output differs from the previous
+                  stage output by less than this (see image_change()).
+
+    Keyword arguments accepted by run_bsmem_using_model() and
+    run_bsmem_using_image() may also be used, and apply to every stage.
+
+    Returns:
+      Result for each stage run.
+
+    Raises:
+      ValueError
+
+    """
+    if len(stages) == 0:
+        raise ValueError("Pipeline must have at least one stage")
+    results: List[StageResult] = []
+    previous: Optional[fits.PrimaryHDU] = None
+    for i, stage in enumerate(stages, start=1):
+        outputfile = _get_outputfile(datafile, i, wav)
+        stagekwargs = dict(kwargs)
+        if stage.uvmax is not None:
+            stagekwargs["uvmax"] = stage.uvmax
+        stagekwargs.update(stage.options or {})
+        result: BsmemResult
+        if previous is not None:
+            prior = makesf(previous, stage.fwhm, stage.threshold)
+            result = run_bsmem_using_image(
+                datafile,
+                outputfile,
+                prior.data.shape[0],
+                get_pixelsize(prior),
+                prior,
+                wav=wav,
+                **stagekwargs,
+            )
+        elif imagehdu is not None:
+            result = run_bsmem_using_image(
+                datafile,
+                outputfile,
+                imagehdu.data.shape[0],
+                get_pixelsize(imagehdu),
+                imagehdu,
+                wav=wav,
+                **stagekwargs,
+            )
+        else:
+            result = run_bsmem_using_model(
+                datafile,
+                outputfile,
+                dim,
+                modeltype,
+                modelwidth,
+                pixelsize=pixelsize,
+                wav=wav,
+                **stagekwargs,
+            )
+        output = _read_image(outputfile)
+        change = None
+        if previous is not None:
+            change = image_change(previous.data, output.data)
+            logging.info(f"Stage {i} image change = {change:g}")
+        results.append(StageResult(i, outputfile, change, result))
+        if change is not None and tolerance is not None and change < tolerance:
+            if i < len(stages):
+                logging.info(f"Image converged, skipping {len(stages) - i} stage(s)")
+            break
+        previous = output
+    return results
+
+
+def reconst_grey_nstep(
+    datafile: str,
+    stages: Sequence[Stage] = DEFAULT_STAGES,
+    pixelsize: Optional[float] = None,
+    dim: int = DEFAULT_DIM,
+    modeltype: int = DEFAULT_MT,
+    modelwidth: float = DEFAULT_MW,
+    wav: Optional[Tuple[float, float]] = None,
+    tolerance: Optional[float] = None,
+    **kwargs,
+) -> BsmemResult:
+    """Reconstruct a grey image by running bsmem once per stage.
+
+    Args:
+      datafile:   Input OIFITS data filename.
+      stages:     Settings for each bsmem run.
+      pixelsize:  Reconstructed image pixel size (mas).
+      dim:        Reconstructed image width (pixels).
+      modeltype:  Initial/prior image model type for 1st run (0-4).
+      modelwidth: Initial/prior image model width for 1st run (mas).
+      wav:        Min and max wavelengths to select (nm).
+      tolerance:  Stop once successive images differ by less than this.
+
+    Keyword arguments accepted by run_pipeline() may also be used.
+
+    Returns:
+       Result of last stage run, path-like giving output FITS filename.
+
+    """
+    results = run_pipeline(
+        datafile,
+        stages,
+        pixelsize=pixelsize,
+        dim=dim,
+        modeltype=modeltype,
+        modelwidth=modelwidth,
+        wav=wav,
+        tolerance=tolerance,
+        **kwargs,
+    )
+    return results[-1].result
+
+
+def reconst_grey_nstep_using_image(
+    datafile: str,
+    imagefile: str,
+    stages: Sequence[Stage] = DEFAULT_STAGES,
+    wav: Optional[Tuple[float, float]] = None,
+    tolerance: Optional[float] = None,
+    **kwargs,
+) -> BsmemResult:
+    """Reconstruct a grey image by running bsmem once per stage using a prior.
+
+    Args:
+      datafile:   Input OIFITS data filename.
+      imagefile:  Input initial/prior FITS image for 1st run.
+      stages:     Settings for each bsmem run.
+      wav:        Min and max wavelengths to select (nm).
+      tolerance:  Stop once successive images differ by less than this.
+
+    Keyword arguments accepted by run_pipeline() may also be used.
+
+    Returns:
+       Result of last stage run, path-like giving output FITS filename.
+
+    """
+    results = run_pipeline(
+        datafile,
+        stages,
+        imagehdu=_read_image(imagefile),
+        wav=wav,
+        tolerance=tolerance,
+        **kwargs,
+    )
+    return results[-1].result
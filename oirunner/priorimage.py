@@ -1,21 +1,35 @@
 """Python module to create initial/prior model images for BSMEM.
 
 Attributes:
-  MAS_TO_DEG (float): Conversion factor from milliarcseconds to degrees.
+  MAS_TO_DEG (float):       Conversion factor from milliarcseconds to degrees.
+  KERNEL_CACHE_SIZE (int):  Maximum number of Gaussian kernels (and kernel
+                            FFTs) cached by gaussian_kernel() and blur().
 
 """
 
-import logging
-from typing import Union
-
-from astropy import wcs
-from astropy.io import fits
+from __future__ import annotations
 
-import numpy as np
-
-import scipy.signal
+import functools
+import logging
+from typing import Optional, TYPE_CHECKING, Tuple, Union
+
+from . import timing
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    from astropy import wcs
+    from astropy.io import fits
+    import numpy as np
+    from numpy.typing import DTypeLike
+    from scipy import fft
+else:
+    wcs = lazy_import("astropy.wcs")
+    fits = lazy_import("astropy.io.fits")
+    np = lazy_import("numpy")
+    fft = lazy_import("scipy.fft")
 
 MAS_TO_DEG = 1 / 3600 / 1000
+KERNEL_CACHE_SIZE = 32
 
 
 def get_pixelsize(imagehdu: Union[fits.PrimaryHDU, fits.ImageHDU]) -> float:
@@ -32,19 +46,120 @@ def get_pixelsize(imagehdu: Union[fits.PrimaryHDU, fits.ImageHDU]) -> float:
     return cdelt1 / MAS_TO_DEG
 
 
+@functools.lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def gaussian_kernel(sigma: float) -> np.ndarray:
+    """Return (cached, read-only) square Gaussian convolution kernel.
+
+    The kernel is int(6 * sigma) pixels wide and peaks at unity.
+
+    Args:
+      sigma: Standard deviation of Gaussian in pixels.
+
+    Raises:
+      ValueError
+
+    """
+    bw = int(6 * sigma)
+    if bw < 1:
+        raise ValueError("Gaussian sigma=%f pix is too small to blur with" % sigma)
+    x = np.arange(bw) - bw / 2
+    g = np.exp(-(x**2) / (2 * sigma * sigma))
+    kernel = np.outer(g, g)
+    kernel.flags.writeable = False
+    return kernel
+
+
+@functools.lru_cache(maxsize=KERNEL_CACHE_SIZE)
+def _kernel_fft(sigma: float, shape: Tuple[int, ...], dtype: str = "<f8") -> np.ndarray:
+    """Return (cached, read-only) real FFT of kernel padded for image shape."""
+    kernel = gaussian_kernel(sigma).astype(dtype)
+    fshape = _fft_shape(shape, kernel.shape)
+    kfft = fft.rfftn(kernel, fshape)
+    kfft.flags.writeable = False
+    return kfft
+
+
+def _fft_shape(shape: Tuple[int, ...], kshape: Tuple[int, ...]) -> Tuple[int, ...]:
+    return tuple(fft.next_fast_len(s + k - 1, True) for s, k in zip(shape, kshape))
+
+
+def blur(
+    data: np.ndarray,
+    sigma: float,
+    dtype: Optional[DTypeLike] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Convolve image or image cube with Gaussian using FFTs.
+
+    Equivalent to scipy.signal.convolve(data, gaussian_kernel(sigma), "same")
+    for a 2-D image. For an image cube, each plane (the last two axes) is
+    convolved, all planes at once using a shared kernel FFT.
+
+    Args:
+      data:  Input image or image cube.
+      sigma: Standard deviation of Gaussian in pixels.
+      dtype: Working precision, float64 (default) or float32.
+      out:   Array of the same shape as data to store the result in. The
+             padded FFT workspace is then released before returning,
+             rather than being kept alive by the returned view.
+
+    Returns:
+      New array (or out) with the same shape as data.
+
+    Raises:
+      ValueError
+
+    """
+    if data.ndim < 2:
+        raise ValueError("Cannot blur %d-D data" % data.ndim)
+    if dtype is None:
+        dtype = np.float64 if out is None else out.dtype
+    wdtype = np.dtype(dtype).newbyteorder("=")
+    kshape = gaussian_kernel(sigma).shape
+    shape = data.shape[-2:]
+    fshape = _fft_shape(shape, kshape)
+    axes = (-2, -1)
+    spectrum = fft.rfftn(data.astype(wdtype, copy=False), fshape, axes=axes)
+    spectrum *= _kernel_fft(sigma, shape, wdtype.str)
+    full = fft.irfftn(spectrum, fshape, axes=axes, overwrite_x=True)
+    del spectrum
+    start = [(k - 1) // 2 for k in kshape]
+    result = full[(Ellipsis,) + tuple(slice(i, i + n) for i, n in zip(start, shape))]
+    if out is None:
+        return result
+    np.copyto(out, result)
+    return out
+
+
 def makesf(
     imagehdu: Union[fits.PrimaryHDU, fits.ImageHDU],
     fwhm: float,
     threshold: float,
     blank: float = 1e-8,
+    dtype: Optional[DTypeLike] = None,
+    out: Optional[np.ndarray] = None,
 ) -> fits.PrimaryHDU:
     """Blur and threshold image for use as BSMEM prior model.
 
+    An image cube (e.g. with a spectral third axis) is processed plane by
+    plane, each plane being renormalised and thresholded relative to its
+    own peak. The input WCS, including any spectral axis, is copied to the
+    output cube.
+
+    The input data are only read, so may be memory-mapped. The blurred
+    image is renormalised and thresholded in place. To limit peak memory
+    use for large images, pass a preallocated output buffer and/or work
+    in single precision.
+
     Args:
-      imagehdu:  Input FITS image HDU.
+      imagehdu:  Input FITS image or image cube HDU.
       fwhm:      FWHM of Gaussian to convolve with in mas.
-      threshold: Threshold relative to peak intensity.
+      threshold: Threshold relative to peak intensity (of each plane).
       blank:     Replacement value for pixels below threshold.
+      dtype:     Working and output precision, float64 (default, or the
+                 dtype of out) or float32.
+      out:       Preallocated array for output image data, of the same
+                 shape as the input data.
 
     Returns:
       Output FITS image HDU.
@@ -53,46 +168,44 @@ def makesf(
       KeyError, ValueError
 
     """
-    # Get image attributes
-    dims = imagehdu.data.shape
-    pixelsize = get_pixelsize(imagehdu)
-    minvalue = imagehdu.data.min()
-    maxvalue = imagehdu.data.max()
-    logging.info("Image pixelsize = %f mas" % pixelsize)
-    logging.info("Image min = %g" % minvalue)
-    logging.info("Image max = %g" % maxvalue)
-
-    # Initialize parameters
-    sigma = fwhm / pixelsize / 2.3548
-    lowest = threshold * maxvalue
-
-    # Generate Gaussian
-    bw = int(6 * sigma)
-    blur = np.zeros((bw, bw), float)
-    for i in range(bw):
-        for j in range(bw):
-            blur[i, j] = np.exp(
-                -((i - bw / 2) ** 2 + (j - bw / 2) ** 2) / (2 * sigma * sigma)
-            )
-
-    # Convolve
-    logging.info("Blurring image with sigma=%f pix..." % sigma)
-    result = scipy.signal.convolve(imagehdu.data, blur, "same")
-    logging.info("...blur done")
-    # Renormalise
-    result = result * maxvalue / result.max()
-
-    # Threshold
-    logging.info("Thresholding image at %f (blank=%f)..." % (threshold, blank))
-    for i in range(dims[0]):
-        for j in range(dims[1]):
-            if result[i, j] < lowest:
-                result[i, j] = blank
-    logging.info("...threshold done")
-
-    # Create output HDU with WCS keywords
-    w = wcs.WCS(naxis=2)
-    w.wcs.cdelt = [pixelsize * MAS_TO_DEG, pixelsize * MAS_TO_DEG]
-    outhdu = fits.PrimaryHDU(data=result, header=w.to_header())
-    outhdu.header["HISTORY"] = "makesf fwhm=%f threshold=%f" % (fwhm, threshold)
+    with timing.span("makesf", fwhm=fwhm, threshold=threshold) as attributes:
+        # Get image attributes
+        pixelsize = get_pixelsize(imagehdu)
+        data = imagehdu.data
+        minvalue = data.min()
+        maxvalue = data.max()
+        # Peak of each plane, shaped to broadcast against data
+        planemax = data.max(axis=(-2, -1), keepdims=True)
+        attributes["shape"] = data.shape
+        logging.info("Image pixelsize = %f mas" % pixelsize)
+        logging.info("Image min = %g" % minvalue)
+        logging.info("Image max = %g" % maxvalue)
+
+        # Initialize parameters
+        sigma = fwhm / pixelsize / 2.3548
+        lowest = threshold * planemax
+
+        # Convolve
+        logging.info("Blurring image with sigma=%f pix..." % sigma)
+        with timing.span("makesf.blur", sigma=sigma):
+            result = blur(data, sigma, dtype, out)
+        logging.info("...blur done")
+
+        with timing.span("makesf.threshold"):
+            # Renormalise
+            result *= planemax / result.max(axis=(-2, -1), keepdims=True)
+
+            # Threshold
+            logging.info("Thresholding image at %f (blank=%f)..." % (threshold, blank))
+            np.copyto(result, blank, where=result < lowest)
+            logging.info("...threshold done")
+
+        # Create output HDU with WCS keywords
+        if data.ndim > 2:
+            w = wcs.WCS(imagehdu.header, naxis=data.ndim)
+        else:
+            w = wcs.WCS(naxis=2)
+            w.wcs.cdelt = [pixelsize * MAS_TO_DEG, pixelsize * MAS_TO_DEG]
+        outhdu = fits.PrimaryHDU(data=result, header=w.to_header())
+        outhdu.header["HISTORY"] = "makesf fwhm=%f threshold=%f" % (fwhm, threshold)
     return outhdu
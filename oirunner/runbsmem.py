@@ -5,61 +5,867 @@ Attributes:
   DEFAULT_DIM (int):  Default reconstructed image width.
   DEFAULT_MT (int):   Default model type.
   DEFAULT_MW (float): Default model width.
+  STDERR_LINES (int): Number of lines of bsmem stderr kept for error reports.
+  TERMINATE_GRACE (float): Time allowed for bsmem to exit when stopped early.
+  HASH_LENGTH (int):  Number of hex digits of parameter hash in output
+                      filenames, when requested.
 
 """
 
+from __future__ import annotations
+
+import collections
+import contextlib
+import copy
+import fcntl
+import hashlib
+import inspect
+import json
 import logging
 import os
+import resource
+import shutil
+import signal
 import tempfile
-from subprocess import CalledProcessError, PIPE, run
-from typing import Optional, Sequence, Tuple
-
-from astropy.io import fits
+import threading
+import time
+from subprocess import CalledProcessError, PIPE, Popen
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    IO,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    TYPE_CHECKING,
+    Tuple,
+)
 
+from . import timing
+from .bsmemcache import ResultCache, get_default_cache
+from .bsmemoutput import IterationParser, IterationRecord, parse_iterations
+from .checkpoint import JobManifest
+from .cpuslots import CpuSlot, SlotAllocator
+from .lazy import lazy_import
+from .oiselect import DataSelector
 from .priorimage import get_pixelsize, makesf
+from .staging import PriorStager, get_default_stager
+from .stopping import StopPolicy
 
+if TYPE_CHECKING:
+    from astropy.io import fits
+    import numpy as np
+else:
+    fits = lazy_import("astropy.io.fits")
+    np = lazy_import("numpy")
 
 BSMEM = "bsmem"
 DEFAULT_DIM = 128
 DEFAULT_MT = 3
 DEFAULT_MW = 10.0
+STDERR_LINES = 100
+TERMINATE_GRACE = 10.0
+HASH_LENGTH = 10
 
 
 def _get_outputfile(
-    datafile: str, iteration: int, wav: Optional[Tuple[float, float]]
+    datafile: str,
+    iteration: int,
+    wav: Optional[Tuple[float, float]],
+    tag: Optional[str] = None,
 ) -> str:
     dirname, basename = os.path.split(datafile)
     stem, _ = os.path.splitext(basename)
     if wav is None:
-        return os.path.join(dirname, f"bsmem_{iteration}_{stem}.fits")
+        name = f"bsmem_{iteration}_{stem}"
     else:
         meanwav = int((wav[0] + wav[1]) / 2)
-        return os.path.join(dirname, f"bsmem_{iteration}_{stem}_{meanwav}nm.fits")
+        name = f"bsmem_{iteration}_{stem}_{meanwav}nm"
+    if tag is not None:
+        name += f"_{tag}"
+    return os.path.join(dirname, name + ".fits")
 
 
-def run_bsmem(args: Sequence[str], fullstdout: Optional[str] = None) -> None:
-    """Run bsmem as subprocess and log result.
+def get_param_hash(params: Mapping[str, Any]) -> str:
+    """Return short hash of reconstruction parameters, for output filenames.
+
+    Parameter values are compared by their JSON representation, so that
+    e.g. wavelength ranges given as lists and tuples hash alike.
+
+    """
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:HASH_LENGTH]
+
+
+def _get_tag(
+    hash_names: bool, params: Dict[str, Any], kwargs: Dict[str, Any]
+) -> Optional[str]:
+    """Return hash of named and data selection parameters, if wanted."""
+    if not hash_names:
+        return None
+    selection = {k: v for k, v in kwargs.items() if k in _SELECTION_ARGS}
+    return get_param_hash({**params, **selection})
+
+
+def _get_selection_args(
+    wav: Optional[Tuple[float, float]] = None,
+    uvmax: Optional[float] = None,
+    use_t3: str = "all",
+    alpha: Optional[float] = None,
+    flux: Optional[float] = None,
+    v2a: Optional[float] = None,
+    v2b: Optional[float] = None,
+    t3ampa: Optional[float] = None,
+    t3ampb: Optional[float] = None,
+    t3phia: Optional[float] = None,
+    t3phib: Optional[float] = None,
+) -> List[str]:
+    args = []
+    if wav is not None:
+        args += [f"--wavmin={wav[0]}", f"--wavmax={wav[1]}"]
+    if uvmax is not None:
+        args += [f"--uvmax={uvmax}"]
+    args += [f"--use_t3={use_t3}"]
+    if alpha is not None:
+        args += ["--autoalpha=3", f"--alpha={alpha}"]
+    else:
+        args += ["--autoalpha=4"]
+    if flux is not None:
+        args += [f"--flux={flux}"]
+    if v2a is not None:
+        args += [f"--v2a={v2a}"]
+    if v2b is not None:
+        args += [f"--v2b={v2b}"]
+    if t3ampa is not None:
+        args += [f"--t3ampa={t3ampa}"]
+    if t3ampb is not None:
+        args += [f"--t3ampb={t3ampb}"]
+    if t3phia is not None:
+        args += [f"--t3phia={t3phia}"]
+    if t3phib is not None:
+        args += [f"--t3phib={t3phib}"]
+    return args
+
+
+_SELECTION_ARGS = list(inspect.signature(_get_selection_args).parameters)
+
+
+def get_model_args(
+    datafile: str,
+    outputfile: str,
+    dim: int,
+    modeltype: int,
+    modelwidth: float,
+    pixelsize: Optional[float] = None,
+    **kwargs,
+) -> List[str]:
+    """Return bsmem arguments for run using initial/prior model.
+
+    Args:
+      datafile:   Input OIFITS data filename.
+      outputfile: Output FITS filename.
+      dim:        Reconstructed image width (pixels).
+      modeltype:  Initial/prior image model type (0-4).
+      modelwidth: Initial/prior image model width (mas).
+      pixelsize:  Reconstructed image pixel size (mas).
+
+    Data selection and error scaling arguments accepted by
+    run_bsmem_using_model() (wav, uvmax, use_t3, alpha, flux, v2a, v2b,
+    t3ampa, t3ampb, t3phia, t3phib) may also be used.
+
+    """
+    args = [
+        BSMEM,
+        "--noui",
+        "--clobber",
+        f"--data={datafile}",
+        f"--output={outputfile}",
+        f"--dim={dim}",
+        f"--mt={modeltype}",
+        f"--mw={modelwidth}",
+    ]
+    if pixelsize is not None:
+        args += [f"--pixelsize={pixelsize}"]
+    return args + _get_selection_args(**kwargs)
+
+
+def get_image_args(
+    datafile: str,
+    outputfile: str,
+    dim: int,
+    pixelsize: float,
+    priorfile: str,
+    **kwargs,
+) -> List[str]:
+    """Return bsmem arguments for run using initial/prior image file.
+
+    Args:
+      datafile:   Input OIFITS data filename.
+      outputfile: Output FITS filename.
+      dim:        Reconstructed image width (pixels).
+      pixelsize:  Reconstructed image pixel size (mas).
+      priorfile:  Initial/prior FITS image filename.
+
+    Data selection and error scaling arguments accepted by
+    run_bsmem_using_image() (wav, uvmax, use_t3, alpha, flux, v2a, v2b,
+    t3ampa, t3ampb, t3phia, t3phib) may also be used.
+
+    """
+    args = [
+        BSMEM,
+        "--noui",
+        "--clobber",
+        f"--data={datafile}",
+        f"--output={outputfile}",
+        f"--dim={dim}",
+        f"--pixelsize={pixelsize}",
+        f"--sf={priorfile}",
+    ]
+    return args + _get_selection_args(**kwargs)
+
+
+def _read_image(filename: str) -> fits.PrimaryHDU:
+    """Return primary HDU of FITS image, read into memory."""
+    with timing.span("fits.read", filename=filename):
+        with fits.open(filename, memmap=False) as hdulist:
+            return fits.PrimaryHDU(hdulist[0].data, hdulist[0].header)
+
+
+def _get_fullstdout(outputfile: str) -> str:
+    return os.path.splitext(outputfile)[0] + "-out.txt"
+
+
+def _get_arg(args: Sequence[str], prefix: str) -> Optional[str]:
+    for arg in args:
+        if arg.startswith(prefix):
+            return arg[len(prefix) :]
+    return None
+
+
+def _lock_output(outputfile: str, blocking: bool = True) -> IO[str]:
+    """Wait for exclusive lock on output filename, returning open lock file.
+
+    The lock is held on a hidden file alongside the output, so that it
+    excludes other threads and processes writing the same output. The
+    lock file is left in place, since removing it would race with other
+    runs waiting for it.
+
+    Raises:
+      BlockingIOError: If not blocking and the lock is held elsewhere.
+
+    """
+    dirname, basename = os.path.split(outputfile)
+    f = open(os.path.join(dirname, f".{basename}.lock"), "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+def _unlock_output(f: IO[str]) -> None:
+    fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+
+
+def _make_workdir(
+    args: Sequence[str], fullstdout: Optional[str]
+) -> Tuple[str, List[str], Optional[str]]:
+    """Create private working directory for bsmem output files.
+
+    The directory is alongside the output file, so that finished files
+    can be renamed into place atomically.
+
+    Returns:
+      Working directory, and the arguments and stdout filename with
+      output files redirected into it.
+
+    """
+    outputfile = _get_arg(args, "--output=")
+    assert outputfile is not None
+    workdir = tempfile.mkdtemp(
+        prefix=".bsmem-", dir=os.path.dirname(outputfile) or os.curdir
+    )
+    workargs = [
+        (
+            "--output=" + os.path.join(workdir, os.path.basename(outputfile))
+            if arg.startswith("--output=")
+            else arg
+        )
+        for arg in args
+    ]
+    workstdout = None
+    if fullstdout is not None:
+        workstdout = os.path.join(workdir, os.path.basename(fullstdout))
+    return workdir, workargs, workstdout
+
+
+def _install(
+    workargs: Sequence[str],
+    workstdout: Optional[str],
+    args: Sequence[str],
+    fullstdout: Optional[str],
+) -> None:
+    """Rename finished output files from working directory into place."""
+    if workstdout is not None and fullstdout is not None:
+        if os.path.exists(workstdout):
+            os.replace(workstdout, fullstdout)
+    workoutput = _get_arg(workargs, "--output=")
+    outputfile = _get_arg(args, "--output=")
+    if workoutput is not None and outputfile is not None:
+        os.replace(workoutput, outputfile)
+
+
+def _isolate(
+    stack: contextlib.ExitStack, args: Sequence[str], fullstdout: Optional[str]
+) -> Tuple[List[str], Optional[str]]:
+    """Lock output and redirect it to working directory removed on exit.
+
+    Returns:
+      Arguments and stdout filename redirected into working directory.
+
+    """
+    outputfile = _get_arg(args, "--output=")
+    assert outputfile is not None
+    with timing.span("bsmem.lock", outputfile=outputfile):
+        stack.callback(_unlock_output, _lock_output(outputfile))
+    workdir, workargs, workstdout = _make_workdir(args, fullstdout)
+    stack.callback(shutil.rmtree, workdir, ignore_errors=True)
+    return workargs, workstdout
+
+
+def _kill(process: Popen) -> None:
+    """Kill subprocess and any children it has started."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _exitcode(status: int) -> int:
+    """Return Popen-style returncode for wait status."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class BsmemStopped(Exception):
+    """bsmem was stopped early and did not write an output image.
+
+    Attributes:
+      reason: Reason bsmem was stopped.
+
+    """
+
+    def __init__(self, reason: str):
+        """Create exception."""
+        super().__init__(f"bsmem stopped ({reason}) without writing output")
+        self.reason = reason
+
+
+class BsmemResult:
+    """Outcome of a bsmem run.
+
+    The instance is path-like, os.fspath() and str() giving the output
+    filename, so it may be passed wherever that filename is expected. The
+    output image is read when first accessed and then kept.
+
+    Attributes:
+      args:        Arguments for subprocess.
+      outputfile:  Output FITS filename, None if not given in args.
+      records:     Iteration records reported by bsmem, in order.
+      seconds:     Wall-clock time taken.
+      rusage:      Resource usage of subprocess, None if not measured (e.g.
+                   if bsmem was not run).
+      stop_reason: Reason bsmem was stopped early, else None.
+      reused:      True if output of a previous identical run was reused
+                   (see oirunner.bsmemcache and oirunner.checkpoint).
+
+    """
+
+    __slots__ = (
+        "args",
+        "outputfile",
+        "records",
+        "seconds",
+        "rusage",
+        "stop_reason",
+        "reused",
+        "_hdu",
+    )
+
+    def __init__(
+        self,
+        args: Sequence[str],
+        records: Sequence[IterationRecord] = (),
+        seconds: float = 0.0,
+        rusage: Optional[resource.struct_rusage] = None,
+        stop_reason: Optional[str] = None,
+        reused: bool = False,
+    ):
+        """Create result; the output image is not read until accessed."""
+        self.args = list(args)
+        self.outputfile = _get_arg(self.args, "--output=")
+        self.records = list(records)
+        self.seconds = seconds
+        self.rusage = rusage
+        self.stop_reason = stop_reason
+        self.reused = reused
+        self._hdu: Optional[fits.PrimaryHDU] = None
+
+    @property
+    def final(self) -> Optional[IterationRecord]:
+        """Record for last iteration, None if none reported."""
+        return self.records[-1] if self.records else None
+
+    @property
+    def iterations(self) -> int:
+        """Number of last iteration reported, zero if none."""
+        final = self.final
+        return 0 if final is None else final.iteration
+
+    @property
+    def hdu(self) -> fits.PrimaryHDU:
+        """Primary HDU of output image.
+
+        Raises:
+          OSError, ValueError
+
+        """
+        if self._hdu is None:
+            self._hdu = _read_image(self.__fspath__())
+        return self._hdu
+
+    @property
+    def image(self) -> np.ndarray:
+        """Output image data.
+
+        Raises:
+          OSError, ValueError
+
+        """
+        return self.hdu.data
+
+    def __fspath__(self) -> str:
+        """Return output filename.
+
+        Raises:
+          ValueError
+
+        """
+        if self.outputfile is None:
+            raise ValueError("bsmem run has no output file")
+        return self.outputfile
+
+    def __str__(self) -> str:
+        """Return output filename."""
+        return str(self.outputfile)
+
+    def __repr__(self) -> str:
+        """Return representation giving output file and cost of run."""
+        return "%s(%r, iterations=%d, seconds=%.3f)" % (
+            type(self).__name__,
+            self.outputfile,
+            self.iterations,
+            self.seconds,
+        )
+
+
+class BsmemProcess:
+    """bsmem subprocess whose output is parsed as it arrives.
+
+    Iterate over the instance to run bsmem and receive iteration records.
+    The subprocess may be stopped early by a wall-clock limit, a stop
+    policy, or by calling stop(); it is sent SIGTERM, then killed if it
+    has not exited after TERMINATE_GRACE seconds.
+
+    Attributes:
+      args:        Arguments for subprocess.
+      fullstdout:  Destination filename for full stdout.
+      timeout:     Wall-clock limit (seconds).
+      stop_policy: Called with each iteration record, returns reason to stop.
+      stop_reason: Reason bsmem was stopped early, else None.
+      slot:        CPUs and priorities for subprocess, or None.
+      returncode:  Exit status of subprocess, None while running.
+      rusage:      Resource usage of subprocess, None while running.
+      parse_seconds: Time spent parsing output.
+
+    """
+
+    def __init__(
+        self,
+        args: Sequence[str],
+        fullstdout: Optional[str] = None,
+        timeout: Optional[float] = None,
+        stop_policy: Optional[StopPolicy] = None,
+        slot: Optional[CpuSlot] = None,
+    ):
+        """Create instance; bsmem is not run until iterated over."""
+        self.args = list(args)
+        self.fullstdout = fullstdout
+        self.timeout = timeout
+        # Copy so that a policy can be shared by concurrent runs
+        self.stop_policy = copy.deepcopy(stop_policy)
+        self.stop_reason: Optional[str] = None
+        self.slot = slot
+        self.returncode: Optional[int] = None
+        self.rusage: Optional[resource.struct_rusage] = None
+        self.parse_seconds = 0.0
+        self._process: Optional[Popen] = None
+        self._exited = threading.Event()
+        self._lock = threading.Lock()
+
+    def stop(self, reason: str) -> None:
+        """Stop bsmem early, if running."""
+        with self._lock:
+            if self.stop_reason is not None or self._process is None:
+                return
+            self.stop_reason = reason
+        logging.warning(f"Stopping bsmem: {reason}")
+        try:
+            os.killpg(self._process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        timer = threading.Timer(TERMINATE_GRACE, self._kill_unless_exited)
+        timer.daemon = True
+        timer.start()
+
+    def _kill_unless_exited(self) -> None:
+        assert self._process is not None
+        if not self._exited.is_set():
+            _kill(self._process)
+
+    def __iter__(self) -> Iterator[IterationRecord]:
+        """Run bsmem, yielding iteration records as they arrive.
+
+        Raises:
+          CalledProcessError, OSError
+
+        """
+        logging.info("Running '%s'" % " ".join(self.args))
+        if self.stop_policy is not None:
+            self.stop_policy.reset()
+        parser = IterationParser()
+        errlines: Deque[str] = collections.deque(maxlen=STDERR_LINES)
+        with contextlib.ExitStack() as stack:
+            out = None
+            if self.fullstdout is not None:
+                out = stack.enter_context(open(self.fullstdout, "w"))
+            process = stack.enter_context(
+                Popen(
+                    self.args,
+                    stdout=PIPE,
+                    stderr=PIPE,
+                    encoding="utf-8",
+                    errors="replace",
+                    start_new_session=True,
+                    env=None if self.slot is None else self.slot.environ(),
+                    preexec_fn=None if self.slot is None else self.slot.preexec,
+                )
+            )
+            self._process = process
+            assert process.stdout is not None and process.stderr is not None
+            errthread = threading.Thread(
+                target=errlines.extend, args=(process.stderr,), daemon=True
+            )
+            errthread.start()
+            timer = None
+            if self.timeout is not None:
+                timer = threading.Thread(target=self._watch, daemon=True)
+                timer.start()
+            try:
+                for line in process.stdout:
+                    if out is not None:
+                        out.write(line)
+                    t0 = time.perf_counter()
+                    record = parser.feed(line)
+                    self.parse_seconds += time.perf_counter() - t0
+                    if record is not None:
+                        self._check(record)
+                        yield record
+                record = parser.finish()
+                if record is not None:
+                    yield record
+            except BaseException:
+                _kill(process)
+                raise
+            finally:
+                self.returncode = self._reap(process)
+                errthread.join()
+                if out is not None and self.stop_reason is not None:
+                    out.write(f"oirunner: bsmem stopped early ({self.stop_reason})\n")
+        last = "" if parser.last is None else parser.last.text
+        if self.returncode != 0 and self.stop_reason is None:
+            raise CalledProcessError(
+                self.returncode, self.args, last, "".join(errlines)
+            )
+        logging.info(f"Last iteration:\n{last}")
+
+    def _reap(self, process: Popen) -> int:
+        """Wait for subprocess to exit, recording its resource usage."""
+        try:
+            _, status, self.rusage = os.wait4(process.pid, 0)
+            returncode = process.returncode = _exitcode(status)
+        except ChildProcessError:
+            returncode = process.wait()
+        self._exited.set()
+        return returncode
+
+    def _check(self, record: IterationRecord) -> None:
+        if self.stop_policy is not None:
+            reason = self.stop_policy(record)
+            if reason is not None:
+                self.stop(reason)
+
+    def _watch(self) -> None:
+        assert self.timeout is not None
+        if not self._exited.wait(self.timeout):
+            self.stop("wall-clock limit of %g s exceeded" % self.timeout)
+
+
+def iter_bsmem(
+    args: Sequence[str], fullstdout: Optional[str] = None
+) -> Iterator[IterationRecord]:
+    """Run bsmem as subprocess, yielding iteration records as they arrive.
+
+    Output is read incrementally and written straight to fullstdout, so
+    the full log is never held in memory. Closing the generator before it
+    is exhausted kills the subprocess (and its process group).
 
     Args:
       args: Arguments for subprocess.
       fullstdout: Destination filename for full stdout.
 
+    Raises:
+      CalledProcessError, OSError
+
+    """
+    return iter(BsmemProcess(args, fullstdout))
+
+
+def _get_mtime(filename: Optional[str]) -> Optional[int]:
+    try:
+        return os.stat(filename).st_mtime_ns if filename is not None else None
+    except FileNotFoundError:
+        return None
+
+
+def _fetch_cached(
+    args: Sequence[str],
+    fullstdout: Optional[str],
+    use_cache: bool,
+    callback: Optional[Callable[[IterationRecord], None]],
+) -> Tuple[Optional[ResultCache], Optional[str]]:
+    """Look up bsmem result in cache, copying output files into place.
+
+    Returns:
+      Cache and key to store result under, (cache, None) if the result was
+      found in the cache, or (None, None) if not caching.
+
     """
-    logging.info("Running '%s'" % " ".join(args))
+    cache = get_default_cache() if use_cache else None
+    outputfile = _get_arg(args, "--output=")
+    if cache is None or outputfile is None:
+        return None, None
     try:
-        process = run(args, check=True, stdout=PIPE, stderr=PIPE)
-        out = process.stdout.decode("utf-8")
-        if fullstdout is not None:
-            with open(fullstdout, "w") as f:
-                f.write(out)
-        result = "Iteration" + out.split("Iteration")[-1]
-        logging.info(f"Last iteration:\n{result}")
-    except CalledProcessError as e:
-        # log output from bsmem process
-        logging.exception(
-            f"bsmem failed:\n{e.stderr.decode('utf-8')}\n{e.stdout.decode('utf-8')}"
+        key = cache.get_key(args)
+    except OSError as e:
+        logging.warning(f"Not caching bsmem result: {e}")
+        return None, None
+    if not cache.fetch(key, outputfile, fullstdout):
+        return cache, key
+    logging.info("Using cached result for '%s'" % " ".join(args))
+    _replay(fullstdout, callback)
+    return cache, None
+
+
+def _replay(
+    fullstdout: Optional[str], callback: Optional[Callable[[IterationRecord], None]]
+) -> None:
+    """Call callback with iteration records from previous run's stdout."""
+    if callback is not None and fullstdout is not None:
+        try:
+            with open(fullstdout) as f:
+                for record in parse_iterations(f):
+                    callback(record)
+        except FileNotFoundError:
+            pass
+
+
+def _finish_run(
+    args: Sequence[str],
+    fullstdout: Optional[str],
+    stop_reason: Optional[str],
+    before: Optional[int],
+    cache: Optional[ResultCache],
+    key: Optional[str],
+) -> None:
+    """Record reason for stopping bsmem early, or cache result of full run."""
+    outputfile = _get_arg(args, "--output=")
+    if stop_reason is not None:
+        if outputfile is None or _get_mtime(outputfile) in [None, before]:
+            raise BsmemStopped(stop_reason)
+        with fits.open(outputfile, mode="update") as hdulist:
+            hdulist[0].header[
+                "HISTORY"
+            ] = f"oirunner stopped bsmem early: {stop_reason}"
+    elif cache is not None and key is not None and outputfile is not None:
+        cache.store(key, outputfile, fullstdout)
+
+
+def run_bsmem(
+    args: Sequence[str],
+    fullstdout: Optional[str] = None,
+    use_cache: bool = True,
+    callback: Optional[Callable[[IterationRecord], None]] = None,
+    timeout: Optional[float] = None,
+    stop_policy: Optional[StopPolicy] = None,
+    checkpoint: Optional[JobManifest] = None,
+    isolate: bool = False,
+    cpu_slots: Optional[SlotAllocator] = None,
+) -> BsmemResult:
+    """Run bsmem as subprocess and log result.
+
+    The run is reported as a "bsmem" span (see oirunner.timing), with the
+    subprocess CPU time and maximum resident set size (ru_maxrss, in
+    platform-dependent units) as attributes.
+
+    If a job manifest is given (see oirunner.checkpoint), bsmem is not run
+    if the manifest records an identical run whose output is unchanged.
+
+    If caching is enabled (see oirunner.bsmemcache), the output files from
+    a previous identical run are reused instead of running bsmem again.
+
+    If bsmem is stopped early, the reason is logged, appended to fullstdout
+    and recorded in the header of the output image.
+
+    If isolate is true, an exclusive lock on the output filename is held
+    for the whole run, so that a concurrent run of the same job (in any
+    thread or process) waits and then finds this run's result in the
+    checkpoint manifest or cache. bsmem writes into a private working
+    directory, and the output image and stdout are renamed into place
+    only once the run succeeds, so that readers never see partial output
+    and a failed run leaves any previous output intact.
+
+    Args:
+      args: Arguments for subprocess.
+      fullstdout: Destination filename for full stdout.
+      use_cache: Reuse cached result if available.
+      callback: Function called with each iteration record as it arrives.
+      timeout: Wall-clock limit for bsmem run (seconds).
+      stop_policy: Policy for stopping bsmem once converged.
+      checkpoint: Manifest of completed runs to skip and to record run in.
+      isolate: Lock output and run bsmem in a private working directory.
+      cpu_slots: Allocator of CPUs to pin bsmem to, waited for if all
+                 are in use (see oirunner.cpuslots).
+
+    Returns:
+      Result of run, including the iteration records and the reason bsmem
+      was stopped early (if it was).
+
+    Raises:
+      BsmemStopped, CalledProcessError, OSError
+
+    """
+    start = time.perf_counter()
+    records: List[IterationRecord] = []
+
+    def collect(record: IterationRecord) -> None:
+        records.append(record)
+        if callback is not None:
+            callback(record)
+
+    outputfile = _get_arg(args, "--output=")
+    isolate = isolate and outputfile is not None
+    with contextlib.ExitStack() as stack:
+        attributes = stack.enter_context(timing.span("bsmem", outputfile=outputfile))
+        workargs, workstdout = args, fullstdout
+        if isolate:
+            workargs, workstdout = _isolate(stack, args, fullstdout)
+        if checkpoint is not None:
+            completed = checkpoint.completed(args)
+            if completed is not None:
+                logging.info("Skipping completed run '%s'" % " ".join(args))
+                attributes["skipped"] = True
+                _replay(fullstdout, collect)
+                return BsmemResult(
+                    args,
+                    records,
+                    time.perf_counter() - start,
+                    stop_reason=completed.stop_reason,
+                    reused=True,
+                )
+        with timing.span("bsmem.cache_lookup"):
+            cache, key = _fetch_cached(workargs, workstdout, use_cache, collect)
+        if cache is not None and key is None:
+            attributes["cached"] = True
+            if isolate:
+                _install(workargs, workstdout, args, fullstdout)
+            if checkpoint is not None:
+                checkpoint.record(args)
+            return BsmemResult(args, records, time.perf_counter() - start, reused=True)
+        before = _get_mtime(outputfile)
+        slot = None
+        if cpu_slots is not None:
+            with timing.span("bsmem.slot_wait"):
+                slot = stack.enter_context(cpu_slots.slot())
+            attributes["cpus"] = list(slot.cpus)
+        process = BsmemProcess(workargs, workstdout, timeout, stop_policy, slot)
+        try:
+            with timing.span("bsmem.process"):
+                for record in process:
+                    collect(record)
+        except CalledProcessError as e:
+            # log output from bsmem process
+            logging.exception(f"bsmem failed:\n{e.stderr}\n{e.stdout}")
+            raise
+        finally:
+            attributes.update(_process_attributes(process))
+        with timing.span("bsmem.finish"):
+            _finish_run(workargs, workstdout, process.stop_reason, before, cache, key)
+            if isolate:
+                _install(workargs, workstdout, args, fullstdout)
+            if checkpoint is not None:
+                checkpoint.record(args, process.stop_reason)
+        return BsmemResult(
+            args,
+            records,
+            time.perf_counter() - start,
+            process.rusage,
+            process.stop_reason,
         )
-        raise
+
+
+def _process_attributes(process: BsmemProcess) -> Dict[str, Any]:
+    """Return span attributes describing completed bsmem process."""
+    attributes: Dict[str, Any] = {
+        "returncode": process.returncode,
+        "stop_reason": process.stop_reason,
+        "parse_seconds": process.parse_seconds,
+    }
+    if process.rusage is not None:
+        attributes["cpu_user"] = process.rusage.ru_utime
+        attributes["cpu_system"] = process.rusage.ru_stime
+        attributes["maxrss"] = process.rusage.ru_maxrss
+    return attributes
+
+
+def _select_data(
+    selector: Optional[DataSelector],
+    datafile: str,
+    wav: Optional[Tuple[float, float]],
+    uvmax: Optional[float],
+) -> str:
+    """Return filename of (perhaps pre-selected) data for bsmem to read."""
+    if selector is None:
+        return datafile
+    with timing.span("select_data"):
+        return selector.subset(datafile, wav, uvmax)
 
 
 def run_bsmem_using_model(
@@ -80,7 +886,9 @@ def run_bsmem_using_model(
     t3ampb: Optional[float] = None,
     t3phia: Optional[float] = None,
     t3phib: Optional[float] = None,
-) -> None:
+    selector: Optional[DataSelector] = None,
+    **kwargs,
+) -> BsmemResult:
     """Run bsmem using initial/prior model.
 
     Args:
@@ -102,45 +910,36 @@ def run_bsmem_using_model(
       t3ampb:     Additive offset b for triple amplitude errors (e'= a * e + b)
       t3phia:     Multiplicative factor a for closure phase errors (e'= a * e + b)
       t3phib:     Additive offset b for closure phase errors (e'= a * e + b)
+      selector:   Writes pre-selected subset of data for bsmem to read,
+                  default is to pass datafile to bsmem unchanged.
+
+    Keyword arguments accepted by run_bsmem() may also be used.
+
+    Returns:
+      Result of bsmem run.
 
     """
-    args = [
-        BSMEM,
-        "--noui",
-        "--clobber",
-        f"--data={datafile}",
-        f"--output={outputfile}",
-        f"--dim={dim}",
-        f"--mt={modeltype}",
-        f"--mw={modelwidth}",
-    ]
-    if pixelsize is not None:
-        args += [f"--pixelsize={pixelsize}"]
-    if wav is not None:
-        args += [f"--wavmin={wav[0]}", f"--wavmax={wav[1]}"]
-    if uvmax is not None:
-        args += [f"--uvmax={uvmax}"]
-    args += [f"--use_t3={use_t3}"]
-    if alpha is not None:
-        args += ["--autoalpha=3", f"--alpha={alpha}"]
-    else:
-        args += ["--autoalpha=4"]
-    if flux is not None:
-        args += [f"--flux={flux}"]
-    if v2a is not None:
-        args += [f"--v2a={v2a}"]
-    if v2b is not None:
-        args += [f"--v2b={v2b}"]
-    if t3ampa is not None:
-        args += [f"--t3ampa={t3ampa}"]
-    if t3ampb is not None:
-        args += [f"--t3ampb={t3ampb}"]
-    if t3phia is not None:
-        args += [f"--t3phia={t3phia}"]
-    if t3phib is not None:
-        args += [f"--t3phib={t3phib}"]
-    fullstdout = os.path.splitext(outputfile)[0] + "-out.txt"
-    run_bsmem(args, fullstdout)
+    datafile = _select_data(selector, datafile, wav, uvmax)
+    args = get_model_args(
+        datafile,
+        outputfile,
+        dim,
+        modeltype,
+        modelwidth,
+        pixelsize,
+        wav=wav,
+        uvmax=uvmax,
+        use_t3=use_t3,
+        alpha=alpha,
+        flux=flux,
+        v2a=v2a,
+        v2b=v2b,
+        t3ampa=t3ampa,
+        t3ampb=t3ampb,
+        t3phia=t3phia,
+        t3phib=t3phib,
+    )
+    return run_bsmem(args, _get_fullstdout(outputfile), **kwargs)
 
 
 def run_bsmem_using_image(
@@ -160,7 +959,10 @@ def run_bsmem_using_image(
     t3ampb: Optional[float] = None,
     t3phia: Optional[float] = None,
     t3phib: Optional[float] = None,
-) -> None:
+    stager: Optional[PriorStager] = None,
+    selector: Optional[DataSelector] = None,
+    **kwargs,
+) -> BsmemResult:
     """Run bsmem using initial/prior image.
 
     Args:
@@ -181,47 +983,42 @@ def run_bsmem_using_image(
       t3ampb:     Additive offset b for triple amplitude errors (e'= a * e + b)
       t3phia:     Multiplicative factor a for closure phase errors (e'= a * e + b)
       t3phib:     Additive offset b for closure phase errors (e'= a * e + b)
+      stager:     Writes prior image to scratch file, default from
+                  oirunner.staging.get_default_stager().
+      selector:   Writes pre-selected subset of data for bsmem to read,
+                  default is to pass datafile to bsmem unchanged.
+
+    Keyword arguments accepted by run_bsmem() may also be used.
+
+    Returns:
+      Result of bsmem run.
 
     """
-    tempimage = tempfile.NamedTemporaryFile(suffix=".fits", mode="wb", delete=False)
-    imagehdu.writeto(tempimage.name, overwrite=True)
-    tempimage.close()
-    args = [
-        BSMEM,
-        "--noui",
-        "--clobber",
-        f"--data={datafile}",
-        f"--output={outputfile}",
-        f"--dim={dim}",
-        f"--pixelsize={pixelsize}",
-        f"--sf={tempimage.name}",
-    ]
-    if wav is not None:
-        args += [f"--wavmin={wav[0]}", f"--wavmax={wav[1]}"]
-    if uvmax is not None:
-        args += [f"--uvmax={uvmax}"]
-    args += [f"--use_t3={use_t3}"]
-    if alpha is not None:
-        args += ["--autoalpha=3", f"--alpha={alpha}"]
-    else:
-        args += ["--autoalpha=4"]
-    if flux is not None:
-        args += [f"--flux={flux}"]
-    if v2a is not None:
-        args += [f"--v2a={v2a}"]
-    if v2b is not None:
-        args += [f"--v2b={v2b}"]
-    if t3ampa is not None:
-        args += [f"--t3ampa={t3ampa}"]
-    if t3ampb is not None:
-        args += [f"--t3ampb={t3ampb}"]
-    if t3phia is not None:
-        args += [f"--t3phia={t3phia}"]
-    if t3phib is not None:
-        args += [f"--t3phib={t3phib}"]
-    fullstdout = os.path.splitext(outputfile)[0] + "-out.txt"
-    run_bsmem(args, fullstdout)
-    os.remove(tempimage.name)
+    datafile = _select_data(selector, datafile, wav, uvmax)
+    if stager is None:
+        stager = get_default_stager()
+    with contextlib.ExitStack() as stack:
+        with timing.span("stage_prior"):
+            priorfile = stack.enter_context(stager.stage(imagehdu))
+        args = get_image_args(
+            datafile,
+            outputfile,
+            dim,
+            pixelsize,
+            priorfile,
+            wav=wav,
+            uvmax=uvmax,
+            use_t3=use_t3,
+            alpha=alpha,
+            flux=flux,
+            v2a=v2a,
+            v2b=v2b,
+            t3ampa=t3ampa,
+            t3ampb=t3ampb,
+            t3phia=t3phia,
+            t3phib=t3phib,
+        )
+        return run_bsmem(args, _get_fullstdout(outputfile), **kwargs)
 
 
 def reconst_grey_basic(
@@ -231,8 +1028,9 @@ def reconst_grey_basic(
     modeltype: int = DEFAULT_MT,
     modelwidth: float = DEFAULT_MW,
     wav: Optional[Tuple[float, float]] = None,
+    hash_names: bool = False,
     **kwargs,
-) -> str:
+) -> BsmemResult:
     """Reconstruct a grey image by running bsmem once.
 
     Args:
@@ -242,15 +1040,26 @@ def reconst_grey_basic(
       modeltype:  Initial/prior image model type (0-4).
       modelwidth: Initial/prior image model width (mas).
       wav:        Min and max wavelengths to select (nm).
+      hash_names: Include hash of parameters in output filename, so that
+                  concurrent runs with different parameters do not
+                  overwrite each other's output.
 
     Keyword arguments accepted by run_bsmem_using_model() may also be used.
 
     Returns:
-       Output FITS filename.
+       Result of bsmem run, path-like giving output FITS filename.
 
     """
-    outputfile = _get_outputfile(datafile, 1, wav)
-    run_bsmem_using_model(
+    params = dict(
+        pixelsize=pixelsize,
+        dim=dim,
+        modeltype=modeltype,
+        modelwidth=modelwidth,
+        wav=wav,
+    )
+    tag = _get_tag(hash_names, params, kwargs)
+    outputfile = _get_outputfile(datafile, 1, wav, tag)
+    return run_bsmem_using_model(
         datafile,
         outputfile,
         dim,
@@ -260,43 +1069,43 @@ def reconst_grey_basic(
         wav=wav,
         **kwargs,
     )
-    return outputfile
 
 
 def reconst_grey_basic_using_image(
     datafile: str,
     imagefile: str,
     wav: Optional[Tuple[float, float]] = None,
+    hash_names: bool = False,
     **kwargs,
-) -> str:
+) -> BsmemResult:
     """Reconstruct a grey image by running bsmem once using a prior image.
 
     Args:
       datafile:   Input OIFITS data filename.
       imagefile:  Input initial/prior FITS image.
       wav:        Min and max wavelengths to select (nm).
+      hash_names: Include hash of parameters in output filename.
 
     Keyword arguments accepted by run_bsmem_using_image() may also be used.
 
     Returns:
-       Output FITS filename.
+       Result of bsmem run, path-like giving output FITS filename.
 
     """
-    outputfile = _get_outputfile(datafile, 1, wav)
-    with fits.open(imagefile) as hdulist:
-        imagehdu = hdulist[0]
-        dim = imagehdu.data.shape[0]
-        pixelsize = get_pixelsize(imagehdu)
-        run_bsmem_using_image(
-            datafile,
-            outputfile,
-            dim,
-            pixelsize,
-            imagehdu,
-            wav=wav,
-            **kwargs,
-        )
-    return outputfile
+    tag = _get_tag(hash_names, dict(imagefile=imagefile, wav=wav), kwargs)
+    outputfile = _get_outputfile(datafile, 1, wav, tag)
+    imagehdu = _read_image(imagefile)
+    dim = imagehdu.data.shape[0]
+    pixelsize = get_pixelsize(imagehdu)
+    return run_bsmem_using_image(
+        datafile,
+        outputfile,
+        dim,
+        pixelsize,
+        imagehdu,
+        wav=wav,
+        **kwargs,
+    )
 
 
 def reconst_grey_2step(
@@ -309,8 +1118,9 @@ def reconst_grey_2step(
     uvmax1: float = 1.1e8,
     fwhm: float = 1.25,
     threshold: float = 0.05,
+    hash_names: bool = False,
     **kwargs,
-) -> str:
+) -> BsmemResult:
     """Reconstruct a grey image by running bsmem twice.
 
     Args:
@@ -323,16 +1133,28 @@ def reconst_grey_2step(
       uvmax1:     Maximum uv radius to select for 1st run (waves).
       fwhm:       FWHM of Gaussian to convolve 1st run output with (mas).
       threshold:  Threshold (relative to peak) to apply to 1st run output.
+      hash_names: Include hash of parameters in output filenames.
 
     Keyword arguments accepted by run_bsmem_using_model() may also be used.
 
     Returns:
-       Output FITS filename.
+       Result of 2nd bsmem run, path-like giving output FITS filename.
 
     """
     # TODO: intelligent defaults for uvmax1, fwhm?
-    out1file = _get_outputfile(datafile, 1, wav)
-    run_bsmem_using_model(
+    params = dict(
+        pixelsize=pixelsize,
+        dim=dim,
+        modeltype=modeltype,
+        modelwidth=modelwidth,
+        wav=wav,
+        uvmax1=uvmax1,
+        fwhm=fwhm,
+        threshold=threshold,
+    )
+    tag = _get_tag(hash_names, params, kwargs)
+    out1file = _get_outputfile(datafile, 1, wav, tag)
+    result1 = run_bsmem_using_model(
         datafile,
         out1file,
         dim,
@@ -343,10 +1165,9 @@ def reconst_grey_2step(
         uvmax=uvmax1,
         **kwargs,
     )
-    with fits.open(out1file) as hdulist:
-        imagehdu = makesf(hdulist[0], fwhm, threshold)
-    out2file = _get_outputfile(datafile, 2, wav)
-    run_bsmem_using_image(
+    imagehdu = makesf(result1.hdu, fwhm, threshold)
+    out2file = _get_outputfile(datafile, 2, wav, tag)
+    return run_bsmem_using_image(
         datafile,
         out2file,
         dim,
@@ -355,7 +1176,6 @@ def reconst_grey_2step(
         wav=wav,
         **kwargs,
     )
-    return out2file
 
 
 def reconst_grey_2step_using_image(
@@ -365,8 +1185,9 @@ def reconst_grey_2step_using_image(
     uvmax1: float = 1.1e8,
     fwhm: float = 1.25,
     threshold: float = 0.05,
+    hash_names: bool = False,
     **kwargs,
-) -> str:
+) -> BsmemResult:
     """Reconstruct a grey image by running bsmem twice using a prior image.
 
     Args:
@@ -376,38 +1197,40 @@ def reconst_grey_2step_using_image(
       uvmax1:     Maximum uv radius to select for 1st run (waves).
       fwhm:       FWHM of Gaussian to convolve 1st run output with (mas).
       threshold:  Threshold (relative to peak) to apply to 1st run output.
+      hash_names: Include hash of parameters in output filenames.
 
     Keyword arguments accepted by run_bsmem_using_image() may also be used.
 
     Returns:
-       Output FITS filename.
+       Result of 2nd bsmem run, path-like giving output FITS filename.
 
     """
-    out1file = _get_outputfile(datafile, 1, wav)
-    with fits.open(imagefile) as hdulist:
-        image1hdu = hdulist[0]
-        dim = image1hdu.data.shape[0]
-        pixelsize = get_pixelsize(image1hdu)
-        run_bsmem_using_image(
-            datafile,
-            out1file,
-            dim,
-            pixelsize,
-            image1hdu,
-            wav=wav,
-            uvmax=uvmax1,
-            **kwargs,
-        )
-    out2file = _get_outputfile(datafile, 2, wav)
-    with fits.open(out1file) as hdulist:
-        image2hdu = makesf(hdulist[0], fwhm, threshold)
-        run_bsmem_using_image(
-            datafile,
-            out2file,
-            dim,
-            pixelsize,
-            image2hdu,
-            wav=wav,
-            **kwargs,
-        )
-    return out2file
+    params = dict(
+        imagefile=imagefile, wav=wav, uvmax1=uvmax1, fwhm=fwhm, threshold=threshold
+    )
+    tag = _get_tag(hash_names, params, kwargs)
+    out1file = _get_outputfile(datafile, 1, wav, tag)
+    image1hdu = _read_image(imagefile)
+    dim = image1hdu.data.shape[0]
+    pixelsize = get_pixelsize(image1hdu)
+    result1 = run_bsmem_using_image(
+        datafile,
+        out1file,
+        dim,
+        pixelsize,
+        image1hdu,
+        wav=wav,
+        uvmax=uvmax1,
+        **kwargs,
+    )
+    out2file = _get_outputfile(datafile, 2, wav, tag)
+    image2hdu = makesf(result1.hdu, fwhm, threshold)
+    return run_bsmem_using_image(
+        datafile,
+        out2file,
+        dim,
+        pixelsize,
+        image2hdu,
+        wav=wav,
+        **kwargs,
+    )
@@ -0,0 +1,592 @@
+"""Python module to reconstruct images for many wavelength channels.
+
+Channels may be reconstructed independently, each starting from a model
+prior, or chained so that each channel starts from the (optionally
+blurred) image reconstructed for its neighbour. Adjacent channels usually
+give similar images, so chained runs need fewer bsmem iterations. Chains
+start from one or more anchor channels reconstructed from the model prior
+and extend towards shorter and longer wavelengths, until they reach the
+channels belonging to the next anchor.
+
+Attributes:
+  DEFAULT_WORKERS (int): Default maximum number of concurrent bsmem runs.
+
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import time
+from concurrent.futures import (
+    Executor,
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import (
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TYPE_CHECKING,
+    Tuple,
+    Union,
+)
+
+from .lazy import lazy_import
+from .priorimage import get_pixelsize, makesf
+from .runbsmem import (
+    DEFAULT_DIM,
+    DEFAULT_MT,
+    DEFAULT_MW,
+    _get_outputfile,
+    _read_image,
+    reconst_grey_basic,
+    run_bsmem_using_image,
+    run_bsmem_using_model,
+)
+
+if TYPE_CHECKING:
+    from astropy.io import fits
+    import numpy as np
+else:
+    fits = lazy_import("astropy.io.fits")
+    np = lazy_import("numpy")
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+class ChannelResult(NamedTuple):
+    """Outcome of reconstruction for a single wavelength channel.
+
+    Attributes:
+      wav:        Min and max wavelengths selected (nm).
+      outputfile: Output FITS filename, or None if reconstruction failed.
+      error:      Exception raised by failed reconstruction, else None.
+
+    """
+
+    wav: Tuple[float, float]
+    outputfile: Optional[str]
+    error: Optional[BaseException]
+
+
+class ChainResult(NamedTuple):
+    """Outcome of chained reconstruction for a single wavelength channel.
+
+    Attributes:
+      wav:        Min and max wavelengths selected (nm).
+      outputfile: Output FITS filename, or None if reconstruction failed.
+      error:      Exception raised by failed reconstruction, else None.
+      prior:      Index of channel whose image was used as the prior, or
+                  None if started from the model prior.
+      iterations: Number of bsmem iterations, or None if not reported.
+      seconds:    Wall-clock time taken by reconstruction.
+
+    """
+
+    wav: Tuple[float, float]
+    outputfile: Optional[str]
+    error: Optional[BaseException]
+    prior: Optional[int]
+    iterations: Optional[int]
+    seconds: float
+
+
+class ChainSavings(NamedTuple):
+    """Cost of chained reconstruction compared with cold starts.
+
+    Attributes:
+      cold:             Number of cold-started channels compared against.
+      warm:             Number of warm-started channels.
+      cold_iterations:  Mean iterations per cold-started channel.
+      warm_iterations:  Mean iterations per warm-started channel.
+      iterations_saved: Total iterations saved by warm starts.
+      seconds_saved:    Total wall-clock time saved by warm starts.
+
+    """
+
+    cold: int
+    warm: int
+    cold_iterations: float
+    warm_iterations: float
+    iterations_saved: float
+    seconds_saved: float
+
+
+def get_wavelength_bins(datafile: str) -> List[Tuple[float, float]]:
+    """Return wavelength bins for all distinct channels in OIFITS file.
+
+    Each channel in the OI_WAVELENGTH table(s) gives a bin of width EFF_BAND
+    centred on EFF_WAVE. Bins are returned in order of increasing wavelength.
+
+    Args:
+      datafile: Input OIFITS data filename.
+
+    Returns:
+      List of (min, max) wavelengths (nm).
+
+    Raises:
+      KeyError
+
+    """
+    channels = set()
+    with fits.open(datafile) as hdulist:
+        for hdu in hdulist[1:]:
+            if hdu.name != "OI_WAVELENGTH":
+                continue
+            for effwave, effband in zip(hdu.data["EFF_WAVE"], hdu.data["EFF_BAND"]):
+                channels.add((float(effwave) * 1e9, float(effband) * 1e9))
+    if not channels:
+        raise KeyError("No OI_WAVELENGTH table in '%s'" % datafile)
+    return [(wave - band / 2, wave + band / 2) for wave, band in sorted(channels)]
+
+
+def reconst_channels(
+    datafile: str,
+    wavs: Optional[Sequence[Tuple[float, float]]] = None,
+    reconst: Callable[..., Union[str, "os.PathLike[str]"]] = reconst_grey_basic,
+    workers: int = DEFAULT_WORKERS,
+    processes: bool = False,
+    **kwargs,
+) -> List[ChannelResult]:
+    """Reconstruct an image for each wavelength channel concurrently.
+
+    Args:
+      datafile:  Input OIFITS data filename.
+      wavs:      Min and max wavelengths (nm) for each channel, default is
+                 one channel per OI_WAVELENGTH entry.
+      reconst:   Function to reconstruct one channel and return the output
+                 filename (or a path-like result), e.g. reconst_grey_2step.
+      workers:   Maximum number of channels to reconstruct at once.
+      processes: Use a process pool rather than a thread pool.
+
+    Keyword arguments accepted by reconst may also be used.
+
+    Returns:
+      Result for each channel, in the same order as wavs.
+
+    Raises:
+      ValueError
+
+    """
+    if wavs is None:
+        wavs = get_wavelength_bins(datafile)
+    wavs = [(float(wav[0]), float(wav[1])) for wav in wavs]
+    outputfiles = [_get_outputfile(datafile, 1, wav) for wav in wavs]
+    if len(set(outputfiles)) != len(outputfiles):
+        raise ValueError("Wavelength channels must have distinct mean wavelengths")
+    executor: Executor
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    with executor:
+        futures = [
+            executor.submit(reconst, datafile, wav=wav, **kwargs) for wav in wavs
+        ]
+        results = []
+        for wav, future in zip(wavs, futures):
+            try:
+                outputfile = os.fspath(future.result())
+                results.append(ChannelResult(wav, outputfile, None))
+            except Exception as e:
+                logging.error(f"Reconstruction of channel {wav} failed: {e}")
+                results.append(ChannelResult(wav, None, e))
+    return results
+
+
+def get_anchors(nchannels: int, nchains: int) -> List[int]:
+    """Return indices of evenly spaced anchor channels.
+
+    Each anchor is at the centre of one of nchains equal groups of
+    channels, so that the chains are of similar length.
+
+    Raises:
+      ValueError
+
+    """
+    if nchannels < 1 or nchains < 1:
+        raise ValueError("Need at least one channel and one chain")
+    nchains = min(nchains, nchannels)
+    return [int((k + 0.5) * nchannels / nchains) for k in range(nchains)]
+
+
+def _run_channel(
+    datafile: str,
+    wav: Tuple[float, float],
+    priorfile: Optional[str],
+    pixelsize: Optional[float],
+    dim: int,
+    modeltype: int,
+    modelwidth: float,
+    fwhm: Optional[float],
+    threshold: float,
+    kwargs: dict,
+) -> Tuple[str, Optional[int], float]:
+    """Reconstruct one channel, returning filename, iterations and seconds."""
+    outputfile = _get_outputfile(datafile, 1, wav)
+    start = time.perf_counter()
+    if priorfile is None:
+        result = run_bsmem_using_model(
+            datafile,
+            outputfile,
+            dim,
+            modeltype,
+            modelwidth,
+            pixelsize=pixelsize,
+            wav=wav,
+            **kwargs,
+        )
+    else:
+        imagehdu = _read_image(priorfile)
+        if fwhm is not None:
+            imagehdu = makesf(imagehdu, fwhm, threshold)
+        result = run_bsmem_using_image(
+            datafile,
+            outputfile,
+            imagehdu.data.shape[0],
+            get_pixelsize(imagehdu),
+            imagehdu,
+            wav=wav,
+            **kwargs,
+        )
+    seconds = time.perf_counter() - start
+    iterations = None if result.final is None else result.iterations
+    return outputfile, iterations, seconds
+
+
+def reconst_chained(
+    datafile: str,
+    wavs: Optional[Sequence[Tuple[float, float]]] = None,
+    pixelsize: Optional[float] = None,
+    dim: int = DEFAULT_DIM,
+    modeltype: int = DEFAULT_MT,
+    modelwidth: float = DEFAULT_MW,
+    fwhm: Optional[float] = None,
+    threshold: float = 0.05,
+    anchors: Optional[Sequence[int]] = None,
+    nchains: int = 1,
+    workers: int = DEFAULT_WORKERS,
+    **kwargs,
+) -> List[ChainResult]:
+    """Reconstruct an image for each channel, warm-starting from neighbours.
+
+    Each anchor channel is reconstructed from the model prior. Every other
+    channel belongs to the nearest anchor (the shorter-wavelength one if
+    equidistant) and is reconstructed using the image from the adjacent
+    channel on the anchor side as its prior, blurred with makesf() if fwhm
+    is given. The chains either side of each anchor, and the chains from
+    different anchors, run concurrently. If a channel fails, the next
+    channel in its chain uses the last successful image instead.
+
+    Passing every channel index as an anchor reconstructs all channels
+    from the model prior, giving the cold-start baseline for
+    chain_savings().
+
+    Args:
+      datafile:   Input OIFITS data filename.
+      wavs:       Min and max wavelengths (nm) for each channel, default is
+                  one channel per OI_WAVELENGTH entry. Chains follow the
+                  order given.
+      pixelsize:  Reconstructed image pixel size (mas), for anchor
+                  channels. Other channels use the grid of their prior.
+      dim:        Reconstructed image width (pixels), for anchor channels.
+      modeltype:  Initial/prior image model type (0-4), for anchor channels.
+      modelwidth: Initial/prior image model width (mas), for anchor channels.
+      fwhm:       FWHM of Gaussian to blur prior images with (mas), default
+                  is to use neighbouring images unchanged.
+      threshold:  Threshold for blurred prior images, relative to peak.
+      anchors:    Indices into wavs of anchor channels, default is nchains
+                  evenly spaced channels.
+      nchains:    Number of anchors to choose if anchors is not given.
+      workers:    Maximum number of channels to reconstruct at once.
+
+    Keyword arguments accepted by run_bsmem_using_model() and
+    run_bsmem_using_image() may also be used.
+
+    Returns:
+      Result for each channel, in the same order as wavs.
+
+    Raises:
+      ValueError
+
+    """
+    if wavs is None:
+        wavs = get_wavelength_bins(datafile)
+    wavs = [(float(wav[0]), float(wav[1])) for wav in wavs]
+    outputfiles = [_get_outputfile(datafile, 1, wav) for wav in wavs]
+    if len(set(outputfiles)) != len(outputfiles):
+        raise ValueError("Wavelength channels must have distinct mean wavelengths")
+    if anchors is None:
+        anchors = get_anchors(len(wavs), nchains)
+    anchors = sorted(set(anchors))
+    if not anchors or anchors[0] < 0 or anchors[-1] >= len(wavs):
+        raise ValueError(
+            "Anchors %s must be channel indices from 0 to %d" % (anchors, len(wavs) - 1)
+        )
+    owner = [min(anchors, key=lambda a: (abs(a - i), a)) for i in range(len(wavs))]
+    results: List[Optional[ChainResult]] = [None] * len(wavs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # future -> (channel index, chain direction, index of prior channel)
+        pending: Dict[Future, Tuple[int, int, Optional[int]]] = {}
+
+        def submit(index: int, step: int, prior: Optional[int]) -> None:
+            priorfile = None if prior is None else outputfiles[prior]
+            future = executor.submit(
+                _run_channel,
+                datafile,
+                wavs[index],
+                priorfile,
+                pixelsize,
+                dim,
+                modeltype,
+                modelwidth,
+                fwhm,
+                threshold,
+                kwargs,
+            )
+            pending[future] = (index, step, prior)
+
+        for anchor in anchors:
+            submit(anchor, 0, None)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, step, prior = pending.pop(future)
+                try:
+                    outputfile, iterations, seconds = future.result()
+                    result = ChainResult(
+                        wavs[index], outputfile, None, prior, iterations, seconds
+                    )
+                    nextprior: Optional[int] = index
+                except Exception as e:
+                    logging.error(
+                        f"Reconstruction of channel {wavs[index]} failed: {e}"
+                    )
+                    result = ChainResult(wavs[index], None, e, prior, None, 0.0)
+                    nextprior = prior
+                results[index] = result
+                for nextstep in [-1, 1] if step == 0 else [step]:
+                    nextindex = index + nextstep
+                    if (
+                        0 <= nextindex < len(wavs)
+                        and owner[nextindex] == owner[index]
+                        and results[nextindex] is None
+                    ):
+                        submit(nextindex, nextstep, nextprior)
+    chained = [r for r in results if r is not None]
+    try:
+        savings = chain_savings(chained)
+    except ValueError:
+        pass
+    else:
+        logging.info(
+            "Warm starts saved an estimated %.0f iterations and %.1f s"
+            % (savings.iterations_saved, savings.seconds_saved)
+        )
+    return chained
+
+
+def chain_savings(
+    results: Sequence[ChainResult], cold: Optional[Sequence[ChainResult]] = None
+) -> ChainSavings:
+    """Compare warm-started channels with cold-started ones.
+
+    Each successful warm-started channel is compared with the cold start
+    for the same channel if one is available, else with the mean over
+    all cold starts. Without a cold-start baseline, the anchor channels of
+    the chained reconstruction are used, giving an estimate.
+
+    Args:
+      results: Channel results as returned by reconst_chained().
+      cold:    Channel results for cold starts of some or all channels,
+               e.g. from reconst_chained() with every channel an anchor.
+
+    Returns:
+      Mean iterations and total savings.
+
+    Raises:
+      ValueError
+
+    """
+    if cold is None:
+        cold = [r for r in results if r.prior is None]
+    coldruns = {
+        r.wav: (r.iterations, r.seconds)
+        for r in cold
+        if r.error is None and r.iterations is not None
+    }
+    warmruns = [
+        (r.wav, r.iterations, r.seconds)
+        for r in results
+        if r.prior is not None and r.error is None and r.iterations is not None
+    ]
+    if not coldruns or not warmruns:
+        raise ValueError("Need successful cold- and warm-started channels to compare")
+    cold_iterations, cold_seconds = np.mean(list(coldruns.values()), axis=0)
+    iterations_saved = 0.0
+    seconds_saved = 0.0
+    for wav, iterations, seconds in warmruns:
+        base_iterations, base_seconds = coldruns.get(
+            wav, (cold_iterations, cold_seconds)
+        )
+        iterations_saved += base_iterations - iterations
+        seconds_saved += base_seconds - seconds
+    return ChainSavings(
+        len(coldruns),
+        len(warmruns),
+        float(cold_iterations),
+        float(np.mean([run[1] for run in warmruns])),
+        float(iterations_saved),
+        float(seconds_saved),
+    )
+
+
+def assemble_cube(
+    results: Sequence[Union[ChannelResult, ChainResult]],
+    cubefile: str,
+    overwrite: bool = True,
+) -> None:
+    """Write single-channel images to a FITS cube.
+
+    Failed channels are filled with NaNs. If the channels are evenly spaced
+    the cube has a linear wavelength axis (nm), otherwise the third axis has
+    no WCS. An additional WAVELENGTHS table gives the exact limits of each
+    channel.
+
+    Args:
+      results:   Channel results as returned by reconst_channels() or
+                 reconst_chained().
+      cubefile:  Output FITS filename.
+      overwrite: Overwrite existing output file.
+
+    Raises:
+      ValueError
+
+    """
+    good = [r for r in results if r.outputfile is not None]
+    if not good:
+        raise ValueError("No successfully reconstructed channels to assemble")
+    with fits.open(good[0].outputfile) as hdulist:
+        header = hdulist[0].header.copy()
+        shape = hdulist[0].data.shape
+    cube = np.full((len(results),) + shape, np.nan)
+    for i, r in enumerate(results):
+        if r.outputfile is not None:
+            with fits.open(r.outputfile) as hdulist:
+                cube[i] = hdulist[0].data
+    meanwavs = [(r.wav[0] + r.wav[1]) / 2 for r in results]
+    outhdu = fits.PrimaryHDU(data=cube)
+    for prefix in ["CTYPE", "CUNIT", "CRPIX", "CRVAL", "CDELT"]:
+        for key in [prefix + "1", prefix + "2"]:
+            if key in header:
+                outhdu.header[key] = header[key]
+    if len(results) > 1:
+        steps = np.diff(meanwavs)
+        cdelt = steps.mean()
+        linear = np.allclose(steps, cdelt, rtol=1e-3, atol=0.0)
+    else:
+        cdelt = results[0].wav[1] - results[0].wav[0]
+        linear = True
+    if linear:
+        outhdu.header["CTYPE3"] = "WAVE"
+        outhdu.header["CUNIT3"] = "nm"
+        outhdu.header["CRPIX3"] = 1.0
+        outhdu.header["CRVAL3"] = meanwavs[0]
+        outhdu.header["CDELT3"] = cdelt
+    outhdu.header["HISTORY"] = "Assembled from %d/%d channels" % (
+        len(good),
+        len(results),
+    )
+    wavhdu = fits.BinTableHDU.from_columns(
+        [
+            fits.Column("WAV_MIN", "D", "nm", array=[r.wav[0] for r in results]),
+            fits.Column("WAV_MAX", "D", "nm", array=[r.wav[1] for r in results]),
+            fits.Column("OK", "L", array=[r.outputfile is not None for r in results]),
+        ],
+        name="WAVELENGTHS",
+    )
+    fits.HDUList([outhdu, wavhdu]).writeto(cubefile, overwrite=overwrite)
+
+
+def _get_cubefile(datafile: str) -> str:
+    dirname, basename = os.path.split(datafile)
+    stem, _ = os.path.splitext(basename)
+    return os.path.join(dirname, f"bsmem_cube_{stem}.fits")
+
+
+def _warn_failed(results: Sequence[Union[ChannelResult, ChainResult]]) -> None:
+    failed = [r for r in results if r.error is not None]
+    if failed:
+        logging.warning(
+            "%d of %d channels failed: %s"
+            % (len(failed), len(results), ", ".join(str(r.wav) for r in failed))
+        )
+
+
+def reconst_grey_cube(
+    datafile: str,
+    wavs: Optional[Sequence[Tuple[float, float]]] = None,
+    cubefile: Optional[str] = None,
+    **kwargs,
+) -> Tuple[str, List[ChannelResult]]:
+    """Reconstruct grey images for many wavelength channels as a FITS cube.
+
+    Args:
+      datafile: Input OIFITS data filename.
+      wavs:     Min and max wavelengths (nm) for each channel, default is
+                one channel per OI_WAVELENGTH entry.
+      cubefile: Output FITS filename, default derived from datafile.
+
+    Keyword arguments accepted by reconst_channels() may also be used.
+
+    Returns:
+      Output FITS filename and result for each channel.
+
+    Raises:
+      ValueError
+
+    """
+    results = reconst_channels(datafile, wavs, **kwargs)
+    if cubefile is None:
+        cubefile = _get_cubefile(datafile)
+    assemble_cube(results, cubefile)
+    _warn_failed(results)
+    return cubefile, results
+
+
+def reconst_chained_cube(
+    datafile: str,
+    wavs: Optional[Sequence[Tuple[float, float]]] = None,
+    cubefile: Optional[str] = None,
+    **kwargs,
+) -> Tuple[str, List[ChainResult]]:
+    """Reconstruct chained grey images for many channels as a FITS cube.
+
+    Args:
+      datafile: Input OIFITS data filename.
+      wavs:     Min and max wavelengths (nm) for each channel, default is
+                one channel per OI_WAVELENGTH entry.
+      cubefile: Output FITS filename, default derived from datafile.
+
+    Keyword arguments accepted by reconst_chained() may also be used.
+
+    Returns:
+      Output FITS filename and result for each channel.
+
+    Raises:
+      ValueError
+
+    """
+    results = reconst_chained(datafile, wavs, **kwargs)
+    if cubefile is None:
+        cubefile = _get_cubefile(datafile)
+    assemble_cube(results, cubefile)
+    _warn_failed(results)
+    return cubefile, results
@@ -0,0 +1,228 @@
+"""Python module to stage prior images as files for bsmem.
+
+Attributes:
+  SCRATCH_DIR (str): Default directory for staged files, from
+                     $OIRUNNER_SCRATCH_DIR if set, else the system
+                     temporary directory.
+  MAX_FILES (int):   Default maximum number of unused staged files to keep
+                     for reuse.
+
+"""
+
+from __future__ import annotations
+
+import atexit
+import contextlib
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Iterator, List, NamedTuple, Optional, TYPE_CHECKING, Union
+
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    from astropy.io import fits
+    import numpy as np
+else:
+    fits = lazy_import("astropy.io.fits")
+    np = lazy_import("numpy")
+
+SCRATCH_DIR = os.environ.get("OIRUNNER_SCRATCH_DIR", tempfile.gettempdir())
+MAX_FILES = 8
+
+
+class StagingStats(NamedTuple):
+    """Prior staging statistics.
+
+    Attributes:
+      written: Number of prior images written to scratch files.
+      reused:  Number of times an existing scratch file was reused.
+      seconds: Total time spent hashing and writing prior images.
+
+    """
+
+    written: int
+    reused: int
+    seconds: float
+
+
+class _Staged:
+    __slots__ = ("filename", "users", "written")
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.users = 0
+        self.written = threading.Event()
+
+
+def hash_hdu(imagehdu: Union[fits.PrimaryHDU, fits.ImageHDU]) -> str:
+    """Return hash of image HDU header and data."""
+    h = hashlib.sha256()
+    h.update(imagehdu.header.tostring().encode("ascii"))
+    data = np.ascontiguousarray(imagehdu.data)
+    h.update(str((data.dtype.str, data.shape)).encode("ascii"))
+    h.update(data.data)
+    return h.hexdigest()
+
+
+class PriorStager:
+    """Write prior image HDUs to scratch files, reusing identical images.
+
+    Staged files that are no longer in use are kept (up to maxfiles of
+    them) so that passing the same image again, as in a wavelength sweep,
+    does not write it again. All staged files are removed by cleanup(),
+    on leaving a with block, when the stager is garbage collected, or at
+    interpreter exit.
+
+    Attributes:
+      scratchdir: Directory for staged files.
+      reuse:      Reuse staged file for identical image.
+      maxfiles:   Maximum number of unused staged files to keep.
+
+    """
+
+    def __init__(
+        self,
+        scratchdir: Optional[str] = None,
+        reuse: bool = True,
+        maxfiles: int = MAX_FILES,
+    ):
+        """Create stager, making scratch directory if necessary."""
+        self.scratchdir = SCRATCH_DIR if scratchdir is None else scratchdir
+        self.reuse = reuse
+        self.maxfiles = maxfiles
+        self._staged: "OrderedDict[str, _Staged]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._written = 0
+        self._reused = 0
+        self._seconds = 0.0
+        os.makedirs(self.scratchdir, exist_ok=True)
+        # Must not refer to self, or the stager would never be collected
+        weakref.finalize(self, _remove_staged, self._lock, self._staged)
+
+    def __enter__(self) -> "PriorStager":
+        """Return self, for use in a with statement."""
+        return self
+
+    def __exit__(self, *exc) -> None:
+        """Remove staged files."""
+        self.cleanup()
+
+    @contextlib.contextmanager
+    def stage(self, imagehdu: Union[fits.PrimaryHDU, fits.ImageHDU]) -> Iterator[str]:
+        """Context manager yielding filename of staged copy of image.
+
+        The file must not be modified, and may be removed on leaving the
+        context.
+
+        """
+        start = time.perf_counter()
+        key = hash_hdu(imagehdu) if self.reuse else os.urandom(16).hex()
+        with self._lock:
+            staged = self._staged.get(key)
+            writer = staged is None
+            if staged is None:
+                fd, filename = tempfile.mkstemp(suffix=".fits", dir=self.scratchdir)
+                os.close(fd)
+                staged = self._staged[key] = _Staged(filename)
+            self._staged.move_to_end(key)
+            staged.users += 1
+        try:
+            if writer:
+                try:
+                    imagehdu.writeto(staged.filename, overwrite=True)
+                except BaseException:
+                    with self._lock:
+                        del self._staged[key]
+                    _remove(staged.filename)
+                    raise
+                finally:
+                    staged.written.set()
+            else:
+                staged.written.wait()
+                if not os.path.exists(staged.filename):
+                    raise OSError("Failed to stage prior image")
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._seconds += elapsed
+                if writer:
+                    self._written += 1
+                else:
+                    self._reused += 1
+            logging.info(
+                "%s prior image '%s' in %.3f s"
+                % ("Wrote" if writer else "Reused", staged.filename, elapsed)
+            )
+            yield staged.filename
+        finally:
+            with self._lock:
+                staged.users -= 1
+                if not self.reuse:
+                    self._staged.pop(key, None)
+                    _remove(staged.filename)
+                self._trim()
+
+    def _trim(self) -> None:
+        unused = [k for k, s in self._staged.items() if s.users == 0]
+        for key in unused[: max(len(unused) - self.maxfiles, 0)]:
+            _remove(self._staged.pop(key).filename)
+
+    def cleanup(self) -> None:
+        """Remove all staged files that are not in use."""
+        with self._lock:
+            for key in [k for k, s in self._staged.items() if s.users == 0]:
+                _remove(self._staged.pop(key).filename)
+
+    def files(self) -> List[str]:
+        """Return names of currently staged files."""
+        with self._lock:
+            return [s.filename for s in self._staged.values()]
+
+    def stats(self) -> StagingStats:
+        """Return staging statistics."""
+        with self._lock:
+            return StagingStats(self._written, self._reused, self._seconds)
+
+
+def _remove(filename: str) -> None:
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_staged(lock: threading.Lock, staged: "OrderedDict[str, _Staged]") -> None:
+    with lock:
+        while staged:
+            _remove(staged.popitem()[1].filename)
+
+
+_default_stager: Optional[PriorStager] = None
+_default_lock = threading.Lock()
+
+
+def get_default_stager() -> PriorStager:
+    """Return stager used by run_bsmem_using_image() by default."""
+    global _default_stager
+    with _default_lock:
+        if _default_stager is None:
+            _default_stager = PriorStager()
+        return _default_stager
+
+
+def set_default_stager(stager: PriorStager) -> None:
+    """Set stager used by run_bsmem_using_image() by default."""
+    global _default_stager
+    with _default_lock:
+        _default_stager = stager
+
+
+@atexit.register
+def _cleanup_default() -> None:
+    if _default_stager is not None:
+        _default_stager.cleanup()
@@ -0,0 +1,102 @@
+"""Python module defining policies for stopping bsmem early.
+
+A stop policy is called with each iteration record as bsmem reports it,
+and returns a reason string when bsmem should be stopped.
+
+"""
+
+from typing import Optional, Sequence
+
+from .bsmemoutput import IterationRecord
+
+
+class StopPolicy:
+    """Base class for stop policies, which never stop bsmem."""
+
+    def reset(self) -> None:
+        """Forget previous iterations, ready for a new run."""
+        pass
+
+    def __call__(self, record: IterationRecord) -> Optional[str]:
+        """Return reason to stop bsmem after this iteration, else None."""
+        return None
+
+
+class ChiSquaredPlateau(StopPolicy):
+    """Stop when chi-squared has stopped changing.
+
+    Attributes:
+      epsilon:  Largest change in chi2 regarded as no change.
+      patience: Number of consecutive iterations with no change required.
+      relative: Compare change in chi2 relative to previous value.
+
+    """
+
+    def __init__(self, epsilon: float = 1e-3, patience: int = 5, relative=True):
+        """Create policy."""
+        self.epsilon = epsilon
+        self.patience = patience
+        self.relative = relative
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget previous iterations, ready for a new run."""
+        self._last: Optional[float] = None
+        self._count = 0
+
+    def __call__(self, record: IterationRecord) -> Optional[str]:
+        """Return reason to stop bsmem after this iteration, else None."""
+        if record.chi2 is None:
+            return None
+        if self._last is not None:
+            change = abs(record.chi2 - self._last)
+            if self.relative and self._last != 0.0:
+                change /= abs(self._last)
+            self._count = self._count + 1 if change < self.epsilon else 0
+        self._last = record.chi2
+        if self._count >= self.patience:
+            return "chi2 change below %g for %d iterations" % (
+                self.epsilon,
+                self.patience,
+            )
+        return None
+
+
+class MaxIterations(StopPolicy):
+    """Stop after a given number of iterations.
+
+    Attributes:
+      niter: Maximum number of iterations.
+
+    """
+
+    def __init__(self, niter: int):
+        """Create policy."""
+        self.niter = niter
+
+    def __call__(self, record: IterationRecord) -> Optional[str]:
+        """Return reason to stop bsmem after this iteration, else None."""
+        if record.iteration >= self.niter:
+            return "reached %d iterations" % self.niter
+        return None
+
+
+class AnyOf(StopPolicy):
+    """Stop when any of several policies says so."""
+
+    def __init__(self, policies: Sequence[StopPolicy]):
+        """Create policy."""
+        self.policies = list(policies)
+
+    def reset(self) -> None:
+        """Forget previous iterations, ready for a new run."""
+        for policy in self.policies:
+            policy.reset()
+
+    def __call__(self, record: IterationRecord) -> Optional[str]:
+        """Return reason to stop bsmem after this iteration, else None."""
+        for policy in self.policies:
+            reason = policy(record)
+            if reason is not None:
+                return reason
+        return None
@@ -0,0 +1,340 @@
+"""Python module to sweep bsmem hyperparameters in parallel.
+
+Each combination of parameters (e.g. alpha, v2a, t3phia) is reconstructed
+with its own output file, and the final chi2, entropy, alpha and flux
+reported by bsmem are collected into a table.
+
+Attributes:
+  DEFAULT_WORKERS (int): Default maximum number of concurrent bsmem runs.
+  COLUMNS (List[str]):   Result table columns following the parameters,
+                         which are named "param_" + parameter name.
+
+"""
+
+from __future__ import annotations
+
+import itertools
+import logging
+import math
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    TYPE_CHECKING,
+    Tuple,
+)
+
+from .bsmemoutput import IterationRecord
+from .lazy import lazy_import
+from .runbsmem import (
+    BsmemStopped,
+    DEFAULT_DIM,
+    DEFAULT_MT,
+    DEFAULT_MW,
+    run_bsmem_using_model,
+)
+from .stopping import MaxIterations
+
+if TYPE_CHECKING:
+    from astropy import table
+    import numpy as np
+else:
+    table = lazy_import("astropy.table")
+    np = lazy_import("numpy")
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+COLUMNS = [
+    "chi2",
+    "entropy",
+    "alpha",
+    "flux",
+    "iterations",
+    "seconds",
+    "pruned",
+    "outputfile",
+    "error",
+]
+
+
+class SweepResult(NamedTuple):
+    """Outcome of one bsmem run in a sweep.
+
+    Attributes:
+      run:        Position of parameter combination in sweep.
+      params:     Swept parameter values.
+      chi2:       Final chi-squared reported by bsmem.
+      entropy:    Final entropy reported by bsmem.
+      alpha:      Final regularization hyperparameter reported by bsmem.
+      flux:       Final total flux reported by bsmem.
+      iterations: Number of iterations run.
+      seconds:    Wall-clock time for the run(s).
+      pruned:     Run was abandoned as unpromising before convergence.
+      outputfile: Output FITS filename, or None if run failed.
+      error:      Exception raised by failed run, else None.
+
+    """
+
+    run: int
+    params: Dict[str, Any]
+    chi2: Optional[float]
+    entropy: Optional[float]
+    alpha: Optional[float]
+    flux: Optional[float]
+    iterations: int
+    seconds: float
+    pruned: bool
+    outputfile: Optional[str]
+    error: Optional[BaseException]
+
+
+class Pruning(NamedTuple):
+    """Successive-halving settings for pruning a sweep.
+
+    All combinations are first run for min_iterations bsmem iterations.
+    The best 1/eta of them (by score) are then run for eta times as many
+    iterations, and so on until at most final_fraction of the original
+    combinations remain, which are run to convergence.
+
+    Attributes:
+      min_iterations: Iteration budget for first round.
+      eta:            Factor by which combinations are reduced each round.
+      final_fraction: Fraction of combinations to run to convergence.
+
+    """
+
+    min_iterations: int = 20
+    eta: int = 3
+    final_fraction: float = 0.1
+
+
+def param_grid(grid: Mapping[str, Sequence[Any]]) -> List[Dict[str, Any]]:
+    """Return all combinations of parameter values."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def param_sample(
+    ranges: Mapping[str, Tuple[float, float]],
+    n: int,
+    log: Optional[Set[str]] = None,
+    seed: Optional[int] = None,
+) -> List[Dict[str, float]]:
+    """Return random combinations of parameter values.
+
+    Args:
+      ranges: Min and max value for each parameter.
+      n:      Number of combinations.
+      log:    Names of parameters to sample uniformly in log space.
+      seed:   Random number generator seed.
+
+    """
+    rng = random.Random(seed)
+    log = set() if log is None else log
+    samples = []
+    for _ in range(n):
+        sample = {}
+        for name, (lo, hi) in ranges.items():
+            if name in log:
+                sample[name] = math.exp(rng.uniform(math.log(lo), math.log(hi)))
+            else:
+                sample[name] = rng.uniform(lo, hi)
+        samples.append(sample)
+    return samples
+
+
+def _get_sweepdir(datafile: str) -> str:
+    dirname, basename = os.path.split(datafile)
+    stem, _ = os.path.splitext(basename)
+    return os.path.join(dirname, f"bsmem_sweep_{stem}")
+
+
+def _run_one(
+    datafile: str,
+    outputfile: str,
+    params: Dict[str, Any],
+    niter: Optional[int],
+    kwargs: Dict[str, Any],
+) -> Tuple[Optional[IterationRecord], float, Optional[BaseException]]:
+    records: List[IterationRecord] = []
+    start = time.perf_counter()
+    error: Optional[BaseException] = None
+    kwargs = dict(kwargs)
+    dim = kwargs.pop("dim", DEFAULT_DIM)
+    modeltype = kwargs.pop("modeltype", DEFAULT_MT)
+    modelwidth = kwargs.pop("modelwidth", DEFAULT_MW)
+    try:
+        run_bsmem_using_model(
+            datafile,
+            outputfile,
+            dim,
+            modeltype,
+            modelwidth,
+            callback=records.append,
+            stop_policy=None if niter is None else MaxIterations(niter),
+            **params,
+            **kwargs,
+        )
+    except BsmemStopped:
+        # Only partial metrics available, which suffice for pruning
+        pass
+    except Exception as e:
+        logging.error(f"Sweep run {params} failed: {e}")
+        error = e
+    if niter is not None:
+        # Discard partial block output before bsmem was stopped
+        records = [r for r in records if r.iteration <= niter]
+    return (records[-1] if records else None), time.perf_counter() - start, error
+
+
+def score_chi2(record: IterationRecord) -> float:
+    """Return score (lower is better) for pruning: the final chi2."""
+    return math.inf if record.chi2 is None else record.chi2
+
+
+def sweep(
+    datafile: str,
+    combinations: Sequence[Dict[str, Any]],
+    workers: int = DEFAULT_WORKERS,
+    sweepdir: Optional[str] = None,
+    pruning: Optional[Pruning] = None,
+    score: Callable[[IterationRecord], float] = score_chi2,
+    **kwargs,
+) -> List[SweepResult]:
+    """Run bsmem for each combination of parameters concurrently.
+
+    Args:
+      datafile:     Input OIFITS data filename.
+      combinations: Parameter values for each run, e.g. from param_grid().
+      workers:      Maximum number of concurrent bsmem runs.
+      sweepdir:     Directory for output images, default derived from
+                    datafile.
+      pruning:      Settings for abandoning unpromising combinations early.
+      score:        Function giving score (lower is better) used for pruning.
+
+    Keyword arguments accepted by run_bsmem_using_model() (and dim, modeltype,
+    modelwidth) are applied to every run.
+
+    Returns:
+      Result for each combination, in the same order as combinations.
+
+    Raises:
+      ValueError
+
+    """
+    if pruning is not None and pruning.eta < 2:
+        raise ValueError("Pruning factor eta must be at least 2")
+    if sweepdir is None:
+        sweepdir = _get_sweepdir(datafile)
+    os.makedirs(sweepdir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(datafile))[0]
+    n = len(combinations)
+    outputfiles = [
+        os.path.join(sweepdir, f"bsmem_{i:04d}_{stem}.fits") for i in range(n)
+    ]
+    last: List[Optional[IterationRecord]] = [None] * n
+    seconds = [0.0] * n
+    errors: List[Optional[BaseException]] = [None] * n
+    pruned = [False] * n
+
+    def run_round(indices: Sequence[int], niter: Optional[int]) -> None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _run_one,
+                    datafile,
+                    outputfiles[i],
+                    combinations[i],
+                    niter,
+                    kwargs,
+                )
+                for i in indices
+            ]
+            for i, future in zip(indices, futures):
+                record, elapsed, error = future.result()
+                last[i] = record
+                seconds[i] += elapsed
+                errors[i] = error
+
+    survivors = list(range(n))
+    if pruning is not None:
+        target = max(1, math.ceil(pruning.final_fraction * n))
+        niter = pruning.min_iterations
+        while len(survivors) > target:
+            logging.info(
+                f"Sweep: running {len(survivors)} combinations for {niter} iterations"
+            )
+            run_round(survivors, niter)
+            ok = [i for i in survivors if errors[i] is None and last[i] is not None]
+            ok.sort(key=lambda i: score(last[i]))  # type: ignore[arg-type]
+            keep = ok[: max(target, math.ceil(len(survivors) / pruning.eta))]
+            for i in ok:
+                if i not in keep:
+                    pruned[i] = True
+            survivors = sorted(keep)
+            niter *= pruning.eta
+    logging.info(f"Sweep: running {len(survivors)} combinations to convergence")
+    run_round(survivors, None)
+
+    results = []
+    for i in range(n):
+        record = last[i]
+        results.append(
+            SweepResult(
+                i,
+                dict(combinations[i]),
+                None if record is None else record.chi2,
+                None if record is None else record.entropy,
+                None if record is None else record.alpha,
+                None if record is None else record.flux,
+                0 if record is None else record.iteration,
+                seconds[i],
+                pruned[i],
+                outputfiles[i] if errors[i] is None and not pruned[i] else None,
+                errors[i],
+            )
+        )
+    return results
+
+
+def results_table(results: Sequence[SweepResult]) -> table.Table:
+    """Return sweep results as an astropy Table."""
+    names: List[str] = []
+    for r in results:
+        names += [name for name in r.params if name not in names]
+    columns: Dict[str, list] = {"run": []}
+    columns.update({"param_" + name: [] for name in names})
+    columns.update({name: [] for name in COLUMNS})
+    for r in results:
+        columns["run"].append(r.run)
+        for name in names:
+            columns["param_" + name].append(r.params.get(name, np.nan))
+        for name in ["chi2", "entropy", "alpha", "flux"]:
+            value = getattr(r, name)
+            columns[name].append(np.nan if value is None else value)
+        columns["iterations"].append(r.iterations)
+        columns["seconds"].append(r.seconds)
+        columns["pruned"].append(r.pruned)
+        columns["outputfile"].append(r.outputfile or "")
+        columns["error"].append("" if r.error is None else str(r.error))
+    return table.Table(columns)
+
+
+def write_results(
+    results: Sequence[SweepResult], filename: str, overwrite: bool = False
+) -> None:
+    """Write sweep results table as CSV or FITS according to file extension."""
+    table = results_table(results)
+    if os.path.splitext(filename)[1].lower() in [".fits", ".fit", ".fts"]:
+        table.write(filename, format="fits", overwrite=overwrite)
+    else:
+        table.write(filename, format="ascii.csv", overwrite=overwrite)
@@ -0,0 +1,224 @@
+"""Python module to time and profile stages of image reconstruction.
+
+Timed regions of oirunner (FITS I/O, makesf blur and threshold, prior
+staging, bsmem runs, output parsing) are reported as spans to any hooks
+registered with add_hook(). Spans opened while another span is open in
+the same thread or task record it as their parent. When no hooks are
+registered, spans cost almost nothing.
+
+Example:
+  with timing.using_hook(timing.JsonLinesExporter("spans.jsonl")):
+      reconst_grey_2step(datafile, 0.25)
+
+"""
+
+import cProfile
+import contextlib
+import contextvars
+import io
+import itertools
+import json
+import logging
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    TYPE_CHECKING,
+    TextIO,
+    Tuple,
+)
+
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    import pstats
+else:
+    pstats = lazy_import("pstats")
+
+
+class Span(NamedTuple):
+    """Timed region of code.
+
+    Attributes:
+      name:       Name of region, e.g. "bsmem" or "makesf.blur".
+      span_id:    Unique identifier of span.
+      parent_id:  Identifier of enclosing span, or None.
+      start:      Start time (seconds since the epoch).
+      seconds:    Wall-clock duration.
+      attributes: Further details, e.g. child process resource usage.
+
+    """
+
+    name: str
+    span_id: int
+    parent_id: Optional[int]
+    start: float
+    seconds: float
+    attributes: Dict[str, Any]
+
+
+Hook = Callable[[Span], None]
+
+_hooks: List[Hook] = []
+_hooks_lock = threading.Lock()
+_ids = itertools.count(1)
+_current: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar(
+    "oirunner_span", default=None
+)
+
+
+def add_hook(hook: Hook) -> None:
+    """Register function to be called with each completed span."""
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook: Hook) -> None:
+    """Unregister function added by add_hook()."""
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+@contextlib.contextmanager
+def using_hook(hook: Hook) -> Iterator[Hook]:
+    """Context manager registering hook for the duration of a with block."""
+    add_hook(hook)
+    try:
+        yield hook
+    finally:
+        remove_hook(hook)
+        close = getattr(hook, "close", None)
+        if close is not None:
+            close()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """Context manager timing a region of code.
+
+    Yields a dictionary of span attributes, which may be updated within
+    the with block. If an exception is raised, its repr is recorded as
+    the "error" attribute.
+
+    """
+    if not _hooks:
+        yield attributes
+        return
+    span_id = next(_ids)
+    parent_id = _current.get()
+    token = _current.set(span_id)
+    start = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = repr(e)
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        _current.reset(token)
+        _emit(Span(name, span_id, parent_id, start, seconds, attributes))
+
+
+def _emit(record: Span) -> None:
+    with _hooks_lock:
+        hooks = list(_hooks)
+    for hook in hooks:
+        try:
+            hook(record)
+        except Exception:
+            logging.exception(f"Timing hook {hook!r} failed")
+
+
+class SpanRecorder:
+    """Hook that keeps spans in memory.
+
+    Attributes:
+      spans: Completed spans, in order of completion.
+
+    """
+
+    def __init__(self) -> None:
+        """Create empty recorder."""
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record: Span) -> None:
+        """Record span."""
+        with self._lock:
+            self.spans.append(record)
+
+    def summary(self) -> Dict[str, Tuple[int, float]]:
+        """Return count and total seconds of spans, by name."""
+        result: Dict[str, Tuple[int, float]] = {}
+        with self._lock:
+            for record in self.spans:
+                count, total = result.get(record.name, (0, 0.0))
+                result[record.name] = (count + 1, total + record.seconds)
+        return result
+
+
+class JsonLinesExporter:
+    """Hook that appends spans to a file, one JSON object per line.
+
+    Attributes:
+      filename: Output filename.
+
+    """
+
+    def __init__(self, filename: str):
+        """Open output file for appending."""
+        self.filename = filename
+        self._file: Optional[TextIO] = open(filename, "a")
+        self._lock = threading.Lock()
+
+    def __call__(self, record: Span) -> None:
+        """Write span to file."""
+        line = json.dumps(record._asdict(), default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+                self._file.flush()
+
+    def close(self) -> None:
+        """Close output file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+@contextlib.contextmanager
+def profile(
+    filename: Optional[str] = None, sort: str = "cumulative", limit: int = 30
+) -> Iterator[cProfile.Profile]:
+    """Context manager profiling Python code in the calling thread.
+
+    Code run in other threads (e.g. by the parallel drivers) or in bsmem
+    itself is not profiled.
+
+    Args:
+      filename: Destination for profile data in pstats format. If None,
+                the top entries are logged instead.
+      sort:     Sort order for logged entries.
+      limit:    Number of entries to log.
+
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if filename is not None:
+            profiler.dump_stats(filename)
+        else:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+            logging.info(f"Profile:\n{stream.getvalue()}")
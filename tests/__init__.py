@@ -1 +1,7 @@
 """Tests of oirunner."""
+
+from oirunner import bsmemcache
+
+# Keep tests from reusing, or adding to, the user's cache of bsmem results.
+# Tests of the cache set their own default cache in a temporary directory.
+bsmemcache.set_default_cache(None)
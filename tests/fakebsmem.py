@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Stand-in for the bsmem executable, for tests and benchmarks.
+
+Accepts the command-line arguments built by oirunner.runbsmem, prints
+bsmem-like iteration output and writes a Gaussian FITS image to the
+output file. Only the standard library is used, so that the stub starts
+quickly under any Python 3 interpreter.
+
+Behaviour is controlled by environment variables:
+
+  FAKEBSMEM_NITER: Number of iterations to print (default 10).
+  FAKEBSMEM_SF_NITER: Number of iterations to print when given a prior
+                    image (default FAKEBSMEM_NITER).
+  FAKEBSMEM_DELAY: Delay before each iteration in seconds (default 0).
+  FAKEBSMEM_SPIN:  CPU time to spend computing in each iteration in
+                   seconds (default 0).
+  FAKEBSMEM_LINES: Extra lines of output per iteration (default 0).
+  FAKEBSMEM_EXIT:  Exit with this status without writing output (default 0).
+
+"""
+
+import math
+import os
+import struct
+import sys
+import time
+
+VERSION = "fakebsmem 1.0"
+MAS_TO_DEG = 1 / 3600 / 1000
+BLOCK = 2880
+
+
+def _card(key, value):
+    """Return fixed-format header card, value right-justified to column 30."""
+    if isinstance(value, bool):
+        value = "%20s" % ("T" if value else "F")
+    elif isinstance(value, str):
+        # Strings start at column 11
+        value = "'%-8s'" % value
+    elif isinstance(value, float):
+        value = "%20.13E" % value
+    else:
+        value = "%20d" % value
+    return "%-8s= %s" % (key, value)
+
+
+def write_image(filename, dim, pixelsize, fwhm):
+    """Write dim x dim Gaussian image with given pixelsize and fwhm (mas)."""
+    cards = [
+        _card("SIMPLE", True),
+        _card("BITPIX", -64),
+        _card("NAXIS", 2),
+        _card("NAXIS1", dim),
+        _card("NAXIS2", dim),
+        _card("CTYPE1", "RA---SIN"),
+        _card("CTYPE2", "DEC--SIN"),
+        _card("CRPIX1", dim / 2 + 1),
+        _card("CRPIX2", dim / 2 + 1),
+        _card("CRVAL1", 0.0),
+        _card("CRVAL2", 0.0),
+        _card("CDELT1", pixelsize * MAS_TO_DEG),
+        _card("CDELT2", pixelsize * MAS_TO_DEG),
+        "END",
+    ]
+    header = "".join("%-80s" % card for card in cards)
+    header += " " * (-len(header) % BLOCK)
+    sigma = fwhm / pixelsize / 2.3548
+    row = [math.exp(-((i - dim / 2) ** 2) / (2 * sigma * sigma)) for i in range(dim)]
+    data = struct.pack(">%dd" % (dim * dim), *[y * x for y in row for x in row])
+    data += b"\0" * (-len(data) % BLOCK)
+    with open(filename, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(data)
+
+
+def spin(seconds):
+    """Keep one CPU busy for the given amount of process CPU time."""
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+def main(argv):
+    """Run stub with command-line arguments argv."""
+    if "-V" in argv:
+        print(VERSION)
+        return 0
+    args = dict(arg[2:].split("=", 1) for arg in argv if "=" in arg)
+    for name in ["data", "sf"]:
+        if name in args and not os.path.exists(args[name]):
+            print(f"Cannot open '{args[name]}'", file=sys.stderr)
+            return 1
+    if "data" not in args or "output" not in args:
+        print("Usage: bsmem --data=FILE --output=FILE ...", file=sys.stderr)
+        return 1
+    if os.path.exists(args["output"]) and "--clobber" not in argv:
+        print(f"'{args['output']}' exists", file=sys.stderr)
+        return 1
+    niter = int(os.environ.get("FAKEBSMEM_NITER", "10"))
+    if "sf" in args:
+        niter = int(os.environ.get("FAKEBSMEM_SF_NITER", str(niter)))
+    delay = float(os.environ.get("FAKEBSMEM_DELAY", "0"))
+    nlines = int(os.environ.get("FAKEBSMEM_LINES", "0"))
+    cpu = float(os.environ.get("FAKEBSMEM_SPIN", "0"))
+    status = int(os.environ.get("FAKEBSMEM_EXIT", "0"))
+    alpha = float(args.get("alpha", "1000.0"))
+    print(VERSION)
+    print(f"Reading '{args['data']}'")
+    for i in range(1, niter + 1):
+        if delay > 0:
+            time.sleep(delay)
+        if cpu > 0:
+            spin(cpu)
+        chi2 = 1.0 + 100.0 * math.exp(-i / 3)
+        print(f"Iteration {i}")
+        print(f"  Chi2 = {chi2:.6e}  Entropy = {-0.1 * i:.6e}")
+        print(f"  Alpha = {alpha:.6e}  Flux = {1.0:.6e}")
+        for j in range(nlines):
+            print(f"  Diagnostic {j}: {i * j}")
+        sys.stdout.flush()
+    if status != 0:
+        print("Reconstruction failed", file=sys.stderr)
+        return status
+    dim = int(args.get("dim", "128"))
+    pixelsize = float(args.get("pixelsize", "0.25"))
+    write_image(args["output"], dim, pixelsize, float(args.get("mw", "10.0")))
+    print(f"Wrote '{args['output']}'")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,193 @@
+import asyncio
+import os
+import stat
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfile
+from unittest import mock
+
+import oirunner.runbsmem as runbs
+from oirunner import asyncbsmem
+
+DATAFILE = "tests/2004contest1.oifits"
+IMAGEFILE = "tests/gauss10.fits"
+
+# Records its arguments, then writes an output image
+SCRIPT = """#!/bin/sh
+echo "$@" >> "{argsfile}"
+for arg in "$@"; do
+  case "$arg" in --output=*) cp "{imagefile}" "${{arg#--output=}}";; esac
+done
+echo "Iteration 1"
+echo "Chi2 = 10.0"
+"""
+
+
+class AsyncBsmemTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        dirname = self.tempdir.name
+        self.datafile = os.path.join(dirname, os.path.basename(DATAFILE))
+        copyfile(DATAFILE, self.datafile)
+        self.argsfile = os.path.join(dirname, "args.txt")
+        exe = os.path.join(dirname, "fakebsmem")
+        with open(exe, "w") as f:
+            f.write(
+                SCRIPT.format(
+                    argsfile=self.argsfile, imagefile=os.path.abspath(IMAGEFILE)
+                )
+            )
+        os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR)
+        patcher = mock.patch.object(runbs, "BSMEM", exe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _argslines(self):
+        with open(self.argsfile) as f:
+            return [line.split() for line in f]
+
+    def test_same_args(self):
+        """Test async and sync versions run bsmem with the same arguments"""
+        kwargs = dict(pixelsize=0.25, wav=(500.0, 600.0), alpha=100.0, v2a=1.1)
+        out = runbs.reconst_grey_2step(self.datafile, use_cache=False, **kwargs)
+        self.assertTrue(os.path.exists(out))
+        records = []
+        out = asyncio.run(
+            asyncbsmem.async_reconst_grey_2step(
+                self.datafile, use_cache=False, callback=records.append, **kwargs
+            )
+        )
+        self.assertTrue(os.path.exists(out))
+        self.assertEqual([r.chi2 for r in records], [10.0, 10.0])
+        self.assertEqual(out.records, records[1:])
+        lines = self._argslines()
+        self.assertEqual(len(lines), 4)
+        for sync, async_ in [(lines[0], lines[2]), (lines[1], lines[3])]:
+            strip = [a for a in sync if not a.startswith("--sf=")]
+            self.assertEqual(strip, [a for a in async_ if not a.startswith("--sf=")])
+
+    def test_using_image(self):
+        """Test async reconstruction using a prior image"""
+        out = asyncio.run(
+            asyncbsmem.async_reconst_grey_basic_using_image(
+                self.datafile, IMAGEFILE, use_cache=False
+            )
+        )
+        self.assertTrue(os.path.exists(out))
+        self.assertIn("--dim=128", self._argslines()[0])
+
+    def test_semaphore(self):
+        """Test concurrent runs are limited by semaphore"""
+        script = "echo start >> {0}; sleep 0.3; echo Iteration 1".format(self.argsfile)
+
+        async def main():
+            semaphore = asyncio.Semaphore(2)
+            await asyncio.gather(
+                *[
+                    asyncbsmem.async_run_bsmem(
+                        ["sh", "-c", script], semaphore=semaphore
+                    )
+                    for _ in range(4)
+                ]
+            )
+
+        start = time.monotonic()
+        asyncio.run(main())
+        self.assertGreaterEqual(time.monotonic() - start, 0.6)
+        self.assertEqual(len(self._argslines()), 4)
+
+    def test_cancel(self):
+        """Test cancellation kills bsmem subprocess"""
+        pidfile = os.path.join(self.tempdir.name, "pid")
+        script = f"echo $$ > {pidfile}; echo Iteration 1; exec sleep 30"
+
+        async def main():
+            task = asyncio.ensure_future(
+                asyncbsmem.async_run_bsmem(["sh", "-c", script])
+            )
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        start = time.monotonic()
+        asyncio.run(main())
+        self.assertLess(time.monotonic() - start, 10.0)
+        with open(pidfile) as f:
+            pid = int(f.read())
+        time.sleep(0.1)
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pid, 0)
+
+    def test_timeout(self):
+        """Stopped by wall-clock limit, should fail with BsmemStopped"""
+        with self.assertRaises(runbs.BsmemStopped) as cm:
+            asyncio.run(
+                asyncbsmem.async_run_bsmem(
+                    ["sh", "-c", "echo Iteration 1; exec sleep 30"], timeout=0.3
+                )
+            )
+        self.assertIn("wall-clock", cm.exception.reason)
+
+    def test_isolate(self):
+        """Test isolated runs write into private directory, one at a time"""
+
+        async def main():
+            return await asyncio.gather(
+                *[
+                    asyncbsmem.async_reconst_grey_basic(
+                        self.datafile, use_cache=False, isolate=True
+                    )
+                    for _ in range(2)
+                ]
+            )
+
+        results = asyncio.run(main())
+        self.assertEqual(results[0].outputfile, results[1].outputfile)
+        self.assertTrue(os.path.exists(results[0].outputfile))
+        outputs = [
+            arg[len("--output=") :]
+            for line in self._argslines()
+            for arg in line
+            if arg.startswith("--output=")
+        ]
+        self.assertEqual(len(outputs), 2)
+        for output in outputs:
+            self.assertNotEqual(output, results[0].outputfile)
+            self.assertTrue(
+                os.path.basename(os.path.dirname(output)).startswith(".bsmem-")
+            )
+            self.assertFalse(os.path.exists(os.path.dirname(output)))
+
+    def test_isolate_many(self):
+        """Test many duplicate isolated runs do not exhaust executor threads"""
+        outputfile = runbs._get_outputfile(self.datafile, 1, None)
+        held = runbs._lock_output(outputfile)
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(ThreadPoolExecutor(4))
+            # Lock held elsewhere is polled for
+            loop.call_later(0.2, runbs._unlock_output, held)
+            return await asyncio.wait_for(
+                asyncio.gather(
+                    *[
+                        asyncbsmem.async_reconst_grey_basic(
+                            self.datafile, use_cache=False, isolate=True
+                        )
+                        for _ in range(8)
+                    ]
+                ),
+                30.0,
+            )
+
+        start = time.perf_counter()
+        results = asyncio.run(main())
+        self.assertGreater(time.perf_counter() - start, 0.2)
+        self.assertEqual(len(self._argslines()), 8)
+        self.assertTrue(all(r.outputfile == outputfile for r in results))
@@ -0,0 +1,255 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from unittest import mock
+
+import oirunner.runbsmem as runbs
+from oirunner.batch import (
+    BatchJob,
+    get_job_args,
+    get_job_key,
+    plan_batch,
+    read_manifest,
+    run_batch,
+)
+from oirunner.bsmembatch.__main__ import create_parser, main, runbatch
+
+from .test_runbsmem import FAKEBSMEM
+
+DATAFILE = "tests/2004contest1.oifits"
+IMAGEFILE = "tests/gauss10.fits"
+
+TOML = """\
+[defaults]
+pixelsize = 0.25
+dim = 32
+
+[[jobs]]
+datafile = "a.oifits"
+wav = [500, 600]
+
+[[jobs]]
+name = "two"
+datafile = "a.oifits"
+method = "2step"
+alpha = 1000
+"""
+
+CSV = """\
+name,datafile,method,pixelsize,dim,wav,alpha
+,a.oifits,,0.25,32,"[500, 600]",
+two,a.oifits,2step,0.25,32,,1000
+"""
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self, name, text):
+        filename = os.path.join(self.dirname, name)
+        with open(filename, "w") as f:
+            f.write(text)
+        return filename
+
+    def test_formats(self):
+        """Test TOML, JSON and CSV manifests give same jobs"""
+        datafile = os.path.join(self.dirname, "a.oifits")
+        expected = [
+            BatchJob(
+                "job0", datafile, {"pixelsize": 0.25, "dim": 32, "wav": (500, 600)}
+            ),
+            BatchJob(
+                "two", datafile, {"pixelsize": 0.25, "dim": 32, "alpha": 1000}, True
+            ),
+        ]
+        manifest = {
+            "defaults": {"pixelsize": 0.25, "dim": 32},
+            "jobs": [
+                {"datafile": "a.oifits", "wav": [500, 600]},
+                {
+                    "name": "two",
+                    "datafile": "a.oifits",
+                    "method": "2step",
+                    "alpha": 1000,
+                },
+            ],
+        }
+        filenames = [
+            self.write("jobs.json", json.dumps(manifest)),
+            self.write("jobs.csv", CSV),
+        ]
+        try:
+            import tomllib  # noqa: F401
+
+            filenames.append(self.write("jobs.toml", TOML))
+        except ImportError:
+            pass
+        for filename in filenames:
+            with self.subTest(filename):
+                self.assertEqual(read_manifest(filename), expected)
+
+    def test_bad_manifest(self):
+        """Unknown format or method, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            read_manifest(self.write("jobs.yaml", "jobs: []"))
+        with self.assertRaises(ValueError):
+            read_manifest(
+                self.write("jobs.json", '[{"datafile": "a.oifits", "method": "3step"}]')
+            )
+        with self.assertRaises(ValueError):
+            read_manifest(self.write("jobs.json", '[{"imagefile": "a.fits"}]'))
+
+
+class PlanTestCase(unittest.TestCase):
+    def test_job_args(self):
+        """Test jobs normalised into bsmem arguments of each run"""
+        job = BatchJob("basic", DATAFILE, {"dim": 32, "alpha": 100.0})
+        outputfile = "tests/bsmem_1_2004contest1.fits"
+        self.assertEqual(
+            get_job_args(job),
+            [
+                runbs.get_model_args(
+                    DATAFILE,
+                    outputfile,
+                    32,
+                    runbs.DEFAULT_MT,
+                    runbs.DEFAULT_MW,
+                    alpha=100.0,
+                )
+            ],
+        )
+        job = BatchJob("2step", DATAFILE, {"pixelsize": 0.25}, True)
+        args1, args2 = get_job_args(job)
+        self.assertIn("--uvmax=110000000.0", args1)
+        self.assertIn(f"--sf=makesf({outputfile},fwhm=1.25,threshold=0.05)", args2)
+        job = BatchJob("image", DATAFILE, {}, imagefile=IMAGEFILE)
+        (args,) = get_job_args(job)
+        self.assertIn(f"--sf={IMAGEFILE}", args)
+        self.assertIn("--dim=128", args)
+
+    def test_key(self):
+        """Test key depends on arguments and data, not job name"""
+        job = BatchJob("a", DATAFILE, {"dim": 32})
+        key = get_job_key(job, get_job_args(job))
+        other = job._replace(name="b")
+        self.assertEqual(get_job_key(other, get_job_args(other)), key)
+        other = job._replace(options={"dim": 64})
+        self.assertNotEqual(get_job_key(other, get_job_args(other)), key)
+        other = job._replace(options={"dim": 32, "timeout": 10.0})
+        self.assertNotEqual(get_job_key(other, get_job_args(other)), key)
+
+    def test_invalid(self):
+        """Test invalid jobs identified without aborting the plan"""
+        jobs = [
+            BatchJob("ok", DATAFILE, {}),
+            BatchJob("unknown", DATAFILE, {"colour": "red"}),
+            BatchJob("missing", "tests/nonexistent.oifits", {}),
+            BatchJob("uvmax", DATAFILE, {"pixelsize": 0.25, "uvmax": 1e8}, True),
+            BatchJob("clobber", DATAFILE, {"alpha": 10.0}),
+        ]
+        plan = plan_batch(jobs)
+        self.assertIsInstance(plan[0], str)
+        self.assertIsInstance(plan[1], ValueError)
+        self.assertIsInstance(plan[2], FileNotFoundError)
+        self.assertIsInstance(plan[3], ValueError)
+        self.assertIsInstance(plan[4], ValueError)
+        self.assertIn("written by job 'ok'", str(plan[4]))
+
+
+@mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+class RunBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tempdir.name
+        for name in ["a.oifits", "b.oifits", "c.oifits"]:
+            shutil.copy(DATAFILE, os.path.join(self.dirname, name))
+        shutil.copy(IMAGEFILE, os.path.join(self.dirname, "prior.fits"))
+        self.manifest = {
+            "defaults": {"use_cache": False},
+            "jobs": [
+                {"name": "a", "datafile": "a.oifits", "dim": 16},
+                {"name": "a-again", "datafile": "a.oifits", "dim": 16},
+                {
+                    "name": "b",
+                    "datafile": "b.oifits",
+                    "method": "2step",
+                    "pixelsize": 0.25,
+                    "dim": 16,
+                    "hash_names": True,
+                    "isolate": True,
+                },
+                {"name": "c", "datafile": "c.oifits", "imagefile": "prior.fits"},
+                {"name": "d", "datafile": "d.oifits"},
+            ],
+        }
+        self.filename = os.path.join(self.dirname, "jobs.json")
+        with open(self.filename, "w") as f:
+            json.dump(self.manifest, f)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_run(self):
+        """Test unique jobs run once, sharing outcome with duplicates"""
+        jobs = read_manifest(self.filename)
+        with mock.patch.object(runbs, "run_bsmem", wraps=runbs.run_bsmem) as run_bsmem:
+            results = run_batch(jobs, workers=2)
+        # a, 2 runs of b, c
+        self.assertEqual(run_bsmem.call_count, 4)
+        self.assertEqual([r.job.name for r in results], ["a", "a-again", "b", "c", "d"])
+        self.assertEqual(
+            [r.duplicate for r in results], [False, True, False, False, False]
+        )
+        self.assertEqual(results[0].outputfile, results[1].outputfile)
+        self.assertEqual(results[0].key, results[1].key)
+        self.assertEqual(results[1].seconds, 0.0)
+        for r in results[:4]:
+            self.assertIsNone(r.error)
+            self.assertTrue(os.path.exists(r.outputfile))
+        self.assertRegex(results[2].outputfile, r"bsmem_2_b_[0-9a-f]{10}\.fits$")
+        self.assertIn(f"--output={results[2].outputfile}", get_job_args(jobs[2])[1])
+        self.assertIsInstance(results[4].error, FileNotFoundError)
+        self.assertIsNone(results[4].key)
+
+    def test_cli(self):
+        """Test command-line interface"""
+        del self.manifest["jobs"][3]["imagefile"]
+        with open(self.filename, "w") as f:
+            json.dump(self.manifest, f)
+        parser = create_parser()
+        with redirect_stdout(io.StringIO()) as stdout, redirect_stderr(io.StringIO()):
+            self.assertEqual(runbatch(parser.parse_args(["-n", self.filename])), 1)
+        self.assertIn("# a-again: duplicate", stdout.getvalue())
+        self.assertEqual(stdout.getvalue().count(FAKEBSMEM), 4)
+        self.assertEqual(os.listdir(self.dirname).count("bsmem_1_a.fits"), 0)
+        with redirect_stdout(io.StringIO()) as stdout, redirect_stderr(
+            io.StringIO()
+        ) as stderr:
+            self.assertEqual(
+                runbatch(parser.parse_args(["-j", "2", "-c", "1", self.filename])), 1
+            )
+        self.assertIn("Ran 3 unique jobs of 5 (1 duplicate", stdout.getvalue())
+        self.assertIn("4 succeeded, 1 failed", stdout.getvalue())
+        self.assertIn("Job 'd' failed", stderr.getvalue())
+
+    def test_cli_nice(self):
+        """--nice without --cpus-per-job, should fail with usage error"""
+        argv = ["runbsmem", "--nice", "5", self.filename]
+        with mock.patch("sys.argv", argv), redirect_stderr(io.StringIO()) as stderr:
+            with self.assertRaises(SystemExit) as cm:
+                main()
+        self.assertEqual(cm.exception.code, 2)
+        self.assertIn("--nice requires --cpus-per-job", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+import gc
+import io
+import os
+import tempfile
+import unittest
+import weakref
+from contextlib import redirect_stdout
+from unittest import mock
+
+from astropy.io import fits
+
+import numpy as np
+
+import oirunner.runbsmem as runbs
+from oirunner.bootstrap import RunningStats, bootstrap, resample, write_maps
+from oirunner.bsmemboot.__main__ import create_parser, makemaps
+
+from .test_runbsmem import FAKEBSMEM
+
+DATAFILE = "tests/2004contest1.oifits"
+
+
+def reconst_mean_vis2(datafile, pixelsize, dim=8, fail=()):
+    """Write image filled with mean squared visibility of data."""
+    if any(name in datafile for name in fail):
+        raise RuntimeError("reconstruction failed")
+    with fits.open(datafile) as hdulist:
+        value = hdulist["OI_VIS2"].data["VIS2DATA"].mean()
+    outputfile = os.path.splitext(datafile)[0] + "_image.fits"
+    hdu = fits.PrimaryHDU(np.full((dim, dim), value))
+    hdu.header["CDELT1"] = pixelsize / 3.6e6
+    hdu.header["CDELT2"] = pixelsize / 3.6e6
+    hdu.writeto(outputfile, overwrite=True)
+    return outputfile
+
+
+class RunningStatsTestCase(unittest.TestCase):
+    def test_stats(self):
+        """Test running mean and variance agree with numpy"""
+        rng = np.random.default_rng(3)
+        data = 1e6 + rng.normal(size=(50, 4, 5))
+        stats = RunningStats()
+        for image in data:
+            stats.add(image)
+        self.assertEqual(stats.count, 50)
+        np.testing.assert_allclose(stats.mean, data.mean(axis=0), rtol=1e-12)
+        np.testing.assert_allclose(stats.variance(), data.var(axis=0, ddof=1))
+        np.testing.assert_allclose(stats.std(ddof=0), data.std(axis=0))
+
+    def test_stats_shape(self):
+        """Different array shapes, should fail with ValueError"""
+        stats = RunningStats()
+        stats.add(np.zeros((4, 4)))
+        with self.assertRaises(ValueError):
+            stats.add(np.zeros((4, 5)))
+        with self.assertRaises(ValueError):
+            stats.variance()
+
+
+class BootstrapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.datafile = os.path.join(self.tempdir.name, os.path.basename(DATAFILE))
+        with fits.open(DATAFILE) as hdulist:
+            hdulist.writeto(self.datafile)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_resample(self):
+        """Test data rows drawn with replacement from original"""
+        with fits.open(DATAFILE) as hdulist:
+            result = resample(hdulist, np.random.default_rng(1))
+            self.assertEqual([h.name for h in result], [h.name for h in hdulist])
+            for name, coord in [("OI_VIS2", "UCOORD"), ("OI_T3", "U1COORD")]:
+                original = hdulist[name].data[coord]
+                coords = result[name].data[coord]
+                self.assertEqual(len(coords), len(original))
+                self.assertTrue(np.all(np.isin(coords, original)))
+                self.assertLess(len(np.unique(coords)), len(np.unique(original)))
+
+    def test_bootstrap(self):
+        """Test statistics of reconstructions from resampled data"""
+        bootdir = os.path.join(self.tempdir.name, "boot")
+        result = bootstrap(
+            self.datafile,
+            8,
+            0.5,
+            workers=3,
+            seed=42,
+            bootdir=bootdir,
+            reconst=reconst_mean_vis2,
+            fail=["boot0003"],
+        )
+        self.assertEqual((result.nsamples, result.failed), (7, 1))
+        self.assertEqual(result.mean.shape, (8, 8))
+        self.assertTrue(np.all(result.std > 0))
+        np.testing.assert_allclose(result.significance, result.mean / result.std)
+        self.assertEqual(os.listdir(bootdir), ["2004contest1_boot0003.oifits"])
+        again = bootstrap(
+            self.datafile, 8, 0.5, seed=42, bootdir=bootdir, reconst=reconst_mean_vis2
+        )
+        self.assertEqual(again.nsamples, 8)
+        mapfile = os.path.join(self.tempdir.name, "maps.fits")
+        write_maps(result, mapfile)
+        with fits.open(mapfile) as hdulist:
+            self.assertEqual(hdulist[0].header["NBOOT"], 7)
+            self.assertAlmostEqual(hdulist[0].header["CDELT1"], 0.5 / 3.6e6)
+            np.testing.assert_allclose(hdulist["STD"].data, result.std)
+            np.testing.assert_allclose(hdulist["SIGNIF"].data, result.significance)
+
+    def test_bootstrap_failed(self):
+        """Too few successful samples, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            bootstrap(
+                self.datafile,
+                2,
+                0.5,
+                reconst=reconst_mean_vis2,
+                fail=["boot0001"],
+            )
+
+    @mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+    def test_bootstrap_bsmem(self):
+        """Test bootstrap using stand-in bsmem, removing intermediate files"""
+        result = bootstrap(self.datafile, 3, 0.25, workers=2, dim=16, use_cache=False)
+        self.assertEqual(result.mean.shape, (16, 16))
+        self.assertEqual(result.nsamples, 3)
+        # stand-in ignores data, so all images are identical
+        self.assertTrue(np.allclose(result.std, 0.0))
+        self.assertTrue(np.all(result.significance == 0.0))
+        self.assertEqual(os.listdir(self.tempdir.name), ["2004contest1.oifits"])
+
+    @mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+    def test_bootstrap_memory(self):
+        """Test sample images released once accumulated"""
+        read = runbs._read_image
+        refs = []
+        alive = []
+
+        def read_image(filename):
+            gc.collect()
+            alive.append(sum(ref() is not None for ref in refs))
+            hdu = read(filename)
+            refs.append(weakref.ref(hdu))
+            return hdu
+
+        with mock.patch.object(runbs, "_read_image", read_image), mock.patch(
+            "oirunner.bootstrap._read_image", read_image
+        ):
+            result = bootstrap(
+                self.datafile, 6, 0.25, workers=2, dim=16, use_cache=False
+            )
+        self.assertEqual(result.nsamples, 6)
+        self.assertLessEqual(max(alive), 1)
+
+    @mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+    @mock.patch.object(runbs, "get_default_cache", return_value=None)
+    def test_cli(self, get_default_cache):
+        """Test command-line interface"""
+        outputfile = os.path.join(self.tempdir.name, "maps.fits")
+        args = create_parser().parse_args(
+            ["-n", "2", "--pixelsize=0.25", "--dim=16", self.datafile, outputfile]
+        )
+        with redirect_stdout(io.StringIO()):
+            makemaps(args)
+        with fits.open(outputfile) as hdulist:
+            self.assertEqual([h.name for h in hdulist], ["PRIMARY", "STD", "SIGNIF"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import stat
+import tempfile
+import unittest
+from shutil import copyfile
+
+from oirunner import bsmemcache
+from oirunner.bsmemcache import ResultCache
+from oirunner.runbsmem import run_bsmem
+
+DATAFILE = "tests/2004contest1.oifits"
+IMAGEFILE = "tests/gauss10.fits"
+
+SCRIPT = """#!/bin/sh
+if [ "$1" = "-V" ]; then echo "fake 1.0"; exit 0; fi
+echo run >> "{countfile}"
+for arg in "$@"; do
+  case "$arg" in --output=*) cp "{imagefile}" "${{arg#--output=}}";; esac
+done
+echo "Iteration 1"
+"""
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        dirname = self.tempdir.name
+        self.cache = ResultCache(os.path.join(dirname, "cache"), maxsize=10**6)
+        self.datafile = os.path.join(dirname, "data.oifits")
+        copyfile(DATAFILE, self.datafile)
+        self.countfile = os.path.join(dirname, "count.txt")
+        self.exe = os.path.join(dirname, "fakebsmem")
+        with open(self.exe, "w") as f:
+            f.write(
+                SCRIPT.format(
+                    countfile=self.countfile, imagefile=os.path.abspath(IMAGEFILE)
+                )
+            )
+        os.chmod(self.exe, os.stat(self.exe).st_mode | stat.S_IXUSR)
+        self.saved = bsmemcache.get_default_cache()
+        bsmemcache.set_default_cache(self.cache)
+
+    def tearDown(self):
+        bsmemcache.set_default_cache(self.saved)
+        self.tempdir.cleanup()
+
+    def _args(self, output, alpha=100.0):
+        return [
+            self.exe,
+            f"--data={self.datafile}",
+            f"--output={output}",
+            f"--alpha={alpha}",
+        ]
+
+    def _runs(self):
+        with open(self.countfile) as f:
+            return len(f.readlines())
+
+    def test_key(self):
+        """Test key depends on arguments and file contents but not output"""
+        key = self.cache.get_key(self._args("a.fits"))
+        self.assertEqual(self.cache.get_key(self._args("b.fits")), key)
+        self.assertNotEqual(self.cache.get_key(self._args("a.fits", 99.0)), key)
+        with open(self.datafile, "ab") as f:
+            f.write(b"\0")
+        self.assertNotEqual(self.cache.get_key(self._args("a.fits")), key)
+
+    def test_run_bsmem(self):
+        """Test identical run is served from cache"""
+        out1 = os.path.join(self.tempdir.name, "out1.fits")
+        out2 = os.path.join(self.tempdir.name, "out2.fits")
+        txt2 = os.path.join(self.tempdir.name, "out2.txt")
+        run_bsmem(self._args(out1), os.path.join(self.tempdir.name, "out1.txt"))
+        self.assertEqual(self._runs(), 1)
+        result = run_bsmem(self._args(out2), txt2)
+        self.assertEqual(self._runs(), 1)
+        self.assertTrue(result.reused)
+        self.assertEqual(result.iterations, 1)
+        self.assertTrue(os.path.exists(out2))
+        with open(txt2) as f:
+            self.assertIn("Iteration 1", f.read())
+        stats = self.cache.stats()
+        self.assertEqual((stats.hits, stats.misses, stats.entries), (1, 1, 1))
+        run_bsmem(self._args(out2), txt2, use_cache=False)
+        self.assertEqual(self._runs(), 2)
+        run_bsmem(self._args(out2, 99.0), txt2)
+        self.assertEqual(self._runs(), 3)
+
+    def test_evict(self):
+        """Test least recently used entries are evicted"""
+        imagesize = os.path.getsize(IMAGEFILE)
+        self.cache.maxsize = 2 * imagesize
+        out = os.path.join(self.tempdir.name, "out.fits")
+        keys = []
+        for alpha in [1.0, 2.0, 3.0]:
+            run_bsmem(self._args(out, alpha))
+            keys.append(self.cache.get_key(self._args(out, alpha)))
+        self.assertEqual(self.cache.stats().entries, 2)
+        self.assertFalse(self.cache.fetch(keys[0], out, None))
+        self.assertTrue(self.cache.fetch(keys[2], out, None))
+        self.cache.clear()
+        self.assertEqual(self.cache.stats(), (0, 0, 0, 0))
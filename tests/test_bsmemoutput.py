@@ -0,0 +1,93 @@
+import os
+import tempfile
+import time
+import unittest
+from subprocess import CalledProcessError
+
+from oirunner.bsmemoutput import IterationParser, parse_iterations
+from oirunner.runbsmem import iter_bsmem, run_bsmem
+
+OUTPUT = """Reading data...
+Iteration 1
+Entropy = -1.5  Chisq = 1200.0  Flux: 0.98
+Current alpha: 4.0e3
+Iteration 2 Chi2 = 300.5
+Entropy = -2.5 Alpha = 2.5d3 Test = 0.12
+"""
+
+SCRIPT = """
+echo "Reading data..."
+for i in 1 2 3; do
+  echo "Iteration $i"
+  echo "Chi2 = $((1000 / i)).0 Entropy = -$i.0"
+  sleep 0.2
+done
+"""
+
+
+class IterationParserTestCase(unittest.TestCase):
+    def test_parse(self):
+        """Test parsing of iteration blocks"""
+        records = list(parse_iterations(OUTPUT.splitlines(keepends=True)))
+        self.assertEqual([r.iteration for r in records], [1, 2])
+        self.assertEqual(records[0].chi2, 1200.0)
+        self.assertEqual(records[0].entropy, -1.5)
+        self.assertEqual(records[0].flux, 0.98)
+        self.assertEqual(records[0].alpha, 4000.0)
+        self.assertEqual(records[1].chi2, 300.5)
+        self.assertEqual(records[1].alpha, 2500.0)
+        self.assertEqual(records[1].metrics["test"], 0.12)
+        self.assertIsNone(records[1].flux)
+        self.assertTrue(records[1].text.startswith("Iteration 2"))
+
+    def test_incremental(self):
+        """Test record is returned when next block starts"""
+        parser = IterationParser()
+        self.assertIsNone(parser.feed("Iteration 1\n"))
+        self.assertIsNone(parser.feed("Chi2 = 10.0\n"))
+        record = parser.feed("Iteration 2\n")
+        self.assertEqual((record.iteration, record.chi2), (1, 10.0))
+        self.assertEqual(parser.finish().iteration, 2)
+        self.assertIsNone(parser.finish())
+
+
+class StreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.fullstdout = os.path.join(self.tempdir.name, "out.txt")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_iter_bsmem(self):
+        """Test records are yielded before process exits"""
+        start = time.monotonic()
+        times = []
+        for record in iter_bsmem(["sh", "-c", SCRIPT], self.fullstdout):
+            times.append(time.monotonic() - start)
+        self.assertEqual(len(times), 3)
+        self.assertLess(times[0], times[-1] - 0.2)
+        with open(self.fullstdout) as f:
+            self.assertEqual(f.read().count("Iteration"), 3)
+
+    def test_callback(self):
+        """Test run_bsmem delivers records to callback"""
+        records = []
+        run_bsmem(["sh", "-c", SCRIPT], self.fullstdout, callback=records.append)
+        self.assertEqual([r.chi2 for r in records], [1000.0, 500.0, 333.0])
+
+    def test_close(self):
+        """Test closing generator kills subprocess"""
+        start = time.monotonic()
+        gen = iter_bsmem(["sh", "-c", "echo Iteration 1; echo Iteration 2; sleep 30"])
+        self.assertEqual(next(gen).iteration, 1)
+        gen.close()
+        self.assertLess(time.monotonic() - start, 10.0)
+
+    def test_failure(self):
+        """Test failed run raises CalledProcessError with stderr"""
+        with self.assertRaises(CalledProcessError) as cm:
+            run_bsmem(["sh", "-c", "echo Iteration 1; echo oops >&2; exit 3"])
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertIn("oops", cm.exception.stderr)
+        self.assertIn("Iteration 1", cm.exception.stdout)
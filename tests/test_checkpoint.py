@@ -0,0 +1,133 @@
+import os
+import pickle
+import stat
+import sys
+import tempfile
+import unittest
+from shutil import copyfile
+from unittest import mock
+
+import oirunner.runbsmem as runbs
+from oirunner.checkpoint import JobManifest
+
+DATAFILE = "tests/2004contest1.oifits"
+IMAGEFILE = "tests/gauss10.fits"
+
+# Logs output filenames and always outputs the same image
+SCRIPT = """#!{python}
+import os, shutil, sys, time
+if sys.argv[1] == "-V":
+    print("fakebsmem 1.0")
+    sys.exit()
+args = dict(a[2:].split("=", 1) for a in sys.argv[1:] if "=" in a)
+with open("{logfile}", "a") as f:
+    f.write(args["output"] + "\\n")
+shutil.copyfile("{imagefile}", args["output"])
+print("Iteration 1", flush=True)
+time.sleep(float(os.environ.get("FAKEBSMEM_DELAY", "0")))
+"""
+
+
+class JobManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        dirname = self.tempdir.name
+        self.datafile = os.path.join(dirname, os.path.basename(DATAFILE))
+        copyfile(DATAFILE, self.datafile)
+        self.logfile = os.path.join(dirname, "runs.log")
+        self.manifestfile = os.path.join(dirname, "job.json")
+        exe = os.path.join(dirname, "fakebsmem")
+        with open(exe, "w") as f:
+            f.write(
+                SCRIPT.format(
+                    python=sys.executable,
+                    logfile=self.logfile,
+                    imagefile=os.path.abspath(IMAGEFILE),
+                )
+            )
+        os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR)
+        patcher = mock.patch.object(runbs, "BSMEM", exe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def runs(self):
+        try:
+            with open(self.logfile) as f:
+                runs = [os.path.basename(line.strip()) for line in f]
+        except FileNotFoundError:
+            return []
+        os.remove(self.logfile)
+        return runs
+
+    def reconst(self, record_stopped=False, **kwargs):
+        return runbs.reconst_grey_2step(
+            self.datafile,
+            0.25,
+            dim=64,
+            checkpoint=JobManifest(self.manifestfile, record_stopped),
+            use_cache=False,
+            **kwargs,
+        )
+
+    def test_resume(self):
+        """Test completed runs are skipped"""
+        out2file = os.fspath(self.reconst())
+        out1file = out2file.replace("bsmem_2_", "bsmem_1_")
+        self.assertEqual(len(self.runs()), 2)
+        self.reconst()
+        self.assertEqual(self.runs(), [])
+        os.remove(out2file)
+        self.reconst()
+        self.assertEqual(self.runs(), [os.path.basename(out2file)])
+        with open(out1file, "ab") as f:
+            f.write(b"\0" * 2880)
+        self.reconst()
+        self.assertEqual(self.runs(), [os.path.basename(out1file)])
+
+    def test_resume_timeout(self):
+        """Test runs stopped by timeout are repeated when resumed"""
+        with mock.patch.dict(os.environ, {"FAKEBSMEM_DELAY": "30"}):
+            self.reconst(timeout=0.5)
+        self.assertEqual(len(self.runs()), 2)
+        self.assertEqual(JobManifest(self.manifestfile).stages(), [])
+        self.reconst()
+        self.assertEqual(len(self.runs()), 2)
+        self.reconst()
+        self.assertEqual(self.runs(), [])
+
+    def test_record_stopped(self):
+        """Test runs stopped early skipped when resumed if requested"""
+        with mock.patch.dict(os.environ, {"FAKEBSMEM_DELAY": "30"}):
+            self.reconst(record_stopped=True, timeout=0.5)
+        self.assertEqual(len(self.runs()), 2)
+        stages = JobManifest(self.manifestfile).stages()
+        self.assertEqual(len(stages), 2)
+        self.assertIn("wall-clock", stages[0].stop_reason)
+        self.reconst(record_stopped=True, timeout=0.5)
+        self.assertEqual(self.runs(), [])
+        self.reconst()
+        self.assertEqual(len(self.runs()), 2)
+
+    def test_changed_args(self):
+        """Test runs repeated when arguments change"""
+        self.reconst(alpha=100.0)
+        self.assertEqual(len(self.runs()), 2)
+        self.reconst(alpha=200.0)
+        self.assertEqual(len(self.runs()), 2)
+
+    def test_manifest(self):
+        """Test manifest contents are shared via file"""
+        out2file = os.fspath(self.reconst())
+        manifest = JobManifest(self.manifestfile)
+        stages = manifest.stages()
+        self.assertEqual(len(stages), 2)
+        self.assertIn(os.path.abspath(out2file), [s.outputfile for s in stages])
+        self.assertEqual(len(pickle.loads(pickle.dumps(manifest)).stages()), 2)
+        manifest.invalidate(out2file)
+        self.assertEqual(len(JobManifest(self.manifestfile).stages()), 1)
+        self.runs()
+        self.reconst()
+        self.assertEqual(self.runs(), [os.path.basename(out2file)])
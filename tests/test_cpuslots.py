@@ -0,0 +1,202 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import oirunner.runbsmem as runbs
+from oirunner import asyncbsmem
+from oirunner.cpuslots import CpuSlot, SlotAllocator, THREAD_VARS, get_layout
+
+from .test_runbsmem import FAKEBSMEM
+
+DATAFILE = "tests/2004contest1.oifits"
+
+# Reports the CPU affinity, thread count and priority it runs with
+SCRIPT = (
+    "grep Cpus_allowed_list /proc/self/status; "
+    'echo "threads $OMP_NUM_THREADS"; '
+    'echo "nice $(nice)"'
+)
+
+
+class LayoutTestCase(unittest.TestCase):
+    def test_layouts(self):
+        """Test compact and scatter layouts of CPUs into slots"""
+        cpus = list(range(8))
+        self.assertEqual(
+            get_layout(cpus, 4, 2, "compact"), [(0, 1), (2, 3), (4, 5), (6, 7)]
+        )
+        self.assertEqual(
+            get_layout(cpus, 4, 2, "scatter"), [(0, 4), (1, 5), (2, 6), (3, 7)]
+        )
+        self.assertEqual(get_layout(cpus, 2, 3, "compact"), [(0, 1, 2), (3, 4, 5)])
+        self.assertEqual(get_layout(cpus, 2, 3, "scatter"), [(0, 2, 4), (1, 3, 5)])
+
+    def test_bad_layout(self):
+        """Too many slots or unknown layout, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            get_layout(list(range(4)), 3, 2)
+        with self.assertRaises(ValueError):
+            get_layout(list(range(4)), 2, 2, "random")
+        with self.assertRaises(ValueError):
+            SlotAllocator(cpus_per_slot=0)
+
+    def test_default(self):
+        """Test default slots use CPUs available to process"""
+        cpus = sorted(os.sched_getaffinity(0))
+        allocator = SlotAllocator()
+        self.assertEqual(len(allocator), len(cpus))
+        self.assertEqual([cpu for slot in allocator.slots for cpu in slot], cpus)
+        self.assertEqual(allocator.threads, 1)
+
+    def test_environ(self):
+        """Test thread counts set in subprocess environment"""
+        slot = CpuSlot(0, (2, 3), 2)
+        env = slot.environ({"PATH": "/bin", "OMP_NUM_THREADS": "64"})
+        self.assertEqual(env["PATH"], "/bin")
+        for name in THREAD_VARS:
+            self.assertEqual(env[name], "2")
+
+
+class AllocatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.allocator = SlotAllocator(2, 2, cpus=range(4))
+
+    def test_acquire(self):
+        """Test slots handed out once each and waited for when all in use"""
+        first = self.allocator.acquire()
+        second = self.allocator.acquire()
+        self.assertEqual((first.cpus, second.cpus), ((0, 1), (2, 3)))
+        self.assertEqual(second.threads, 2)
+        self.assertEqual(self.allocator.free, 0)
+        with self.assertRaises(TimeoutError):
+            self.allocator.acquire(timeout=0.01)
+        timer = threading.Timer(0.05, self.allocator.release, [first])
+        timer.start()
+        start = time.perf_counter()
+        with self.allocator.slot() as slot:
+            self.assertGreater(time.perf_counter() - start, 0.03)
+            self.assertEqual(slot, first)
+        timer.join()
+        self.assertEqual(self.allocator.free, 1)
+
+    def test_release(self):
+        """Release of slot not in use, should fail with ValueError"""
+        slot = self.allocator.acquire()
+        self.allocator.release(slot)
+        with self.assertRaises(ValueError):
+            self.allocator.release(slot)
+
+
+class PinnedRunTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.fullstdout = os.path.join(self.tempdir.name, "stdout.txt")
+        self.cpu = min(os.sched_getaffinity(0))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def check_output(self, nice):
+        with open(self.fullstdout) as f:
+            lines = f.read().splitlines()
+        self.assertIn(f"Cpus_allowed_list:\t{self.cpu}", lines)
+        self.assertIn("threads 1", lines)
+        self.assertIn(f"nice {os.nice(0) + nice}", lines)
+
+    def test_run_bsmem(self):
+        """Test bsmem pinned to slot CPUs with thread count and niceness"""
+        allocator = SlotAllocator(cpus=[self.cpu], nice=5)
+        runbs.run_bsmem(
+            ["sh", "-c", SCRIPT], self.fullstdout, use_cache=False, cpu_slots=allocator
+        )
+        self.check_output(5)
+        self.assertEqual(allocator.free, 1)
+
+    def test_async_run_bsmem(self):
+        """Test async bsmem pinned to slot CPUs with thread count"""
+        allocator = SlotAllocator(cpus=[self.cpu])
+        asyncio.run(
+            asyncbsmem.async_run_bsmem(
+                ["sh", "-c", SCRIPT],
+                self.fullstdout,
+                use_cache=False,
+                cpu_slots=allocator,
+            )
+        )
+        self.check_output(0)
+        self.assertEqual(allocator.free, 1)
+
+    def test_async_many(self):
+        """Test more runs waiting for slots than executor threads"""
+        allocator = SlotAllocator(cpus=[self.cpu])
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            loop.set_default_executor(ThreadPoolExecutor(4))
+            semaphore = asyncio.Semaphore(8)
+            return await asyncio.wait_for(
+                asyncio.gather(
+                    *[
+                        asyncbsmem.async_run_bsmem_using_model(
+                            DATAFILE,
+                            os.path.join(self.tempdir.name, f"out{i}.fits"),
+                            16,
+                            3,
+                            10.0,
+                            use_cache=False,
+                            semaphore=semaphore,
+                            cpu_slots=allocator,
+                        )
+                        for i in range(8)
+                    ]
+                ),
+                30.0,
+            )
+
+        with mock.patch.object(runbs, "BSMEM", FAKEBSMEM):
+            results = asyncio.run(main())
+        self.assertEqual([r.iterations for r in results], [10] * 8)
+        self.assertEqual(allocator.free, 1)
+
+    def test_async_cancel(self):
+        """Test coroutine cancelled while waiting for slot does not take one"""
+        allocator = SlotAllocator(cpus=[self.cpu])
+
+        async def main():
+            slot = allocator.acquire()
+            task = asyncio.ensure_future(allocator.async_acquire())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # Released from another thread
+            task = asyncio.ensure_future(allocator.async_acquire())
+            threading.Timer(0.05, allocator.release, [slot]).start()
+            self.assertEqual(await asyncio.wait_for(task, 5.0), slot)
+            allocator.release(slot)
+
+        asyncio.run(main())
+        self.assertEqual(allocator.free, 1)
+
+    @unittest.skipUnless(shutil.which("ionice"), "ionice not installed")
+    def test_ionice(self):
+        """Test I/O priority of bsmem set from slot"""
+        try:
+            allocator = SlotAllocator(cpus=[self.cpu], ionice=(3, 0))
+        except ValueError as e:
+            self.skipTest(str(e))
+        runbs.run_bsmem(
+            ["ionice"], self.fullstdout, use_cache=False, cpu_slots=allocator
+        )
+        with open(self.fullstdout) as f:
+            self.assertIn("idle", f.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
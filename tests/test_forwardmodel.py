@@ -0,0 +1,171 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from astropy.io import fits
+
+import numpy as np
+
+from oirunner.forwardmodel import ForwardModel, model_vis, score_image
+from oirunner.priorimage import MAS_TO_DEG
+
+DATAFILE = "tests/2004contest1.oifits"
+IMAGEFILE = "tests/gauss10.fits"
+MAS_TO_RAD = np.radians(MAS_TO_DEG)
+
+
+def make_hdu(data, pixelsize, cdelt1_sign=1.0):
+    """Return image HDU with square pixels of given size (mas)."""
+    hdu = fits.PrimaryHDU(data)
+    hdu.header["CDELT1"] = cdelt1_sign * pixelsize * MAS_TO_DEG
+    hdu.header["CDELT2"] = pixelsize * MAS_TO_DEG
+    return hdu
+
+
+class ModelVisTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.u = rng.uniform(-1e8, 1e8, 50)
+        self.v = rng.uniform(-1e8, 1e8, 50)
+
+    def test_gaussian(self):
+        """Test visibilities of Gaussian match analytic transform"""
+        dim, pixelsize, fwhm = 64, 0.25, 2.0
+        x = (np.arange(dim) - dim // 2) * pixelsize
+        sigma = fwhm / 2.3548
+        image = np.exp(-(x[:, np.newaxis] ** 2 + x**2) / (2 * sigma**2))
+        vis = model_vis(image[np.newaxis], self.u, self.v, pixelsize, pixelsize)
+        rho = np.hypot(self.u, self.v)
+        expected = np.exp(-2 * (np.pi * sigma * MAS_TO_RAD * rho) ** 2)
+        np.testing.assert_allclose(vis[0], expected, atol=1e-6)
+
+    def test_binary(self):
+        """Test phase convention for offset point source"""
+        image = np.zeros((16, 16))
+        image[8, 8] = 1.0
+        image[8, 11] = 0.5
+        pixelsize = 0.5
+        vis = model_vis(image[np.newaxis], self.u, self.v, pixelsize, pixelsize)
+        offset = 3 * pixelsize * MAS_TO_RAD
+        expected = (1 + 0.5 * np.exp(-2j * np.pi * self.u * offset)) / 1.5
+        np.testing.assert_allclose(vis[0], expected, atol=1e-12)
+        # Reversing the RA axis mirrors the image
+        mirrored = model_vis(image[np.newaxis], self.u, self.v, -pixelsize, pixelsize)
+        np.testing.assert_allclose(mirrored[0], np.conj(expected), atol=1e-12)
+
+    def test_chunks(self):
+        """Test result independent of chunking and of other images"""
+        rng = np.random.default_rng(2)
+        images = rng.random((3, 8, 12))
+        vis = model_vis(images, self.u, self.v, 0.3, 0.3)
+        with mock.patch("oirunner.forwardmodel.MAX_ELEMENTS", 7):
+            chunked = model_vis(images, self.u, self.v, 0.3, 0.3)
+        np.testing.assert_allclose(chunked, vis)
+        single = model_vis(images[1:2], self.u, self.v, 0.3, 0.3)
+        np.testing.assert_allclose(single[0], vis[1])
+
+    def test_zero_flux(self):
+        """Image with zero total flux, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            model_vis(np.zeros((1, 4, 4)), self.u, self.v, 0.3, 0.3)
+
+
+class ForwardModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.model = ForwardModel(DATAFILE)
+        with fits.open(IMAGEFILE) as hdulist:
+            self.hdu = hdulist[0].copy()
+
+    def test_read(self):
+        """Test squared visibilities and closure phases read from data"""
+        with fits.open(DATAFILE) as hdulist:
+            vis2 = hdulist["OI_VIS2"].data
+            t3 = hdulist["OI_T3"].data
+        self.assertEqual(self.model.nvis2, np.count_nonzero(~vis2["FLAG"]))
+        self.assertEqual(self.model.nt3, np.count_nonzero(~t3["FLAG"]))
+        score = self.model.score(self.hdu)
+        row = score.vis2.row[0]
+        self.assertEqual(score.vis2.data[0], vis2["VIS2DATA"][row])
+        self.assertEqual(score.t3.error[0], t3["T3PHIERR"][score.t3.row[0]])
+        np.testing.assert_allclose(
+            score.vis2.spfreq,
+            np.hypot(vis2["UCOORD"], vis2["VCOORD"])[score.vis2.row] / score.vis2.wave,
+        )
+
+    def test_point_source(self):
+        """Test point source has unit squared visibility, zero closure phase"""
+        data = np.zeros((32, 32))
+        data[10, 20] = 1.0
+        score = self.model.score(make_hdu(data, 0.25))
+        np.testing.assert_allclose(score.vis2.model, 1.0)
+        np.testing.assert_allclose(score.t3.model, 0.0, atol=1e-6)
+        expected = np.mean(((score.vis2.data - 1.0) / score.vis2.error) ** 2)
+        self.assertAlmostEqual(score.chi2_vis2, expected)
+        n = self.model.nvis2 + self.model.nt3
+        self.assertAlmostEqual(
+            score.chi2,
+            (score.chi2_vis2 * self.model.nvis2 + score.chi2_t3 * self.model.nt3) / n,
+        )
+
+    def test_shift(self):
+        """Test score unchanged by shifting image"""
+        data = np.zeros((32, 32))
+        data[8:12, 10:13] = np.random.default_rng(4).random((4, 3))
+        score = self.model.score(make_hdu(data, 0.5))
+        shifted = self.model.score(make_hdu(np.roll(data, (9, 5), (0, 1)), 0.5))
+        np.testing.assert_allclose(shifted.vis2.model, score.vis2.model, atol=1e-9)
+        np.testing.assert_allclose(shifted.t3.model, score.t3.model, atol=1e-6)
+        self.assertTrue(np.all(np.abs(score.t3.residual) * score.t3.error <= 180))
+
+    def test_score_many(self):
+        """Test images scored together match images scored singly"""
+        rng = np.random.default_rng(3)
+        hdus = [
+            make_hdu(rng.random((16, 16)) ** 8, 0.5),
+            self.hdu,
+            make_hdu(rng.random((16, 16)) ** 8, 0.5),
+            make_hdu(rng.random((16, 16)) ** 8, 0.5, -1.0),
+        ]
+        scores = self.model.score_many(hdus)
+        self.assertEqual(len(scores), 4)
+        for hdu, score in zip(hdus, scores):
+            single = self.model.score(hdu)
+            self.assertAlmostEqual(score.chi2, single.chi2)
+            np.testing.assert_allclose(score.t3.model, single.t3.model, atol=1e-9)
+        self.assertNotAlmostEqual(scores[0].chi2, scores[2].chi2)
+
+    def test_not_square(self):
+        """Image with non-square pixels, should fail with ValueError"""
+        self.hdu.header["CDELT2"] *= 2
+        with self.assertRaises(ValueError):
+            self.model.score(self.hdu)
+
+    def test_wav(self):
+        """Wavelength range excluding all data, should fail with ValueError"""
+        self.assertEqual(
+            score_image(DATAFILE, self.hdu, (500.0, 1000.0)).chi2,
+            self.model.score(self.hdu).chi2,
+        )
+        with self.assertRaises(ValueError):
+            ForwardModel(DATAFILE, (2000.0, 2100.0))
+
+    def test_flag(self):
+        """Test flagged and invalid data ignored"""
+        with tempfile.TemporaryDirectory() as dirname:
+            datafile = os.path.join(dirname, "flagged.oifits")
+            with fits.open(DATAFILE) as hdulist:
+                hdulist["OI_VIS2"].data["FLAG"][:10] = True
+                hdulist["OI_VIS2"].data["VIS2ERR"][10] = 0.0
+                hdulist["OI_T3"].data["T3PHI"][0] = np.nan
+                hdulist.writeto(datafile)
+            model = ForwardModel(datafile)
+        self.assertEqual(model.nvis2, self.model.nvis2 - 11)
+        self.assertEqual(model.nt3, self.model.nt3 - 1)
+        score = model.score(self.hdu)
+        self.assertEqual(score.vis2.row[0], 11)
+        self.assertTrue(np.all(np.isfinite(score.t3.residual)))
+
+
+if __name__ == "__main__":
+    unittest.main()
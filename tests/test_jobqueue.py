@@ -0,0 +1,191 @@
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import oirunner.runbsmem as runbs
+from oirunner.bsmemqueue.__main__ import create_parser
+from oirunner.jobqueue import DONE, FAILED, JobQueue, PENDING, RUNNING, Worker
+
+from .test_runbsmem import FAKEBSMEM
+
+DATAFILE = "tests/2004contest1.oifits"
+
+
+def append_line(filename, text):
+    """Job function appending line to file."""
+    with open(filename, "a") as f:
+        f.write(text + "\n")
+    return text
+
+
+def fail_until(filename, attempts):
+    """Job function failing until called the given number of times."""
+    append_line(filename, "attempt")
+    with open(filename) as f:
+        count = len(f.readlines())
+    if count < attempts:
+        raise RuntimeError(f"attempt {count} failed")
+    return count
+
+
+def run_worker(queue, name):
+    """Run worker in child process."""
+    Worker(queue, name).run()
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tempdir.name
+        self.queue = JobQueue(os.path.join(self.dirname, "jobs.db"))
+        self.logfile = os.path.join(self.dirname, "log.txt")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_priority(self):
+        """Test jobs claimed in order of priority then submission"""
+        ids = [
+            self.queue.submit(append_line, self.logfile, "a"),
+            self.queue.submit(append_line, self.logfile, "b", priority=2),
+            self.queue.submit(append_line, self.logfile, "c", priority=2),
+            self.queue.submit(append_line, self.logfile, "d", priority=-1),
+        ]
+        claimed = [self.queue.claim("w").job_id for _ in ids]
+        self.assertEqual(claimed, [ids[1], ids[2], ids[0], ids[3]])
+        self.assertIsNone(self.queue.claim("w"))
+        self.assertEqual(self.queue.counts()[RUNNING], 4)
+
+    def test_run(self):
+        """Test worker records result and timings"""
+        job_id = self.queue.submit(append_line, self.logfile, "a", name="first")
+        self.assertEqual(Worker(self.queue, "w").run(), 1)
+        job = self.queue.get(job_id)
+        self.assertEqual(job.status, DONE)
+        self.assertEqual(job.result, "a")
+        self.assertEqual(job.worker, "w")
+        self.assertEqual(job.function, "tests.test_jobqueue:append_line")
+        self.assertGreaterEqual(job.seconds, 0.0)
+        self.assertGreaterEqual(job.finished, job.started)
+
+    def test_retry(self):
+        """Test failed job retried until it succeeds"""
+        job_id = self.queue.submit(fail_until, self.logfile, 3)
+        self.assertEqual(Worker(self.queue, "w").run(), 3)
+        job = self.queue.get(job_id)
+        self.assertEqual(job.status, DONE)
+        self.assertEqual(job.attempts, 3)
+        self.assertEqual(job.result, 3)
+
+    def test_max_attempts(self):
+        """Test job failed once attempts exhausted"""
+        job_id = self.queue.submit(fail_until, self.logfile, 5, max_attempts=2)
+        Worker(self.queue, "w").run()
+        job = self.queue.get(job_id)
+        self.assertEqual(job.status, FAILED)
+        self.assertEqual(job.error, "RuntimeError: attempt 2 failed")
+        self.assertTrue(self.queue.retry(job_id))
+        self.assertEqual(self.queue.get(job_id).status, PENDING)
+
+    def test_lease_expiry(self):
+        """Test job held by dead worker claimed by another"""
+        queue = JobQueue(self.queue.filename, lease=0.1)
+        job_id = queue.submit(append_line, self.logfile, "a")
+        self.assertEqual(queue.claim("dead").job_id, job_id)
+        self.assertIsNone(queue.claim("live"))
+        time.sleep(0.2)
+        job = queue.claim("live")
+        self.assertEqual((job.job_id, job.attempts), (job_id, 2))
+        self.assertFalse(queue.complete(job_id, "dead", "stale"))
+        self.assertFalse(queue.renew(job_id, "dead"))
+        self.assertTrue(queue.complete(job_id, "live", "fresh"))
+        self.assertEqual(queue.get(job_id).result, "fresh")
+
+    def test_lease_renewed(self):
+        """Test lease renewed while long job runs"""
+        queue = JobQueue(self.queue.filename, lease=0.15)
+        job_id = queue.submit("time:sleep", 0.5)
+        Worker(queue, "w").run()
+        job = queue.get(job_id)
+        self.assertEqual((job.status, job.attempts), (DONE, 1))
+
+    def test_cancel(self):
+        """Test cancelled job is not run"""
+        job_id = self.queue.submit(append_line, self.logfile, "a")
+        self.assertTrue(self.queue.cancel(job_id))
+        self.assertEqual(Worker(self.queue, "w").run(), 0)
+        self.assertFalse(os.path.exists(self.logfile))
+
+    def test_unimportable(self):
+        """Function defined in a local scope, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            self.queue.submit(lambda: None)
+
+    def test_missing_job(self):
+        """Unknown job identifier, should fail with KeyError"""
+        with self.assertRaises(KeyError):
+            self.queue.get(42)
+
+    def test_workers(self):
+        """Test jobs shared between worker processes, each run once"""
+        ids = [self.queue.submit(append_line, self.logfile, str(i)) for i in range(20)]
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=run_worker, args=(self.queue, f"worker{i}"))
+            for i in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+        with open(self.logfile) as f:
+            self.assertEqual(sorted(f.read().split()), sorted(map(str, range(20))))
+        jobs = self.queue.jobs()
+        self.assertEqual([job.job_id for job in jobs], ids)
+        self.assertTrue(all(job.status == DONE and job.attempts == 1 for job in jobs))
+
+    @mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+    def test_reconst(self):
+        """Test queued reconstruction using stand-in bsmem"""
+        datafile = os.path.join(self.dirname, os.path.basename(DATAFILE))
+        with open(DATAFILE, "rb") as fin, open(datafile, "wb") as fout:
+            fout.write(fin.read())
+        job_id = self.queue.submit(
+            runbs.reconst_grey_basic, datafile, 0.25, dim=32, use_cache=False
+        )
+        Worker(self.queue, "w").run()
+        job = self.queue.get(job_id)
+        self.assertEqual(job.status, DONE)
+        self.assertTrue(os.path.exists(job.result))
+
+    @mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+    @mock.patch.object(runbs, "get_default_cache", return_value=None)
+    def test_cli(self, get_default_cache):
+        """Test command-line interface"""
+        datafile = os.path.join(self.dirname, os.path.basename(DATAFILE))
+        with open(DATAFILE, "rb") as fin, open(datafile, "wb") as fout:
+            fout.write(fin.read())
+        database = self.queue.filename
+        parser = create_parser()
+        for argv in [
+            ["submit", "-w", "500", "600", "-w", "600", "700", database, datafile],
+            ["work", "-n", "1", database],
+            ["status", database],
+        ]:
+            args = parser.parse_args(argv)
+            with redirect_stdout(io.StringIO()) as stdout:
+                args.func(args)
+        self.assertIn("done 1", " ".join(stdout.getvalue().split()))
+        jobs = self.queue.jobs()
+        self.assertEqual([job.kwargs["wav"] for job in jobs], [[500, 600], [600, 700]])
+        self.assertEqual([job.status for job in jobs], [DONE, PENDING])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import subprocess
+import sys
+import unittest
+
+from oirunner.lazy import LazyModule, lazy_import
+
+# Dependencies that must not be imported until first use
+HEAVY = ["astropy", "numpy", "scipy"]
+
+# Cumulative import time allowed for each entry point (seconds), well
+# below the time taken to import the heavy dependencies
+IMPORT_BUDGET = 0.5
+
+ENTRY_POINTS = [
+    "oirunner.runbsmem",
+    "oirunner.asyncbsmem",
+    "oirunner.pipeline",
+    "oirunner.forwardmodel",
+    "oirunner.makesf.__main__",
+    "oirunner.bsmemcube.__main__",
+    "oirunner.bsmemsweep.__main__",
+    "oirunner.bsmemqueue.__main__",
+    "oirunner.bsmemboot.__main__",
+    "oirunner.bsmembatch.__main__",
+]
+
+
+def importtime(code):
+    """Run code in new interpreter, returning import times and modules.
+
+    Returns:
+      Cumulative import time (seconds) of each module imported by an import
+      statement, and names of all modules imported.
+
+    """
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            code + "\nimport sys; print(' '.join(sys.modules))",
+        ],
+        capture_output=True,
+        text=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line[len("import time:") :].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) * 1e-6
+    return times, proc.stdout.split()
+
+
+class LazyImportTestCase(unittest.TestCase):
+    def test_proxy(self):
+        """Test module imported on first attribute access"""
+        sys.modules.pop("colorsys", None)
+        colorsys = lazy_import("colorsys")
+        self.assertIsInstance(colorsys, LazyModule)
+        self.assertNotIn("colorsys", sys.modules)
+        self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+        self.assertIn("colorsys", sys.modules)
+        self.assertIs(lazy_import("colorsys"), sys.modules["colorsys"])
+
+    def test_missing(self):
+        """Nonexistent module, should fail with ImportError on use"""
+        module = lazy_import("oirunner.nonexistent")
+        with self.assertRaises(ImportError):
+            module.anything
+
+    def test_entry_points(self):
+        """Test entry points import quickly, without heavy dependencies"""
+        for name in ENTRY_POINTS:
+            with self.subTest(name):
+                times, modules = importtime(f"import {name}")
+                self.assertIn(name, times)
+                self.assertEqual([m for m in HEAVY if m in modules], [])
+                self.assertLess(times[name], IMPORT_BUDGET)
+
+    def test_version(self):
+        """Test "-V" option of scripts does not import heavy dependencies"""
+        for name in ENTRY_POINTS:
+            if not name.endswith(".__main__"):
+                continue
+            with self.subTest(name):
+                _, modules = importtime(
+                    f"from {name} import create_parser\n"
+                    "try:\n"
+                    "    create_parser().parse_args(['-V'])\n"
+                    "except SystemExit:\n"
+                    "    pass"
+                )
+                self.assertIn(name, modules)
+                self.assertEqual([m for m in HEAVY if m in modules], [])
+
+    def test_used(self):
+        """Test heavy dependencies imported when needed"""
+        _, modules = importtime(
+            "from oirunner.priorimage import gaussian_kernel; gaussian_kernel(1.0)"
+        )
+        self.assertIn("numpy", modules)
+        self.assertNotIn("scipy", modules)
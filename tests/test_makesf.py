@@ -1,13 +1,23 @@
+import io
 import os
 import tempfile
+import time
 import unittest
+from contextlib import redirect_stderr
 
 from astropy import wcs
 from astropy.io import fits
 
 import numpy as np
 
-from oirunner.makesf.__main__ import COPY_KEYWORDS, create_parser, makeimage
+from oirunner.makesf.__main__ import (
+    COPY_KEYWORDS,
+    create_batch_parser,
+    create_parser,
+    get_outputimage,
+    makebatch,
+    makeimage,
+)
 from oirunner.priorimage import MAS_TO_DEG
 
 
@@ -69,6 +79,132 @@ class MakesfTestCase(unittest.TestCase):
             for kw in COPY_KEYWORDS:
                 self.assertEqual(hdulist[0].header[kw], self.hdu.header[kw])
 
+    def test_makeimage_lowmem(self):
+        """Test low-memory single precision blur and threshold"""
+        args = self.parser.parse_args(
+            [
+                "--overwrite",
+                "--low-memory",
+                "--float32",
+                self.imageName,
+                self.tempResult.name,
+                "2.0",
+                "0.1",
+            ]
+        )
+        makeimage(args)
+        with fits.open(self.tempResult.name) as hdulist:
+            self.assertEqual(hdulist[0].header["BITPIX"], -32)
+            self.assertAlmostEqual(hdulist[0].data.max(), 1.0, places=6)
+            self.assertEqual(hdulist[0].header["OBJECT"], "alf Ori")
+
+    def test_makeimage_cube(self):
+        """Test image cube blur and threshold"""
+        cube = np.stack([self.hdu.data, 2.0 * self.hdu.data])
+        fits.PrimaryHDU(cube, header=self.hdu.header).writeto(
+            self.imageName, overwrite=True
+        )
+        args = self.parser.parse_args(
+            ["--overwrite", self.imageName, self.tempResult.name, "2.0", "0.1"]
+        )
+        makeimage(args)
+        with fits.open(self.tempResult.name) as hdulist:
+            self.assertEqual(hdulist[0].data.shape, (2, 64, 64))
+            self.assertAlmostEqual(hdulist[0].data[1].max(), 2.0)
+            self.assertEqual(hdulist[0].header["OBJECT"], "alf Ori")
+
+
+class MakesfBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parser = create_batch_parser()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirname = self.tempdir.name
+        w = wcs.WCS(naxis=2)
+        w.wcs.cdelt = [0.5 * MAS_TO_DEG, 0.5 * MAS_TO_DEG]
+        self.inputs = []
+        for i in range(3):
+            data = np.zeros([32, 32], float)
+            data[16, 10 + i] = 1.0
+            name = os.path.join(self.dirname, f"image{i}.fits")
+            fits.PrimaryHDU(data, header=w.to_header()).writeto(name)
+            self.inputs.append(name)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def batch(self, *argv):
+        args = self.parser.parse_args(
+            ["--batch", "--fwhm=2.0", "--threshold=0.1", "-j", "2"] + list(argv)
+        )
+        with redirect_stderr(io.StringIO()):
+            return makebatch(args)
+
+    def test_batch(self):
+        """Test batch processing with up-to-date outputs skipped"""
+        results = self.batch(os.path.join(self.dirname, "image*.fits"))
+        self.assertEqual([r.inputimage for r in results], self.inputs)
+        self.assertFalse(any(r.skipped or r.error for r in results))
+        for r in results:
+            self.assertEqual(r.outputimage, r.inputimage.replace(".fits", "_sf.fits"))
+            self.assertTrue(os.path.exists(r.outputimage))
+        results = self.batch(*self.inputs)
+        self.assertTrue(all(r.skipped for r in results))
+        future = time.time() + 10
+        os.utime(self.inputs[1], (future, future))
+        results = self.batch(*self.inputs)
+        self.assertEqual([r.skipped for r in results], [True, False, True])
+        results = self.batch("--check=hash", *self.inputs)
+        self.assertTrue(all(r.skipped for r in results))
+        results = self.batch("--check=hash", "--blank=0.001", *self.inputs)
+        self.assertFalse(any(r.skipped for r in results))
+        results = self.batch("--check=hash", "--blank=0.001", "--float32", *self.inputs)
+        self.assertFalse(any(r.skipped for r in results))
+        results = self.batch("--low-memory", "-j", "1", "--overwrite", *self.inputs)
+        self.assertFalse(any(r.skipped or r.error for r in results))
+
+    def test_rerun(self):
+        """Test outputs of previous run not treated as inputs"""
+        pattern = os.path.join(self.dirname, "*.fits")
+        results = self.batch(pattern)
+        self.assertEqual([r.inputimage for r in results], self.inputs)
+        results = self.batch(pattern)
+        self.assertEqual([r.inputimage for r in results], self.inputs)
+        self.assertTrue(all(r.skipped for r in results))
+        self.assertEqual(len(os.listdir(self.dirname)), 6)
+        outdir = os.path.join(self.dirname, "priors")
+        os.mkdir(outdir)
+        self.batch(pattern, "--output", outdir + os.sep)
+        results = self.batch(pattern, os.path.join(outdir, "*.fits"))
+        self.assertEqual([r.inputimage for r in results], self.inputs)
+        self.assertEqual(len(os.listdir(outdir)), 3)
+
+    def test_list_outputdir(self):
+        """Test list file and output directory"""
+        listfile = os.path.join(self.dirname, "inputs.txt")
+        with open(listfile, "w") as f:
+            f.write("# priors\n" + "\n".join(self.inputs[:2]) + "\n\n")
+        outdir = os.path.join(self.dirname, "priors")
+        os.mkdir(outdir)
+        results = self.batch("-l", listfile, "--output", outdir)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sorted(os.listdir(outdir)), ["image0.fits", "image1.fits"])
+
+    def test_error(self):
+        """Test per-file error reporting"""
+        badfile = os.path.join(self.dirname, "bad.fits")
+        with open(badfile, "w") as f:
+            f.write("not FITS")
+        results = self.batch(self.inputs[0], badfile, self.inputs[1])
+        self.assertEqual([r.error is None for r in results], [True, False, True])
+        self.assertTrue(os.path.exists(results[2].outputimage))
+
+    def test_output_template(self):
+        """Test output filename template"""
+        self.assertEqual(
+            get_outputimage("out/{stem}.prior{ext}", "in/a.fits"), "out/a.prior.fits"
+        )
+        self.assertEqual(get_outputimage("{dir}/sf_{name}", "a.fits"), "./sf_a.fits")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,206 @@
+import os
+import pickle
+import tempfile
+import unittest
+from unittest import mock
+
+from astropy.io import fits
+
+import numpy as np
+
+import oirunner.runbsmem as runbs
+from oirunner.oiselect import DataIndex, DataSelector
+
+DATAFILE = "tests/2004contest1.oifits"
+NWAVE = 4
+
+_ROW_COLUMNS = [
+    "TARGET_ID",
+    "TIME",
+    "MJD",
+    "INT_TIME",
+    "UCOORD",
+    "VCOORD",
+    "U1COORD",
+    "V1COORD",
+    "U2COORD",
+    "V2COORD",
+    "STA_INDEX",
+]
+
+
+def make_multichannel(filename, nwave=NWAVE):
+    """Write copy of test data with nwave channels from 550 nm in 50 nm steps."""
+    with fits.open(DATAFILE) as hdulist:
+        hdus = [hdulist[0].copy()]
+        for hdu in hdulist[1:]:
+            if hdu.name == "OI_WAVELENGTH":
+                waves = 550e-9 + 50e-9 * np.arange(nwave)
+                cols = [
+                    fits.Column("EFF_WAVE", "E", "m", array=waves),
+                    fits.Column("EFF_BAND", "E", "m", array=np.full(nwave, 50e-9)),
+                ]
+            elif hdu.name in ["OI_VIS2", "OI_T3"]:
+                cols = []
+                for col in hdu.columns:
+                    array, fmt = hdu.data[col.name], col.format
+                    if col.name not in _ROW_COLUMNS:
+                        array = np.repeat(array.reshape(-1, 1), nwave, axis=1)
+                        fmt = "%d%s" % (nwave, col.format.format)
+                    cols.append(fits.Column(col.name, fmt, col.unit, array=array))
+            else:
+                hdus.append(hdu.copy())
+                continue
+            hdus.append(fits.BinTableHDU.from_columns(cols, header=hdu.header))
+        fits.HDUList(hdus).writeto(filename)
+
+
+def uvradius(hdu, wave):
+    """Return largest uv radius of each row of data table at wavelength (m)."""
+    data = hdu.data
+    if hdu.name == "OI_T3":
+        u1, v1, u2, v2 = (data[k] for k in ["U1COORD", "V1COORD", "U2COORD", "V2COORD"])
+        baseline = np.max(
+            [np.hypot(u1, v1), np.hypot(u2, v2), np.hypot(u1 + u2, v1 + v2)], axis=0
+        )
+    else:
+        baseline = np.hypot(data["UCOORD"], data["VCOORD"])
+    return baseline / wave
+
+
+class DataIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.datafile = os.path.join(self.tempdir.name, "multi.oifits")
+        make_multichannel(self.datafile)
+        self.index = DataIndex(self.datafile)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_select_all(self):
+        """Test selecting everything returns all data"""
+        hdulist = self.index.select()
+        with fits.open(self.datafile) as original:
+            self.assertEqual([h.name for h in hdulist], [h.name for h in original])
+            for name in ["OI_WAVELENGTH", "OI_VIS2", "OI_T3"]:
+                self.assertEqual(len(hdulist[name].data), len(original[name].data))
+
+    def test_select_wav(self):
+        """Test channels outside wavelength range removed"""
+        hdulist = self.index.select(wav=(590.0, 660.0))
+        np.testing.assert_allclose(
+            hdulist["OI_WAVELENGTH"].data["EFF_WAVE"], [600e-9, 650e-9]
+        )
+        with fits.open(self.datafile) as original:
+            for name, col in [("OI_VIS2", "VIS2DATA"), ("OI_T3", "T3PHI")]:
+                self.assertEqual(hdulist[name].data[col].shape[1], 2)
+                np.testing.assert_array_equal(
+                    hdulist[name].data[col], original[name].data[col][:, 1:3]
+                )
+                self.assertEqual(
+                    hdulist[name].header["INSNAME"], original[name].header["INSNAME"]
+                )
+
+    def test_select_uvmax(self):
+        """Test rows kept if and only if any selected point within uvmax"""
+        uvmax = 8e7
+        hdulist = self.index.select(wav=(590.0, 660.0), uvmax=uvmax)
+        with fits.open(self.datafile) as original:
+            for name in ["OI_VIS2", "OI_T3"]:
+                keep = uvradius(original[name], 650e-9) <= uvmax
+                self.assertTrue(0 < keep.sum() < len(keep))
+                np.testing.assert_array_equal(
+                    hdulist[name].data["MJD"], original[name].data["MJD"][keep]
+                )
+
+    def test_written_subset(self):
+        """Test subset written to file can be read back"""
+        filename = os.path.join(self.tempdir.name, "subset.oifits")
+        self.index.write(filename, wav=(540.0, 560.0), uvmax=5e7)
+        with fits.open(filename) as hdulist:
+            self.assertEqual(len(hdulist["OI_WAVELENGTH"].data), 1)
+            self.assertEqual(hdulist["OI_VIS2"].columns["VIS2DATA"].format, "1D")
+            self.assertEqual(hdulist["OI_T3"].header["OI_REVN"], 1)
+
+    def test_select_nodata(self):
+        """No channels in wavelength range, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            self.index.select(wav=(700.0, 800.0))
+        with self.assertRaises(ValueError):
+            self.index.select(uvmax=1e6)
+
+
+class DataSelectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.subsetdir = os.path.join(self.tempdir.name, "subsets")
+        self.datafile = os.path.join(self.tempdir.name, "contest.oifits")
+        with fits.open(DATAFILE) as hdulist:
+            hdulist.writeto(self.datafile)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_reuse(self):
+        """Test subset written once and data file indexed once"""
+        selector = DataSelector(self.subsetdir)
+        filename1 = selector.subset(self.datafile, (500.0, 600.0), 1.1e8)
+        self.assertEqual(os.path.dirname(filename1), self.subsetdir)
+        filename2 = selector.subset(self.datafile, (500, 600), 1.1e8)
+        self.assertEqual(filename2, filename1)
+        filename3 = selector.subset(self.datafile, (500.0, 600.0))
+        self.assertNotEqual(filename3, filename1)
+        stats = selector.stats()
+        self.assertEqual(stats[:3], (1, 2, 1))
+        self.assertEqual(
+            sorted(os.listdir(self.subsetdir)),
+            sorted(os.path.basename(f) for f in [filename1, filename3]),
+        )
+
+    def test_modified(self):
+        """Test data file indexed again after modification"""
+        selector = DataSelector(self.subsetdir)
+        filename1 = selector.subset(self.datafile, uvmax=1.1e8)
+        os.utime(self.datafile, ns=(0, 0))
+        filename2 = selector.subset(self.datafile, uvmax=1.1e8)
+        self.assertNotEqual(filename2, filename1)
+        self.assertEqual(selector.stats().indexed, 2)
+
+    def test_clear(self):
+        """Test subset files removed"""
+        selector = DataSelector(self.subsetdir)
+        selector.subset(self.datafile, uvmax=1.1e8)
+        selector.clear()
+        self.assertEqual(os.listdir(self.subsetdir), [])
+
+    def test_pickle(self):
+        """Test selector can be passed to worker processes"""
+        selector = pickle.loads(pickle.dumps(DataSelector(self.subsetdir)))
+        self.assertEqual(selector.subsetdir, self.subsetdir)
+
+    def test_run_bsmem_using_model(self):
+        """Test bsmem passed subset file and selection options"""
+        selector = DataSelector(self.subsetdir)
+        outputfile = os.path.join(self.tempdir.name, "out.fits")
+        with mock.patch.object(runbs, "run_bsmem") as run_bsmem:
+            runbs.run_bsmem_using_model(
+                self.datafile,
+                outputfile,
+                64,
+                3,
+                10.0,
+                wav=(500.0, 600.0),
+                uvmax=1.1e8,
+                selector=selector,
+                use_cache=False,
+            )
+        args = run_bsmem.call_args[0][0]
+        subsetfile = selector.get_subsetfile(self.datafile, (500.0, 600.0), 1.1e8)
+        self.assertIn(f"--data={subsetfile}", args)
+        self.assertIn("--uvmax=110000000.0", args)
+        self.assertEqual(run_bsmem.call_args[1], {"use_cache": False})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import stat
+import sys
+import tempfile
+import unittest
+from shutil import copyfile
+from unittest import mock
+
+import numpy as np
+
+import oirunner.runbsmem as runbs
+from oirunner.pipeline import Stage, image_change, reconst_grey_nstep, run_pipeline
+
+DATAFILE = "tests/2004contest1.oifits"
+IMAGEFILE = "tests/gauss10.fits"
+
+# Logs arguments and always outputs the same image
+SCRIPT = """#!{python}
+import shutil, sys
+with open("{logfile}", "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+args = dict(a[2:].split("=", 1) for a in sys.argv[1:] if "=" in a)
+shutil.copyfile("{imagefile}", args["output"])
+"""
+
+
+class ImageChangeTestCase(unittest.TestCase):
+    def test_image_change(self):
+        """Test image difference metric"""
+        image = np.arange(16.0).reshape((4, 4))
+        self.assertEqual(image_change(image, 2.0 * image), 0.0)
+        self.assertAlmostEqual(image_change(image, image[::-1, :]), 8.0 / 15.0)
+        disjoint = np.zeros((4, 4))
+        disjoint[0, 0] = 1.0
+        self.assertAlmostEqual(image_change(disjoint, disjoint[::-1, :]), 1.0)
+
+    def test_image_change_shape(self):
+        """Test images of different shapes, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            image_change(np.ones((4, 4)), np.ones((8, 8)))
+
+
+class PipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        dirname = self.tempdir.name
+        self.datafile = os.path.join(dirname, os.path.basename(DATAFILE))
+        copyfile(DATAFILE, self.datafile)
+        self.logfile = os.path.join(dirname, "args.log")
+        exe = os.path.join(dirname, "fakebsmem")
+        with open(exe, "w") as f:
+            f.write(
+                SCRIPT.format(
+                    python=sys.executable,
+                    logfile=self.logfile,
+                    imagefile=os.path.abspath(IMAGEFILE),
+                )
+            )
+        os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR)
+        patcher = mock.patch.object(runbs, "BSMEM", exe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def read_log(self):
+        with open(self.logfile) as f:
+            return f.readlines()
+
+    def test_stages(self):
+        """Test per-stage settings"""
+        stages = [Stage(uvmax=5e7), Stage(uvmax=1e8), Stage(options={"alpha": 50.0})]
+        results = run_pipeline(
+            self.datafile, stages, pixelsize=0.25, dim=64, use_cache=False
+        )
+        self.assertEqual([r.stage for r in results], [1, 2, 3])
+        self.assertIsNone(results[0].change)
+        self.assertEqual(results[1].change, 0.0)
+        self.assertTrue(all(os.path.exists(r.outputfile) for r in results))
+        log = self.read_log()
+        self.assertIn("--uvmax=50000000.0", log[0])
+        self.assertIn("--mt=", log[0])
+        self.assertIn("--uvmax=100000000.0", log[1])
+        self.assertIn("--sf=", log[1])
+        self.assertNotIn("--uvmax", log[2])
+        self.assertIn("--alpha=50.0", log[2])
+
+    def test_converged(self):
+        """Test remaining stages skipped once image stops changing"""
+        outputfile = reconst_grey_nstep(
+            self.datafile,
+            [Stage()] * 4,
+            pixelsize=0.25,
+            dim=64,
+            tolerance=1e-3,
+            use_cache=False,
+        )
+        self.assertEqual(len(self.read_log()), 2)
+        self.assertEqual(os.path.basename(outputfile), "bsmem_2_2004contest1.fits")
+
+    def test_no_stages(self):
+        """Test empty pipeline, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            run_pipeline(self.datafile, [])
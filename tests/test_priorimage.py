@@ -1,3 +1,4 @@
+import tracemalloc
 import unittest
 
 from astropy import wcs
@@ -5,7 +6,30 @@ from astropy.io import fits
 
 import numpy as np
 
-from oirunner.priorimage import MAS_TO_DEG, makesf
+from oirunner.priorimage import MAS_TO_DEG, blur, gaussian_kernel, makesf
+
+import scipy.signal
+
+
+def makesf_loops(data, pixelsize, fwhm, threshold, blank=1e-8):
+    """Original per-pixel implementation of makesf, for comparison."""
+    sigma = fwhm / pixelsize / 2.3548
+    maxvalue = data.max()
+    lowest = threshold * maxvalue
+    bw = int(6 * sigma)
+    kernel = np.zeros((bw, bw), float)
+    for i in range(bw):
+        for j in range(bw):
+            kernel[i, j] = np.exp(
+                -((i - bw / 2) ** 2 + (j - bw / 2) ** 2) / (2 * sigma * sigma)
+            )
+    result = scipy.signal.convolve(data, kernel, "same")
+    result = result * maxvalue / result.max()
+    for i in range(data.shape[0]):
+        for j in range(data.shape[1]):
+            if result[i, j] < lowest:
+                result[i, j] = blank
+    return result
 
 
 class PriorImageTestCase(unittest.TestCase):
@@ -27,6 +51,105 @@ class PriorImageTestCase(unittest.TestCase):
         self.assertAlmostEqual(outhdu.header["CDELT1"], w.wcs.cdelt[0])
         self.assertAlmostEqual(outhdu.header["CDELT2"], w.wcs.cdelt[1])
 
+    def test_makesf_equivalent(self):
+        """Test result agrees with original per-pixel implementation"""
+        rng = np.random.default_rng(42)
+        w = wcs.WCS(naxis=2)
+        w.wcs.cdelt = [0.25 * MAS_TO_DEG, 0.25 * MAS_TO_DEG]
+        for shape, fwhm in [((64, 64), 2.0), ((96, 80), 1.25), ((32, 32), 20.0)]:
+            data = rng.random(shape) ** 8
+            hdu = fits.PrimaryHDU(data, header=w.to_header())
+            outhdu = makesf(hdu, fwhm, 0.05, 0.0025)
+            expected = makesf_loops(data, 0.25, fwhm, 0.05, 0.0025)
+            np.testing.assert_allclose(outhdu.data, expected, rtol=1e-9, atol=1e-12)
+
+    def test_blur(self):
+        """Test FFT blur against direct convolution"""
+        for sigma in [0.5, 2.0, 7.3]:
+            expected = scipy.signal.convolve(
+                self.data, gaussian_kernel(sigma), "same", method="direct"
+            )
+            np.testing.assert_allclose(
+                blur(self.data, sigma), expected, rtol=1e-9, atol=1e-12
+            )
+
+    def test_makesf_cube(self):
+        """Test cube planes processed independently and WCS preserved"""
+        w = wcs.WCS(naxis=3)
+        w.wcs.ctype = ["RA---SIN", "DEC--SIN", "WAVE"]
+        w.wcs.cunit = ["deg", "deg", "nm"]
+        w.wcs.cdelt = [0.5 * MAS_TO_DEG, 0.5 * MAS_TO_DEG, 10.0]
+        w.wcs.crval = [0.0, 0.0, 1500.0]
+        cube = np.stack([self.data, 2.0 * self.data[::-1, :], 0.5 * self.data.T])
+        hdu = fits.PrimaryHDU(cube, header=w.to_header())
+        outhdu = makesf(hdu, 2.0, 0.05, 0.0025)
+        self.assertEqual(outhdu.data.shape, cube.shape)
+        w2 = wcs.WCS(naxis=2)
+        w2.wcs.cdelt = w.wcs.cdelt[:2]
+        for plane, outplane in zip(cube, outhdu.data):
+            planehdu = fits.PrimaryHDU(plane, header=w2.to_header())
+            expected = makesf(planehdu, 2.0, 0.05, 0.0025)
+            np.testing.assert_allclose(outplane, expected.data, rtol=1e-9)
+        self.assertEqual(outhdu.header["CTYPE3"], "WAVE")
+        self.assertAlmostEqual(outhdu.header["CRVAL3"], 1500e-9)
+        self.assertAlmostEqual(outhdu.header["CDELT3"], 10e-9)
+        self.assertAlmostEqual(outhdu.header["CDELT1"], w.wcs.cdelt[0])
+
+    def test_blur_cube(self):
+        """Test cube blur agrees with blurring each plane"""
+        cube = np.stack([self.data, self.data.T, np.ones((64, 64))])
+        result = blur(cube, 2.0)
+        for plane, outplane in zip(cube, result):
+            np.testing.assert_allclose(outplane, blur(plane, 2.0), rtol=1e-12)
+
+    def test_makesf_float32(self):
+        """Test single precision result agrees with double precision"""
+        w = wcs.WCS(naxis=2)
+        w.wcs.cdelt = [0.5 * MAS_TO_DEG, 0.5 * MAS_TO_DEG]
+        hdu = fits.PrimaryHDU(self.data, header=w.to_header())
+        expected = makesf(hdu, 2.0, 0.05, 0.0025)
+        outhdu = makesf(hdu, 2.0, 0.05, 0.0025, dtype=np.float32)
+        self.assertEqual(outhdu.data.dtype, np.float32)
+        np.testing.assert_allclose(outhdu.data, expected.data, rtol=1e-5, atol=1e-7)
+
+    def test_makesf_out(self):
+        """Test result written to preallocated output buffer"""
+        w = wcs.WCS(naxis=2)
+        w.wcs.cdelt = [0.5 * MAS_TO_DEG, 0.5 * MAS_TO_DEG]
+        hdu = fits.PrimaryHDU(self.data.astype(">f8"), header=w.to_header())
+        expected = makesf(hdu, 2.0, 0.05, 0.0025)
+        out = np.empty(self.data.shape, np.float32)
+        outhdu = makesf(hdu, 2.0, 0.05, 0.0025, out=out)
+        self.assertTrue(np.shares_memory(outhdu.data, out))
+        np.testing.assert_allclose(out, expected.data, rtol=1e-5, atol=1e-7)
+
+    def test_blur_peak_memory(self):
+        """Test float32 blur into output buffer uses less memory"""
+        data = np.random.default_rng(1).random((512, 512))
+
+        def peak(**kwargs):
+            blur(data, 4.0, **kwargs)  # populate kernel cache
+            tracemalloc.start()
+            try:
+                blur(data, 4.0, **kwargs)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        out = np.empty(data.shape, np.float32)
+        self.assertLess(peak(out=out), 0.8 * peak())
+
+    def test_gaussian_kernel_cached(self):
+        """Test kernel is cached and read-only"""
+        kernel = gaussian_kernel(3.0)
+        self.assertIs(gaussian_kernel(3.0), kernel)
+        self.assertEqual(kernel.shape, (18, 18))
+        self.assertAlmostEqual(kernel.max(), 1.0)
+        with self.assertRaises(ValueError):
+            kernel[0, 0] = 0.0
+        with self.assertRaises(ValueError):
+            gaussian_kernel(0.1)
+
     def test_makesf_nopixsize(self):
         """CDELT1/2 keywords missing, should fail with KeyError"""
         hdu = fits.PrimaryHDU(self.data)
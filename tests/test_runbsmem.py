@@ -1,8 +1,14 @@
-import os.path
+import glob
+import math
+import os
+import pickle
 import tempfile
 import unittest
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfile
 from subprocess import CalledProcessError, run
+from unittest import mock
 
 try:
     run(["bsmem", "-V"])
@@ -10,10 +16,15 @@ try:
 except (CalledProcessError, OSError):
     HAVE_BSMEM = False
 
+from astropy.io import fits
+
 import oirunner.runbsmem as runbs
+from oirunner.bsmemcache import ResultCache
+from oirunner.priorimage import get_pixelsize
 
 DATAFILE = "tests/2004contest1.oifits"
 IMAGEFILE = "tests/gauss10.fits"
+FAKEBSMEM = os.path.abspath("tests/fakebsmem.py")
 
 
 class RunBsmemTestCase(unittest.TestCase):
@@ -146,3 +157,139 @@ class RunBsmemTestCase(unittest.TestCase):
             copyfile(DATAFILE, tempdatafile)
             out = runbs.reconst_grey_2step_using_image(tempdatafile, IMAGEFILE)
             self.assertTrue(os.path.exists(out))
+
+
+@mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+class FakeBsmemTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.datafile = os.path.join(self.tempdir.name, os.path.basename(DATAFILE))
+        copyfile(DATAFILE, self.datafile)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_grey_basic(self):
+        """Test grey reconstruction using stand-in bsmem"""
+        out = runbs.reconst_grey_basic(
+            self.datafile, pixelsize=0.25, wav=(500.0, 600.0), use_cache=False
+        )
+        self.assertTrue(os.path.exists(out))
+        self.assertTrue(os.path.exists(runbs._get_fullstdout(out)))
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            with fits.open(out) as hdulist:
+                hdulist.verify("exception")
+                self.assertAlmostEqual(get_pixelsize(hdulist[0]), 0.25, places=10)
+
+    def test_result(self):
+        """Test result of run gives metrics, arguments and image"""
+        result = runbs.reconst_grey_basic(
+            self.datafile, pixelsize=0.25, dim=32, use_cache=False
+        )
+        self.assertEqual(
+            os.fspath(result), runbs._get_outputfile(self.datafile, 1, None)
+        )
+        self.assertEqual(str(result), result.outputfile)
+        self.assertEqual(result.args[0], FAKEBSMEM)
+        self.assertIn("--dim=32", result.args)
+        self.assertEqual([r.iteration for r in result.records], list(range(1, 11)))
+        self.assertEqual(result.iterations, 10)
+        self.assertAlmostEqual(result.final.chi2, 1.0 + 100.0 * math.exp(-10 / 3), 4)
+        self.assertGreater(result.seconds, 0.0)
+        self.assertGreater(result.rusage.ru_maxrss, 0)
+        self.assertIsNone(result.stop_reason)
+        self.assertFalse(result.reused)
+        self.assertEqual(result.image.shape, (32, 32))
+        self.assertIs(result.hdu, result.hdu)
+        result = pickle.loads(pickle.dumps(result))
+        self.assertEqual(result.iterations, 10)
+
+    def test_grey_2step_using_image(self):
+        """Test two-step grey reconstruction using stand-in bsmem"""
+        records = []
+        out = runbs.reconst_grey_2step_using_image(
+            self.datafile, IMAGEFILE, use_cache=False, callback=records.append
+        )
+        self.assertTrue(os.path.exists(out))
+        self.assertEqual([r.iteration for r in records], 2 * list(range(1, 11)))
+
+    def test_fail(self):
+        """Test failing bsmem run, should fail with CalledProcessError"""
+        with mock.patch.dict(os.environ, {"FAKEBSMEM_EXIT": "2"}):
+            with self.assertRaises(CalledProcessError) as cm:
+                runbs.reconst_grey_basic(self.datafile, use_cache=False)
+        self.assertEqual(cm.exception.returncode, 2)
+        self.assertIn("Reconstruction failed", cm.exception.stderr)
+
+
+@mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+class IsolationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.datafile = os.path.join(self.tempdir.name, os.path.basename(DATAFILE))
+        copyfile(DATAFILE, self.datafile)
+        cache = ResultCache(os.path.join(self.tempdir.name, "cache"))
+        patcher = mock.patch.object(runbs, "get_default_cache", return_value=cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_hash_names(self):
+        """Test output filenames distinguish parameters when requested"""
+        kwargs = dict(dim=16, wav=(500.0, 600.0), use_cache=False, hash_names=True)
+        with ThreadPoolExecutor(2) as executor:
+            futures = [
+                executor.submit(
+                    runbs.reconst_grey_basic, self.datafile, alpha=alpha, **kwargs
+                )
+                for alpha in [10.0, 100.0]
+            ]
+            results = [future.result() for future in futures]
+        outputs = [os.fspath(result) for result in results]
+        self.assertNotEqual(outputs[0], outputs[1])
+        for result, alpha in zip(results, [10.0, 100.0]):
+            self.assertIn(f"--alpha={alpha}", result.args)
+            self.assertTrue(os.path.exists(runbs._get_fullstdout(result.outputfile)))
+        self.assertRegex(
+            os.path.basename(outputs[0]),
+            r"^bsmem_1_2004contest1_550nm_[0-9a-f]{10}\.fits$",
+        )
+        kwargs["wav"] = [500.0, 600.0]
+        again = runbs.reconst_grey_basic(self.datafile, alpha=10.0, **kwargs)
+        self.assertEqual(os.fspath(again), outputs[0])
+        out = runbs.reconst_grey_basic(self.datafile, dim=16, use_cache=False)
+        self.assertEqual(os.fspath(out), runbs._get_outputfile(self.datafile, 1, None))
+
+    def test_isolate(self):
+        """Test concurrent identical runs wait for and reuse first result"""
+        with mock.patch.dict(os.environ, {"FAKEBSMEM_DELAY": "0.02"}):
+            with ThreadPoolExecutor(3) as executor:
+                futures = [
+                    executor.submit(
+                        runbs.reconst_grey_basic, self.datafile, dim=16, isolate=True
+                    )
+                    for _ in range(3)
+                ]
+                results = [future.result() for future in futures]
+        self.assertEqual(sorted(r.reused for r in results), [False, True, True])
+        self.assertTrue(all(r.iterations == 10 for r in results))
+        self.assertTrue(os.path.exists(results[0].outputfile))
+        self.assertTrue(os.path.exists(runbs._get_fullstdout(results[0].outputfile)))
+        self.assertEqual(glob.glob(os.path.join(self.tempdir.name, ".bsmem-*")), [])
+
+    def test_isolate_fail(self):
+        """Test failed isolated run leaves previous output intact"""
+        out = runbs.reconst_grey_basic(self.datafile, dim=16, isolate=True)
+        with open(out.outputfile, "rb") as f:
+            previous = f.read()
+        with mock.patch.dict(os.environ, {"FAKEBSMEM_EXIT": "2"}):
+            with self.assertRaises(CalledProcessError):
+                runbs.reconst_grey_basic(
+                    self.datafile, dim=16, isolate=True, use_cache=False
+                )
+        with open(out.outputfile, "rb") as f:
+            self.assertEqual(f.read(), previous)
+        self.assertEqual(glob.glob(os.path.join(self.tempdir.name, ".bsmem-*")), [])
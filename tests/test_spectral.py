@@ -0,0 +1,235 @@
+import os
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+
+from astropy import wcs
+from astropy.io import fits
+
+import numpy as np
+
+import oirunner.runbsmem as runbs
+import oirunner.spectral as spectral
+from oirunner.bsmemcube.__main__ import create_parser, makecube
+from oirunner.priorimage import MAS_TO_DEG
+from oirunner.runbsmem import _get_outputfile
+from oirunner.spectral import (
+    ChainResult,
+    chain_savings,
+    get_anchors,
+    get_wavelength_bins,
+    reconst_chained,
+    reconst_chained_cube,
+    reconst_grey_cube,
+)
+
+from .test_runbsmem import FAKEBSMEM
+
+DATAFILE = "tests/2004contest1.oifits"
+
+
+def fake_reconst(datafile, wav=None, dim=16):
+    """Write image whose pixels equal the mean wavelength."""
+    if wav[0] < 0.0:
+        raise RuntimeError("negative wavelength")
+    outputfile = _get_outputfile(datafile, 1, wav)
+    w = wcs.WCS(naxis=2)
+    w.wcs.cdelt = [0.5 * MAS_TO_DEG, 0.5 * MAS_TO_DEG]
+    data = np.full((dim, dim), (wav[0] + wav[1]) / 2)
+    fits.PrimaryHDU(data, header=w.to_header()).writeto(outputfile)
+    return outputfile
+
+
+class SpectralTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.datafile = os.path.join(self.tempdir.name, "multi.oifits")
+        hdulist = fits.HDUList([fits.PrimaryHDU()])
+        for insname, waves in [("A", [700e-9, 650e-9]), ("B", [600e-9, 650e-9])]:
+            hdu = fits.BinTableHDU.from_columns(
+                [
+                    fits.Column("EFF_WAVE", "E", array=waves),
+                    fits.Column("EFF_BAND", "E", array=[20e-9, 20e-9]),
+                ],
+                name="OI_WAVELENGTH",
+            )
+            hdu.header["INSNAME"] = insname
+            hdulist.append(hdu)
+        hdulist.writeto(self.datafile)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_wavelength_bins(self):
+        """Test channel limits derived from OI_WAVELENGTH tables"""
+        bins = get_wavelength_bins(self.datafile)
+        self.assertEqual(len(bins), 3)
+        for (wavmin, wavmax), mean in zip(bins, [600.0, 650.0, 700.0]):
+            self.assertAlmostEqual(wavmin, mean - 10.0, places=3)
+            self.assertAlmostEqual(wavmax, mean + 10.0, places=3)
+        bins = get_wavelength_bins(DATAFILE)
+        self.assertEqual(len(bins), 1)
+        self.assertAlmostEqual(bins[0][0], 540.0, places=3)
+
+    def test_cube(self):
+        """Test cube assembly in channel order"""
+        for processes in [False, True]:
+            cubefile, results = reconst_grey_cube(
+                self.datafile,
+                reconst=fake_reconst,
+                workers=2,
+                processes=processes,
+                dim=8,
+            )
+            self.assertTrue(all(r.error is None for r in results))
+            with fits.open(cubefile) as hdulist:
+                cube = hdulist[0].data
+                self.assertEqual(cube.shape, (3, 8, 8))
+                np.testing.assert_allclose(cube[:, 0, 0], [600.0, 650.0, 700.0])
+                self.assertEqual(hdulist[0].header["CTYPE3"], "WAVE")
+                self.assertAlmostEqual(hdulist[0].header["CDELT3"], 50.0, places=3)
+                self.assertEqual(len(hdulist["WAVELENGTHS"].data), 3)
+            for r in results:
+                os.remove(r.outputfile)
+
+    def test_cube_failure(self):
+        """Test failed channel is reported and left blank"""
+        wavs = [(500.0, 520.0), (-10.0, 10.0), (600.0, 620.0)]
+        cubefile, results = reconst_grey_cube(
+            self.datafile, wavs, reconst=fake_reconst, workers=3
+        )
+        self.assertIsNone(results[0].error)
+        self.assertIsInstance(results[1].error, RuntimeError)
+        self.assertIsNone(results[1].outputfile)
+        with fits.open(cubefile) as hdulist:
+            self.assertTrue(np.all(np.isnan(hdulist[0].data[1])))
+            self.assertFalse(np.any(np.isnan(hdulist[0].data[2])))
+            self.assertFalse(hdulist["WAVELENGTHS"].data["OK"][1])
+
+    def test_uneven_channels(self):
+        """Test cube of unevenly spaced channels has no linear wavelength axis"""
+        wavs = [(500.0, 520.0), (520.0, 540.0), (600.0, 620.0)]
+        cubefile, _ = reconst_grey_cube(self.datafile, wavs, reconst=fake_reconst)
+        with fits.open(cubefile) as hdulist:
+            self.assertNotIn("CTYPE3", hdulist[0].header)
+            self.assertNotIn("CDELT3", hdulist[0].header)
+            np.testing.assert_allclose(
+                hdulist["WAVELENGTHS"].data["WAV_MIN"], [500.0, 520.0, 600.0]
+            )
+
+    def test_cli_exists(self):
+        """Existing default cube file, should fail with SystemExit"""
+        cubefile = os.path.join(self.tempdir.name, "bsmem_cube_multi.fits")
+        fits.PrimaryHDU().writeto(cubefile)
+        args = create_parser().parse_args([self.datafile])
+        with mock.patch("oirunner.bsmemcube.__main__.reconst_grey_cube") as reconst:
+            with self.assertRaises(SystemExit):
+                makecube(args)
+        reconst.assert_not_called()
+
+    def test_duplicate_channels(self):
+        """Channels sharing output filename, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            reconst_grey_cube(
+                self.datafile, [(500.0, 520.0), (500.2, 520.1)], reconst=fake_reconst
+            )
+
+
+class ChainedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.datafile = os.path.join(self.tempdir.name, os.path.basename(DATAFILE))
+        with open(DATAFILE, "rb") as fin, open(self.datafile, "wb") as fout:
+            fout.write(fin.read())
+        self.wavs = [(500.0 + 10 * i, 510.0 + 10 * i) for i in range(7)]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_anchors(self):
+        """Test anchors at centres of equal groups of channels"""
+        self.assertEqual(get_anchors(7, 1), [3])
+        self.assertEqual(get_anchors(7, 2), [1, 5])
+        self.assertEqual(get_anchors(3, 5), [0, 1, 2])
+        with self.assertRaises(ValueError):
+            get_anchors(0, 1)
+
+    @mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+    @mock.patch.dict(os.environ, {"FAKEBSMEM_NITER": "12", "FAKEBSMEM_SF_NITER": "4"})
+    def test_chained(self):
+        """Test each channel started from neighbour nearer its anchor"""
+        results = reconst_chained(
+            self.datafile,
+            self.wavs,
+            pixelsize=0.25,
+            dim=16,
+            fwhm=1.0,
+            nchains=2,
+            workers=3,
+            use_cache=False,
+        )
+        self.assertEqual([r.wav for r in results], self.wavs)
+        self.assertEqual([r.prior for r in results], [1, None, 1, 2, 5, None, 5])
+        self.assertEqual([r.iterations for r in results], [4, 12, 4, 4, 4, 12, 4])
+        for r in results:
+            with fits.open(r.outputfile) as hdulist:
+                self.assertEqual(hdulist[0].data.shape, (16, 16))
+        savings = chain_savings(results)
+        self.assertEqual(savings[:4], (2, 5, 12.0, 4.0))
+        self.assertEqual(savings.iterations_saved, 40.0)
+
+    @mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+    def test_chain_failure(self):
+        """Test chain continues from last successful image"""
+        run_bsmem_using_image = spectral.run_bsmem_using_image
+
+        def fail_second(datafile, outputfile, *args, wav=None, **kwargs):
+            if wav == self.wavs[1]:
+                raise RuntimeError("bsmem failed")
+            return run_bsmem_using_image(datafile, outputfile, *args, wav=wav, **kwargs)
+
+        with mock.patch.object(
+            spectral, "run_bsmem_using_image", side_effect=fail_second
+        ):
+            results = reconst_chained(
+                self.datafile, self.wavs[:4], dim=16, anchors=[0], use_cache=False
+            )
+        self.assertIsInstance(results[1].error, RuntimeError)
+        self.assertIsNone(results[1].outputfile)
+        self.assertEqual([r.prior for r in results], [None, 0, 0, 2])
+        self.assertIsNotNone(results[3].outputfile)
+
+    def test_savings(self):
+        """Test warm starts compared with matching cold starts"""
+        wavs = self.wavs[:3]
+        warm = [
+            ChainResult(wavs[0], "a", None, None, 20, 2.0),
+            ChainResult(wavs[1], "b", None, 0, 5, 0.5),
+            ChainResult(wavs[2], "c", None, 1, 6, 0.6),
+        ]
+        cold = [
+            ChainResult(wavs[1], "d", None, None, 10, 1.0),
+            ChainResult(wavs[2], "e", RuntimeError("bad"), None, None, 0.0),
+        ]
+        savings = chain_savings(warm, cold)
+        self.assertEqual(savings[:4], (1, 2, 10.0, 5.5))
+        self.assertEqual(savings.iterations_saved, 9.0)
+        self.assertAlmostEqual(savings.seconds_saved, 0.9)
+        with self.assertRaises(ValueError):
+            chain_savings(warm[:1])
+
+    @mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+    def test_chained_cube(self):
+        """Test chained channels assembled into cube"""
+        cubefile, results = reconst_chained_cube(
+            self.datafile, self.wavs[:3], dim=16, use_cache=False
+        )
+        self.assertEqual([r.prior for r in results], [1, None, 1])
+        with fits.open(cubefile) as hdulist:
+            self.assertEqual(hdulist[0].data.shape, (3, 16, 16))
+
+    def test_bad_anchor(self):
+        """Anchor outside channel range, should fail with ValueError"""
+        with self.assertRaises(ValueError):
+            reconst_chained(self.datafile, self.wavs, anchors=[7])
@@ -0,0 +1,81 @@
+import gc
+import os
+import tempfile
+import unittest
+import weakref
+from unittest import mock
+
+from astropy.io import fits
+
+import numpy as np
+
+import oirunner.runbsmem as runbs
+from oirunner.staging import PriorStager
+
+DATAFILE = "tests/2004contest1.oifits"
+
+
+class PriorStagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.scratchdir = os.path.join(self.tempdir.name, "scratch")
+        self.hdu = fits.PrimaryHDU(np.ones((8, 8)))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_reuse(self):
+        """Test identical image is written once"""
+        with PriorStager(self.scratchdir) as stager:
+            with stager.stage(self.hdu) as filename1:
+                self.assertEqual(os.path.dirname(filename1), self.scratchdir)
+                with fits.open(filename1) as hdulist:
+                    np.testing.assert_array_equal(hdulist[0].data, self.hdu.data)
+            with stager.stage(fits.PrimaryHDU(np.ones((8, 8)))) as filename2:
+                self.assertEqual(filename2, filename1)
+            with stager.stage(fits.PrimaryHDU(np.zeros((8, 8)))) as filename3:
+                self.assertNotEqual(filename3, filename1)
+            stats = stager.stats()
+            self.assertEqual((stats.written, stats.reused), (2, 1))
+            self.assertGreater(stats.seconds, 0.0)
+            self.assertTrue(os.path.exists(filename1))
+        self.assertEqual(os.listdir(self.scratchdir), [])
+
+    def test_noreuse(self):
+        """Test staged file removed after use when reuse disabled"""
+        stager = PriorStager(self.scratchdir, reuse=False)
+        with stager.stage(self.hdu) as filename:
+            self.assertTrue(os.path.exists(filename))
+        self.assertFalse(os.path.exists(filename))
+
+    def test_maxfiles(self):
+        """Test number of unused staged files is bounded"""
+        with PriorStager(self.scratchdir, maxfiles=2) as stager:
+            for value in range(4):
+                with stager.stage(fits.PrimaryHDU(np.full((4, 4), value))):
+                    pass
+            self.assertEqual(len(stager.files()), 2)
+            self.assertEqual(len(os.listdir(self.scratchdir)), 2)
+
+    def test_collected(self):
+        """Test staged files removed when stager is garbage collected"""
+        stager = PriorStager(self.scratchdir)
+        with stager.stage(self.hdu):
+            pass
+        self.assertEqual(len(os.listdir(self.scratchdir)), 1)
+        ref = weakref.ref(stager)
+        del stager
+        gc.collect()
+        self.assertIsNone(ref())
+        self.assertEqual(os.listdir(self.scratchdir), [])
+
+    def test_failure_cleanup(self):
+        """Test staged file removed when bsmem fails"""
+        stager = PriorStager(self.scratchdir, reuse=False)
+        outputfile = os.path.join(self.tempdir.name, "out.fits")
+        with mock.patch.object(runbs, "BSMEM", "/nonexistent/bsmem"):
+            with self.assertRaises(OSError):
+                runbs.run_bsmem_using_image(
+                    DATAFILE, outputfile, 8, 0.5, self.hdu, stager=stager
+                )
+        self.assertEqual(os.listdir(self.scratchdir), [])
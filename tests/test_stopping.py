@@ -0,0 +1,95 @@
+import os
+import tempfile
+import time
+import unittest
+
+from astropy.io import fits
+
+from oirunner.bsmemoutput import IterationRecord
+from oirunner.runbsmem import BsmemStopped, run_bsmem
+from oirunner.stopping import AnyOf, ChiSquaredPlateau, MaxIterations
+
+IMAGEFILE = "tests/gauss10.fits"
+
+SCRIPT = """
+cp "{imagefile}" "$1"
+i=1
+while true; do
+  echo "Iteration $i"
+  echo "Chi2 = {chi2}"
+  i=$((i + 1))
+  sleep 0.05
+done
+"""
+
+
+def record(iteration, chi2):
+    """Return iteration record with only chi2 set."""
+    return IterationRecord(iteration, chi2, None, None, None, {}, "")
+
+
+class StopPolicyTestCase(unittest.TestCase):
+    def test_plateau(self):
+        """Test chi2 plateau detection"""
+        policy = ChiSquaredPlateau(epsilon=0.01, patience=2)
+        chi2s = [100.0, 50.0, 49.9, 49.8, 49.7]
+        reasons = [policy(record(i, c)) for i, c in enumerate(chi2s)]
+        self.assertEqual(reasons[:3], [None, None, None])
+        self.assertIsNotNone(reasons[3])
+        policy.reset()
+        self.assertIsNone(policy(record(1, 49.7)))
+
+    def test_max_iterations(self):
+        """Test iteration limit, combined with another policy"""
+        policy = AnyOf([ChiSquaredPlateau(), MaxIterations(3)])
+        self.assertIsNone(policy(record(2, 10.0)))
+        self.assertIn("3 iterations", policy(record(3, 5.0)))
+
+
+class EarlyStopTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.outputfile = os.path.join(self.tempdir.name, "out.fits")
+        self.fullstdout = os.path.join(self.tempdir.name, "out.txt")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _args(self, chi2="100.0", imagefile=IMAGEFILE):
+        script = SCRIPT.format(imagefile=imagefile, chi2=chi2)
+        return [
+            "sh",
+            "-c",
+            script,
+            "sh",
+            self.outputfile,
+            f"--output={self.outputfile}",
+        ]
+
+    def test_policy(self):
+        """Test bsmem stopped on convergence, keeping image"""
+        policy = ChiSquaredPlateau(patience=3)
+        reason = run_bsmem(
+            self._args(), self.fullstdout, use_cache=False, stop_policy=policy
+        ).stop_reason
+        self.assertIn("chi2", reason)
+        with fits.open(self.outputfile) as hdulist:
+            self.assertIn(reason, str(hdulist[0].header["HISTORY"]))
+        with open(self.fullstdout) as f:
+            text = f.read()
+        self.assertIn("Iteration 4", text)
+        self.assertIn("stopped early", text)
+
+    def test_timeout(self):
+        """Test bsmem stopped by wall-clock limit"""
+        start = time.monotonic()
+        reason = run_bsmem(self._args(), use_cache=False, timeout=0.5).stop_reason
+        self.assertIn("wall-clock", reason)
+        self.assertLess(time.monotonic() - start, 5.0)
+
+    def test_timeout_noimage(self):
+        """No image written before stop, should fail with BsmemStopped"""
+        with self.assertRaises(BsmemStopped):
+            run_bsmem(
+                self._args(imagefile="/nonexistent"), use_cache=False, timeout=0.3
+            )
@@ -0,0 +1,151 @@
+import io
+import os
+import stat
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+from shutil import copyfile
+from unittest import mock
+
+from astropy.table import Table
+
+import oirunner.runbsmem as runbs
+from oirunner.bsmemsweep.__main__ import create_parser, parse_ranges, runsweep
+from oirunner.sweep import Pruning, param_grid, param_sample, sweep, write_results
+
+DATAFILE = "tests/2004contest1.oifits"
+IMAGEFILE = "tests/gauss10.fits"
+
+# Converges to chi2 = alpha after 5 iterations
+SCRIPT = """#!{python}
+import shutil, sys, time
+args = dict(a[2:].split("=", 1) for a in sys.argv[1:] if "=" in a)
+if float(args["alpha"]) < 0:
+    sys.exit("bad alpha")
+for i in range(1, 6):
+    time.sleep(0.05)
+    print("Iteration", i)
+    print("Chi2 =", float(args["alpha"]) * (6 - i), " Entropy = -1.0 Flux = 1.0")
+    sys.stdout.flush()
+shutil.copyfile("{imagefile}", args["output"])
+"""
+
+
+class SweepTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        dirname = self.tempdir.name
+        self.datafile = os.path.join(dirname, os.path.basename(DATAFILE))
+        copyfile(DATAFILE, self.datafile)
+        exe = os.path.join(dirname, "fakebsmem")
+        with open(exe, "w") as f:
+            f.write(
+                SCRIPT.format(
+                    python=sys.executable, imagefile=os.path.abspath(IMAGEFILE)
+                )
+            )
+        os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR)
+        patcher = mock.patch.object(runbs, "BSMEM", exe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_param_grid(self):
+        """Test grid of parameter combinations"""
+        combinations = param_grid({"alpha": [1.0, 2.0], "v2a": [1.0, 1.1, 1.2]})
+        self.assertEqual(len(combinations), 6)
+        self.assertEqual(combinations[1], {"alpha": 1.0, "v2a": 1.1})
+
+    def test_param_sample(self):
+        """Test random sample of parameter combinations"""
+        samples = param_sample(
+            {"alpha": (10.0, 1e4), "v2a": (1.0, 2.0)}, 50, log={"alpha"}, seed=1
+        )
+        self.assertEqual(len(samples), 50)
+        self.assertTrue(all(10.0 <= s["alpha"] <= 1e4 for s in samples))
+        self.assertEqual(
+            samples,
+            param_sample(
+                {"alpha": (10.0, 1e4), "v2a": (1.0, 2.0)}, 50, log={"alpha"}, seed=1
+            ),
+        )
+
+    def test_sweep(self):
+        """Test sweep collects final metrics in order"""
+        combinations = param_grid({"alpha": [3.0, -1.0, 1.0]})
+        results = sweep(self.datafile, combinations, workers=3, use_cache=False)
+        self.assertEqual([r.chi2 for r in results], [3.0, None, 1.0])
+        self.assertEqual(results[0].iterations, 5)
+        self.assertEqual(results[0].flux, 1.0)
+        self.assertIsNotNone(results[1].error)
+        self.assertTrue(os.path.exists(results[2].outputfile))
+        for ext in [".csv", ".fits"]:
+            filename = os.path.join(self.tempdir.name, "results" + ext)
+            write_results(results, filename)
+            table = Table.read(filename)
+            self.assertEqual(list(table["param_alpha"][[0, 2]]), [3.0, 1.0])
+
+    def test_prune(self):
+        """Test unpromising combinations are abandoned"""
+        combinations = param_grid({"alpha": [float(a) for a in range(1, 10)]})
+        results = sweep(
+            self.datafile,
+            combinations,
+            workers=4,
+            pruning=Pruning(min_iterations=2, eta=3, final_fraction=0.1),
+            use_cache=False,
+        )
+        self.assertEqual([r.run for r in results if not r.pruned], [0])
+        self.assertEqual(results[0].chi2, 1.0)
+        self.assertEqual(results[0].iterations, 5)
+        # Second round of 6 iterations lets best 3 finish
+        self.assertEqual([r.iterations for r in results[1:3]], [5, 5])
+        self.assertTrue(all(r.iterations == 2 for r in results[3:]))
+        self.assertTrue(all(r.outputfile is None for r in results[1:]))
+
+    @mock.patch.object(runbs, "get_default_cache", return_value=None)
+    def test_cli(self, get_default_cache):
+        """Test command-line interface"""
+        table = os.path.join(self.tempdir.name, "results.csv")
+        parser = create_parser()
+        args = parser.parse_args(
+            ["--grid=alpha=1,2", "--grid=v2a=1.0,1.5", "-j", "2", self.datafile, table]
+        )
+        self.assertEqual(runsweep(args), 0)
+        self.assertEqual(len(Table.read(table)), 4)
+
+    def test_cli_no_cache(self):
+        """Test --no-cache passed to every run"""
+        table = os.path.join(self.tempdir.name, "results.csv")
+        parser = create_parser()
+        args = parser.parse_args(["--grid=alpha=1", "--no-cache", self.datafile, table])
+        with mock.patch("oirunner.bsmemsweep.__main__.sweep", return_value=[]) as m:
+            runsweep(args)
+        self.assertIs(m.call_args[1]["use_cache"], False)
+
+    def test_cli_bad_spec(self):
+        """Malformed --grid or --range, should fail with usage error"""
+        parser = create_parser()
+        for spec in [
+            ["--grid", "alpha"],
+            ["--grid", "alpha=x"],
+            ["--range", "alpha=1"],
+            ["--range", "alpha=1:x"],
+            ["--range", "alpha=1:2:lin"],
+        ]:
+            with self.subTest(spec):
+                with redirect_stderr(io.StringIO()) as stderr:
+                    with self.assertRaises(SystemExit) as cm:
+                        parser.parse_args(spec + [self.datafile, "out.csv"])
+                self.assertEqual(cm.exception.code, 2)
+                self.assertIn("invalid", stderr.getvalue())
+        args = parser.parse_args(
+            ["--range", "alpha=1:10:log", "--range", "v2a=1:2", self.datafile, "t"]
+        )
+        self.assertEqual(
+            parse_ranges(args.range),
+            ({"alpha": (1.0, 10.0), "v2a": (1.0, 2.0)}, {"alpha"}),
+        )
@@ -0,0 +1,103 @@
+import json
+import os
+import pstats
+import tempfile
+import unittest
+from shutil import copyfile
+from unittest import mock
+
+import oirunner.runbsmem as runbs
+from oirunner import timing
+
+DATAFILE = "tests/2004contest1.oifits"
+IMAGEFILE = "tests/gauss10.fits"
+FAKEBSMEM = os.path.abspath("tests/fakebsmem.py")
+
+
+class SpanTestCase(unittest.TestCase):
+    def test_nested(self):
+        """Test spans record parent and attributes"""
+        recorder = timing.SpanRecorder()
+        with timing.using_hook(recorder):
+            with timing.span("outer", size=1) as attributes:
+                with timing.span("inner"):
+                    pass
+                attributes["extra"] = 2
+        inner, outer = recorder.spans
+        self.assertEqual((inner.name, outer.name), ("inner", "outer"))
+        self.assertEqual(inner.parent_id, outer.span_id)
+        self.assertIsNone(outer.parent_id)
+        self.assertEqual(outer.attributes, {"size": 1, "extra": 2})
+        self.assertGreaterEqual(outer.seconds, inner.seconds)
+        self.assertEqual(recorder.summary()["inner"][0], 1)
+
+    def test_error(self):
+        """Test span records exception"""
+        recorder = timing.SpanRecorder()
+        with timing.using_hook(recorder):
+            with self.assertRaises(ValueError):
+                with timing.span("failing"):
+                    raise ValueError("oops")
+        self.assertIn("oops", recorder.spans[0].attributes["error"])
+
+    def test_no_hooks(self):
+        """Test spans not created without hooks"""
+        recorder = timing.SpanRecorder()
+        with timing.using_hook(recorder):
+            pass
+        with timing.span("ignored"):
+            pass
+        self.assertEqual(recorder.spans, [])
+
+    def test_exporter(self):
+        """Test spans written as JSON lines"""
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, "spans.jsonl")
+            with timing.using_hook(timing.JsonLinesExporter(filename)):
+                with timing.span("first", value=1.5):
+                    pass
+                with timing.span("second"):
+                    pass
+            with open(filename) as f:
+                spans = [json.loads(line) for line in f]
+        self.assertEqual([s["name"] for s in spans], ["first", "second"])
+        self.assertEqual(spans[0]["attributes"], {"value": 1.5})
+
+    def test_profile(self):
+        """Test profile written in pstats format"""
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, "oirunner.prof")
+            with timing.profile(filename):
+                sorted(range(1000), key=lambda x: -x)
+            stats = pstats.Stats(filename)
+        self.assertGreater(stats.total_calls, 0)
+
+
+@mock.patch.object(runbs, "BSMEM", FAKEBSMEM)
+class ReconstTimingTestCase(unittest.TestCase):
+    def test_grey_2step(self):
+        """Test reconstruction stages are timed"""
+        recorder = timing.SpanRecorder()
+        with tempfile.TemporaryDirectory() as dirname:
+            datafile = os.path.join(dirname, os.path.basename(DATAFILE))
+            copyfile(DATAFILE, datafile)
+            with timing.using_hook(recorder):
+                runbs.reconst_grey_2step_using_image(
+                    datafile, IMAGEFILE, use_cache=False
+                )
+        summary = recorder.summary()
+        for name in [
+            "fits.read",
+            "stage_prior",
+            "makesf",
+            "makesf.blur",
+            "makesf.threshold",
+            "bsmem.process",
+        ]:
+            self.assertIn(name, summary)
+        self.assertEqual(summary["bsmem"][0], 2)
+        attributes = [s.attributes for s in recorder.spans if s.name == "bsmem"][0]
+        self.assertEqual(attributes["returncode"], 0)
+        self.assertGreater(attributes["cpu_user"] + attributes["cpu_system"], 0.0)
+        self.assertGreater(attributes["maxrss"], 0)
+        self.assertGreater(attributes["parse_seconds"], 0.0)